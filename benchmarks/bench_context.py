@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+"""Benchmark pushing and popping logging context on deep stacks.
+
+Compares ContextStack, which keeps a flattened dict per level, with
+rebuilding the flattened dict from every level after each change, as it
+used to.
+
+Usage: python benchmarks/bench_context.py [iterations]
+"""
+
+from collections import OrderedDict
+import sys
+import timeit
+
+from talisker.context import ContextStack
+
+
+class RebuildContextStack(ContextStack):
+    """The previous implementation, for comparison."""
+
+    def __init__(self, *dicts):
+        self.stack = list(dicts)
+        self._flat = None
+
+    @property
+    def flat(self):
+        if self._flat is None:
+            self._flat = OrderedDict(self._iterate())
+        return self._flat
+
+    def _iterate(self):
+        seen = set()
+        for d in reversed(self.stack):
+            for k, v in d.items():
+                if k not in seen:
+                    yield k, v
+            seen = seen.union(d)
+
+    def push(self, _dict=None, **kwargs):
+        d = {} if _dict is None else _dict.copy()
+        d.update(kwargs)
+        level = len(self.stack)
+        self.stack.append(d)
+        self._flat = None
+        return level
+
+    def pop(self):
+        if self.stack:
+            self.stack.pop()
+        self._flat = None
+
+
+def main(iterations=20000):
+    for depth in (1, 10, 50):
+        layers = [
+            {'key{}_{}'.format(i, j): j for j in range(3)}
+            for i in range(depth)
+        ]
+        results = {}
+        for cls in (RebuildContextStack, ContextStack):
+            stack = cls(*layers)
+
+            def task():
+                # a loop pushing per-item context, logging twice per item
+                stack.push(item=1)
+                stack.flat
+                stack.flat
+                stack.pop()
+                stack.flat
+
+            t = timeit.timeit(task, number=iterations)
+            results[cls] = t
+            print('depth {:3} {:20} {:8.2f}us per item'.format(
+                depth, cls.__name__, t / iterations * 1e6))
+        print('depth {:3} {:20} {:8.2f}x'.format(
+            depth, 'speedup',
+            results[RebuildContextStack] / results[ContextStack]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
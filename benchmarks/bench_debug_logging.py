@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Benchmark DEBUG log calls that no handler will emit.
+
+Compares deferred structured extra merging with merging every record, as
+StructuredLogger used to.
+
+Usage: python benchmarks/bench_debug_logging.py [iterations]
+"""
+
+import logging
+import sys
+import timeit
+
+from talisker import logs
+from talisker.context import Context
+from talisker.testing import TestHandler
+
+
+def main(iterations=100000):
+    logging.setLoggerClass(logs.StructuredLogger)
+    logger = logging.getLogger('bench.debug')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = TestHandler(level=logging.INFO)
+    logger.addHandler(handler)
+
+    logs.set_global_extra({'service': 'bench', 'unit': 'bench/0'})
+    Context.new()
+    Context.request_id = 'a4e3c2d1-1234-4321-abcd-0123456789ab'
+    logs.logging_context.push(method='GET', path='/api/v1/things')
+
+    def debug():
+        logger.debug('debug %s', 'msg', extra={'foo': 'bar', 'baz': 1})
+
+    results = {}
+    for name, will_emit in (('eager', lambda level: True),
+                            ('deferred', logger.will_emit)):
+        logger.will_emit = will_emit
+        t = timeit.timeit(debug, number=iterations)
+        results[name] = t
+        print('{:10} {:8.2f}us per debug call'.format(
+            name, t / iterations * 1e6))
+    assert not handler.records
+    print('speedup    {:8.2f}x'.format(results['eager'] / results['deferred']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
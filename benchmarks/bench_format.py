@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Benchmark StructuredFormatter.format with and without the per-second
+timestamp cache and precompiled format.
+
+Usage: python benchmarks/bench_format.py [iterations]
+"""
+
+import logging
+import sys
+import time
+import timeit
+
+from talisker import logs
+
+
+class UncachedFormatter(logs.StructuredFormatter):
+    """StructuredFormatter as it was before the caching."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compiled_fmt = None
+
+    def formatTime(self, record, datefmt=None):
+        return logging.Formatter.formatTime(self, record, datefmt)
+
+
+def main(iterations=100000):
+    logger = logs.StructuredLogger('bench')
+    record = logger.makeRecord(
+        'talisker.wsgi', logging.INFO, 'fn', 1, 'GET /api/v1/things', (),
+        None, extra={'status': 200, 'duration_ms': 12.3})
+    record.created = time.time()
+    uncached = UncachedFormatter()
+    cached = logs.StructuredFormatter()
+    assert uncached.format(record) == cached.format(record)
+
+    results = {}
+    for name, fmt in (('uncached', uncached), ('cached', cached)):
+        t = timeit.timeit(lambda: fmt.format(record), number=iterations)
+        results[name] = t
+        print('{:10} {:8.2f}us per log line'.format(
+            name, t / iterations * 1e6))
+    speedup = results['uncached'] / results['cached']
+    print('speedup    {:8.2f}x'.format(speedup))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
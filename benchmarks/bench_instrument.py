@@ -0,0 +1,69 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+"""Benchmark the overhead of talisker.instrument per call.
+
+Times a trivial function bare, decorated, and wrapped in the context
+manager, within a request context, so includes tracking, metrics and the
+sentry breadcrumb.
+
+Usage: python benchmarks/bench_instrument.py [iterations]
+"""
+
+import sys
+import timeit
+
+import talisker
+import talisker.sentry  # noqa
+from talisker import Context
+
+
+def call():
+    return 1
+
+
+instrumented = talisker.instrument('bench')(call)
+
+
+def managed():
+    with talisker.instrument('bench', 'managed'):
+        return call()
+
+
+def main(iterations=100000):
+    Context.new()
+    bare = timeit.timeit(call, number=iterations)
+    print('{:20} {:8.2f}us per call'.format('bare', bare / iterations * 1e6))
+    funcs = [('decorator', instrumented), ('context manager', managed)]
+    for name, func in funcs:
+        t = timeit.timeit(func, number=iterations)
+        print('{:20} {:8.2f}us per call, {:.2f}us overhead'.format(
+            name, t / iterations * 1e6, (t - bare) / iterations * 1e6))
+        # don't let the breadcrumbs pile up between runs
+        Context.new()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
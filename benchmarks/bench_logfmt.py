@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Benchmark the standard and fast logfmt encoders.
+
+Usage: python benchmarks/bench_logfmt.py [iterations]
+"""
+
+from collections import OrderedDict
+import sys
+import timeit
+
+from talisker import logs
+
+
+def access_log_extra():
+    """Typical structured data from a TaliskerWSGIRequest access log."""
+    extra = OrderedDict()
+    extra['method'] = 'GET'
+    extra['path'] = '/api/v1/snaps/details/some-snap'
+    extra['qs'] = 'fields=revision,version&channel=stable'
+    extra['status'] = 200
+    extra['view'] = 'api.views.snap_details'
+    extra['duration_ms'] = 23.456
+    extra['ip'] = '10.0.0.1'
+    extra['proto'] = 'HTTP/1.1'
+    extra['length'] = 4523
+    extra['referrer'] = 'https://example.com/some/page'
+    extra['forwarded'] = '1.2.3.4, 10.0.0.1'
+    extra['ua'] = 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101'
+    extra['sql_count'] = 4
+    extra['sql_time_ms'] = 12.3
+    extra['request_id'] = 'a4e3c2d1-1234-4321-abcd-0123456789ab'
+    return extra
+
+
+def main(iterations=20000):
+    extra = access_log_extra()
+    standard = logs.StructuredFormatter()
+    fast = logs.StructuredFormatter(encoder='fast')
+    assert standard.logfmt(extra) == fast.logfmt(extra)
+
+    results = {}
+    for name, fmt in (('standard', standard), ('fast', fast)):
+        t = timeit.timeit(lambda: fmt.logfmt(extra), number=iterations)
+        results[name] = t
+        print('{:10} {:8.2f}us per log line'.format(
+            name, t / iterations * 1e6))
+    print('speedup    {:8.2f}x'.format(results['standard'] / results['fast']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
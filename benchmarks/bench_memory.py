@@ -0,0 +1,101 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+"""Benchmark the memory allocated to handle each WSGI request.
+
+Reports the size of the per-request ContextData and TaliskerWSGIRequest
+objects, and the peak memory allocated while handling a simple request
+through the talisker middleware.
+
+Usage: python benchmarks/bench_memory.py [iterations]
+"""
+
+import logging
+import sys
+import tracemalloc
+from wsgiref.util import setup_testing_defaults
+
+import talisker.sentry  # noqa
+from talisker.context import Context, ContextData
+from talisker.wsgi import TaliskerWSGIRequest, wrap
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def app(environ, start_response):
+    Context.track('sql', 1.0)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'OK']
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def request():
+    environ = {'REMOTE_ADDR': '127.0.0.1'}
+    setup_testing_defaults(environ)
+    middleware = request.middleware
+    for _ in middleware(environ, start_response):
+        pass
+    Context.clear()
+
+
+def main(iterations=1000):
+    logging.getLogger().addHandler(logging.NullHandler())
+    request.middleware = wrap(app)
+
+    context = ContextData('id')
+    context.metric_api_name = 'api'
+    context.metric_host_name = 'host'
+    wsgi_request = TaliskerWSGIRequest({}, start_response, {})
+    print('{:20} {:6} bytes'.format('ContextData', instance_size(context)))
+    print('{:20} {:6} bytes'.format(
+        'TaliskerWSGIRequest', instance_size(wsgi_request)))
+
+    # warm up caches before measuring
+    for _ in range(10):
+        request()
+
+    tracemalloc.start()
+    total = 0
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        request()
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - current
+    tracemalloc.stop()
+    print('{:20} {:6} bytes peak per request'.format(
+        'request', total // iterations))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,86 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+"""Benchmark iterating a streamed response with many small chunks.
+
+Compares iterating TaliskerWSGIRequest, which passes chunks through after
+the first, with calling __next__ for every chunk, as it used to.
+
+Usage: python benchmarks/bench_response.py [chunks]
+"""
+
+import logging
+import sys
+import time
+import timeit
+from wsgiref.util import setup_testing_defaults
+
+import talisker.sentry  # noqa
+from talisker.context import Context
+from talisker.wsgi import TaliskerWSGIRequest
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def make_request(chunks):
+    Context.new()
+    environ = {'REMOTE_ADDR': '127.0.0.1', 'REQUEST_ID': 'id'}
+    setup_testing_defaults(environ)
+    environ['start_time'] = time.time()
+    request = TaliskerWSGIRequest(environ, start_response, {})
+    request.start_response('200 OK', [])
+    return request.wrap_response([b'x' * 10] * chunks)
+
+
+def per_chunk(chunks):
+    request = make_request(chunks)
+    while True:
+        try:
+            next(request)
+        except StopIteration:
+            break
+
+
+def passthrough(chunks):
+    for _ in make_request(chunks):
+        pass
+
+
+def main(chunks=10000, iterations=20):
+    logging.getLogger().addHandler(logging.NullHandler())
+    results = {}
+    for func in (per_chunk, passthrough):
+        t = timeit.timeit(lambda: func(chunks), number=iterations)
+        results[func] = t
+        print('{:12} {:8.3f}us per chunk'.format(
+            func.__name__, t / iterations / chunks * 1e6))
+    print('speedup      {:8.2f}x'.format(
+        results[per_chunk] / results[passthrough]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
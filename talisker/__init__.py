@@ -41,6 +41,7 @@ from talisker.context import (  # NOQA
     DeadlineExceeded,
     request_timeout,
 )
+from talisker.instrumentation import instrument  # NOQA
 
 __version__ = '0.22.0'
 __all__ = [
@@ -49,6 +50,7 @@ __all__ = [
     'Context',
     'DeadlineExceeded',
     'request_timeout',
+    'instrument',
 ]
 prometheus_multiproc_cleanup = False
 
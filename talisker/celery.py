@@ -169,6 +169,7 @@ def task_prerun(sender, task_id, task, **kwargs):
     rid = get_header(task.request, REQUEST_ID)
     if rid is not None:
         Context.request_id = rid
+    talisker.logs.start_debug_buffer(talisker.get_config().debug_buffer_size)
 
     start_time = get_header(task.request, ENQUEUE_START)
     if start_time is not None:
@@ -209,6 +210,8 @@ def task_postrun(sender, task_id, task, **kwargs):
     if hasattr(task, 'talisker_timestamp'):
         send_run_metric(sender.name, task.talisker_timestamp)
         del task.talisker_timestamp
+    if kwargs.get('state') == 'FAILURE' or Context.debug:
+        talisker.logs.flush_debug_buffer()
     talisker.clear_context()
 
 
@@ -116,12 +116,31 @@ class Config():
         'DEVEL': False,
         'TALISKER_COLOUR': False,
         'TALISKER_LOGSTATUS': False,
+        'TALISKER_SERVER_TIMING': False,
+        'TALISKER_DEADLINE_INCLUDES_QUEUE': False,
+        'TALISKER_MAX_CONCURRENCY': 0,
+        'TALISKER_ADAPTIVE_CONCURRENCY': 0,
+        'TALISKER_MIN_DEADLINE_BUDGET': -1,
         'TALISKER_SLOWQUERY_THRESHOLD': -1,
+        'TALISKER_SLOWCALL_THRESHOLD': -1,
         'TALISKER_SOFT_REQUEST_TIMEOUT': -1,
         'TALISKER_NETWORKS': [],
         'TALISKER_ID_HEADER': 'X-Request-Id',
+        'TALISKER_REQUEST_ID_FORMAT': 'uuid4',
         'TALISKER_DEADLINE_HEADER': 'X-Request-Deadline',
         'TALISKER_EXPLAIN_SQL': False,
+        'TALISKER_LOG_FORMAT': 'logfmt',
+        'TALISKER_LOGFMT_ENCODER': 'standard',
+        'TALISKER_LOG_QUEUE_SIZE': 0,
+        'TALISKER_DEBUG_BUFFER_SIZE': 0,
+        'TALISKER_LOG_DEDUP': {},
+        'TALISKER_LOG_RING_BUFFER_SIZE': 0,
+        'TALISKER_REQUESTS_SNAPSHOT_SIZE': 0,
+        'TALISKER_LOG_DEDUP_WINDOW': 60,
+        'TALISKER_ACCESS_LOG_SAMPLING': [],
+        'TALISKER_ACCESS_LOG_SAMPLING_THRESHOLD': -1,
+        'TALISKER_DEBUGLOG_SEGMENT_SIZE': 64 * 1024 * 1024,
+        'TALISKER_DEBUGLOG_MAX_SIZE': 512 * 1024 * 1024,
     }
 
     Metadata = collections.namedtuple(
@@ -236,8 +255,10 @@ class Config():
         """Path to write debug level logs to, which is enabled if path is
         writable.
 
-        Debug logs are rotated every 24h to limit size, with only a single
-        24 hour archive is kept.
+        Debug logs are rotated every 24h, or sooner if they reach
+        TALISKER_DEBUGLOG_SEGMENT_SIZE. Rotated logs are compressed, and are
+        removed after 24 hours, or earlier if needed to keep the total size
+        under TALISKER_DEBUGLOG_MAX_SIZE.
         """
         log = self[raw_name]
         if log is None:
@@ -245,6 +266,138 @@ class Config():
         else:
             return str(log)
 
+    @config_property('TALISKER_DEBUGLOG_SEGMENT_SIZE')
+    def debuglog_segment_size(self, raw_name):
+        """Size in bytes at which the DEBUGLOG file is rotated. Defaults to
+        64MB.
+        """
+        size = force_int(self[raw_name])
+        if size <= 0:
+            raise Exception('{} is not a valid size'.format(size))
+        return size
+
+    @config_property('TALISKER_DEBUGLOG_MAX_SIZE')
+    def debuglog_max_size(self, raw_name):
+        """Maximum size in bytes on disk of the DEBUGLOG file and its
+        compressed rotated segments. The oldest segments are removed to stay
+        under this limit. Defaults to 512MB.
+        """
+        size = force_int(self[raw_name])
+        if size <= 0:
+            raise Exception('{} is not a valid size'.format(size))
+        return size
+
+    @config_property('TALISKER_LOG_FORMAT')
+    def log_format(self, raw_name):
+        """Format of the logs written to stderr. Can be 'logfmt' (the
+        default), or 'json'.
+
+        The 'json' format writes one JSON object per line, with the same
+        fields that talisker's logstash filter extracts from the logfmt
+        format, so they can be ingested without any parsing.
+        """
+        log_format = str(self[raw_name]).lower()
+        if log_format not in ('logfmt', 'json'):
+            raise Exception(
+                '{} is not a valid log format'.format(log_format)
+            )
+        return log_format
+
+    @config_property('TALISKER_LOGFMT_ENCODER')
+    def logfmt_encoder(self, raw_name):
+        """Which implementation to use to encode logfmt tags in log lines.
+        Can be 'standard' (the default) or 'fast'. Has no effect on the json
+        log format.
+
+        The 'fast' encoder produces identical output, but is optimised for
+        high log volumes, e.g. access logs on busy services.
+        """
+        encoder = str(self[raw_name]).lower()
+        if encoder not in ('standard', 'fast'):
+            raise Exception(
+                '{} is not a valid logfmt encoder'.format(encoder)
+            )
+        return encoder
+
+    @config_property('TALISKER_LOG_QUEUE_SIZE')
+    def log_queue_size(self, raw_name):
+        """Number of log records to buffer in memory, so that formatting and
+        writing logs happens on a background thread. Defaults to 0 (off).
+
+        This stops a slow log consumer from blocking requests. If the buffer
+        fills up, DEBUG records are dropped first, then INFO and WARNING.
+        ERROR records are never dropped. Dropped records are counted in the
+        logs_dropped metric.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_DEBUG_BUFFER_SIZE')
+    def debug_buffer_size(self, raw_name):
+        """Number of unemitted DEBUG log records to keep for each request or
+        celery task. Defaults to 0 (off).
+
+        The records are only written to the log, and attached to the sentry
+        report, if the request errors, hits its soft timeout, or is being
+        debugged with X-Debug. Otherwise, they are discarded when the request
+        finishes. This gives you debug logs for failed requests, without the
+        cost of DEBUG logging for every request.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_LOG_DEDUP')
+    def log_dedup(self, raw_name):
+        """Collapse repeated log messages. Space separated list of
+        logger=limit rules, e.g. 'talisker.requests=5 root=100'.
+
+        Records with the same logger, level and message template are counted
+        over TALISKER_LOG_DEDUP_WINDOW. Once a logger's limit is reached,
+        further records are dropped until the window ends. The next such
+        record logged includes a repeated field with the number dropped.
+
+        Rules apply to the named logger and its children, and 'root' applies
+        to all loggers. Defaults to no rules (off).
+        """
+        limits = {}
+        for token in (self[raw_name] or '').split():
+            name, sep, limit = token.rpartition('=')
+            if (not sep or not name or not limit.isdigit()
+                    or int(limit) < 1):
+                raise Exception(
+                    '{} is not a valid log dedup rule'.format(token))
+            limits[name] = int(limit)
+        return limits
+
+    @config_property('TALISKER_LOG_DEDUP_WINDOW')
+    def log_dedup_window(self, raw_name):
+        """The window, in seconds, over which TALISKER_LOG_DEDUP counts
+        repeated messages. Defaults to 60.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_LOG_RING_BUFFER_SIZE')
+    def log_ring_buffer_size(self, raw_name):
+        """Size in bytes of an in-memory buffer of recent log lines for each
+        process. Defaults to 0 (off).
+
+        The buffers are stored in the prometheus multiprocess directory, so
+        this requires multiple gunicorn workers or prometheus_multiproc_dir
+        to be set. The recent logs of all workers can then be viewed at
+        /_status/info/logs.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_REQUESTS_SNAPSHOT_SIZE')
+    def requests_snapshot_size(self, raw_name):
+        """Size in bytes of a snapshot of in-flight requests published by
+        each worker every second. Defaults to 0 (off).
+
+        Like TALISKER_LOG_RING_BUFFER_SIZE, this requires the prometheus
+        multiprocess directory. The in-flight requests of all workers can then
+        be viewed at /_status/info/requests. Otherwise, that endpoint only
+        shows the requests of the worker that serves it.
+        """
+        return force_int(self[raw_name])
+
     @config_property('TALISKER_SLOWQUERY_THRESHOLD')
     def slowquery_threshold(self, raw_name):
         """Set the threshold (in ms) over which SQL queries will be logged.
@@ -256,6 +409,14 @@ class Config():
         """
         return force_int(self[raw_name])
 
+    @config_property('TALISKER_SLOWCALL_THRESHOLD')
+    def slowcall_threshold(self, raw_name):
+        """Set the threshold (in ms) over which calls timed with
+        talisker.instrument will be logged. Defaults to -1 (off). It can be
+        overridden for each instrumented call.
+        """
+        return force_int(self[raw_name])
+
     @config_property('TALISKER_EXPLAIN_SQL')
     def explain_sql(self, raw_name):
         """Include EXPLAIN plans in sql sentry breadcrumbs. Defaults to false.
@@ -294,6 +455,49 @@ class Config():
             return None
         return force_int(value)
 
+    @config_property('TALISKER_DEADLINE_INCLUDES_QUEUE')
+    def deadline_includes_queue(self, raw_name):
+        """Count the time a request spent queued, as reported by the
+        X-Request-Start or X-Queue-Start header, against the
+        TALISKER_REQUEST_TIMEOUT deadline. Defaults to false.
+        """
+        return self.is_active(raw_name)
+
+    @config_property('TALISKER_MAX_CONCURRENCY')
+    def max_concurrency(self, raw_name):
+        """Maximum number of requests each worker will handle at once. Further
+        requests are rejected with a 503 and a Retry-After header. Defaults to
+        0 (no limit).
+
+        This is only useful with threaded or async workers. Requests to the
+        /_status endpoints are never rejected.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_ADAPTIVE_CONCURRENCY')
+    def adaptive_concurrency(self, raw_name):
+        """Enable an adaptive per-worker concurrency limit, never higher than
+        this value. Defaults to 0 (off).
+
+        The limit starts at this value, and is lowered when most requests
+        take well over their view's usual latency, and raised slowly again
+        while latency stays low. Requests over the limit are rejected with a
+        503 and a Retry-After header. Requests to the /_status endpoints are
+        never rejected.
+        """
+        return force_int(self[raw_name])
+
+    @config_property('TALISKER_MIN_DEADLINE_BUDGET')
+    def min_deadline_budget(self, raw_name):
+        """Reject requests with less than this many ms left before their
+        deadline with a 503 and a Retry-After header, rather than start work
+        that will not finish in time. Defaults to -1 (off). Setting to 0 only
+        rejects requests whose deadline has already passed.
+
+        Requests to the /_status endpoints are never rejected.
+        """
+        return force_int(self[raw_name])
+
     @config_property('TALISKER_LOGSTATUS')
     def logstatus(self, raw_name):
         """Sets whether http requests to /_status/ endpoints are logged in
@@ -303,6 +507,52 @@ class Config():
         default."""
         return self.is_active(raw_name)
 
+    @config_property('TALISKER_SERVER_TIMING')
+    def server_timing(self, raw_name):
+        """Add a Server-Timing header to responses, with the time spent in the
+        app before calling start_response, and in each tracked type of
+        request (e.g. sql, http). Defaults to false.
+
+        This exposes internal timings to clients, so is best used when there
+        is a trusted proxy in front of the service that can strip it.
+        """
+        return self.is_active(raw_name)
+
+    @config_property('TALISKER_ACCESS_LOG_SAMPLING')
+    def access_log_sampling(self, raw_name):
+        """Sample successful requests in the access log. Space separated
+        list of pattern=rate rules, e.g. 'api.views.*=0.01 /static/*=0'.
+
+        Each pattern is matched against the request's view name, if known,
+        and its path, using shell-style wildcards. The first matching rule
+        sets the rate, between 0 (never log) and 1 (always log). Requests
+        that match no rule are always logged.
+
+        Error responses and timeouts are always logged, as are requests over
+        TALISKER_ACCESS_LOG_SAMPLING_THRESHOLD. Sampled log lines include a
+        sampled_rate field, so counts can be re-weighted. Request metrics
+        always count every request.
+        """
+        rules = []
+        for token in (self[raw_name] or '').split():
+            pattern, sep, rate = token.rpartition('=')
+            try:
+                rate = float(rate)
+            except ValueError:
+                rate = None
+            if not sep or not pattern or rate is None or not 0 <= rate <= 1:
+                raise Exception(
+                    '{} is not a valid sampling rule'.format(token))
+            rules.append((pattern, rate))
+        return rules
+
+    @config_property('TALISKER_ACCESS_LOG_SAMPLING_THRESHOLD')
+    def access_log_sampling_threshold(self, raw_name):
+        """Requests slower than this threshold (in ms) are always logged,
+        regardless of TALISKER_ACCESS_LOG_SAMPLING. Defaults to -1 (off).
+        """
+        return force_int(self[raw_name])
+
     @config_property('TALISKER_NETWORKS')
     def networks(self, raw_name):
         """Sets additional CIDR networks that are allowed to access restricted
@@ -384,6 +634,22 @@ class Config():
         """Header containing request id. Defaults to X-Request-Id."""
         return self[raw_name]
 
+    @config_property('TALISKER_REQUEST_ID_FORMAT')
+    def request_id_format(self, raw_name):
+        """How to generate ids for requests that do not have one. Can be
+        'uuid4' (the default) or 'sequential'.
+
+        'sequential' ids are cheaper to generate: a random per-worker prefix
+        followed by a counter. They are still unique, and are ordered by time
+        within each worker.
+        """
+        id_format = str(self[raw_name]).lower()
+        if id_format not in ('uuid4', 'sequential'):
+            raise Exception(
+                '{} is not a valid request id format'.format(id_format)
+            )
+        return id_format
+
     @config_property('TALISKER_DEADLINE_HEADER')
     def deadline_header(self, raw_name):
         """Header for request deadline. Defaults to X-Request-Deadline."""
@@ -31,9 +31,11 @@ from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 import contextvars
 import functools
+import heapq
+import itertools
 import sys
 import time
-import uuid
+import weakref
 
 from talisker.util import early_log, pkg_is_installed
 
@@ -41,10 +43,20 @@ from talisker.util import early_log, pkg_is_installed
 __all__ = ['Context']
 
 
-# Global storage for contexts by id. We use a process global, so that we can
+# Global registry of contexts by id. We use a process global, so that we can
 # provide best effort logging of outstanding requests when a process is killed,
-# e.g. worker killed by master whilst having inflight requests
-CONTEXT_MAP = {}
+# e.g. worker killed by master whilst having inflight requests. The context
+# itself is stored in the CurrentContext contextvar, so this only holds weak
+# references, and is bounded in size.
+CONTEXT_MAP = weakref.WeakValueDictionary()
+CONTEXT_IDS = itertools.count(1)
+MAX_CONTEXTS = 10000
+
+# contexts older than this many seconds are evicted from the registry, set
+# from the gunicorn worker timeout
+REAPER_TIMEOUT = None
+REAPER_INTERVAL = 10
+REAPER_STATE = {'last_run': 0}
 
 
 # enable asyncio aware contextvars in 3.5.3+/3.6
@@ -64,7 +76,9 @@ if pkg_is_installed('aiocontextvars'):
             )
         )
 
-ContextId = contextvars.ContextVar('talisker')
+CurrentContext = contextvars.ContextVar('talisker')
+# b/w compat alias, it now holds the ContextData rather than its id
+ContextId = CurrentContext
 CONTEXT_OBJ = contextvars
 CONTEXT_ATTR = '_state'
 
@@ -103,13 +117,13 @@ def enable_gevent_context():
 
     _patch_gevent_contextvars()
 
-    global ContextId
-    orig = ContextId
-    ContextId = gevent.contextvars.ContextVar('talisker')
+    global CurrentContext, ContextId
+    orig = CurrentContext
+    CurrentContext = ContextId = gevent.contextvars.ContextVar('talisker')
 
     def undo():
-        global ContextId
-        ContextId = orig
+        global CurrentContext, ContextId
+        CurrentContext = ContextId = orig
 
     return undo
 
@@ -121,6 +135,92 @@ def enable_eventlet_context():
     return setattr_undo(CONTEXT_OBJ, CONTEXT_ATTR, eventlet.corolocal.local())
 
 
+def create_child_context(request_id=None, logging=None, deadline=None,
+                         soft_timeout=-1, debug=False):
+    """Create a context for work done on behalf of another context."""
+    ctx = create_context()
+    ctx.request_id = request_id
+    if logging:
+        ctx.logging.push(logging)
+    ctx.deadline = deadline
+    ctx.soft_timeout = soft_timeout
+    ctx.debug = debug
+    return ctx
+
+
+def capture_context(ctx):
+    """Return the arguments to create_child_context() for a child of ctx."""
+    return {
+        'request_id': ctx.request_id,
+        'logging': dict(ctx.logging.flat),
+        'deadline': ctx.deadline,
+        'soft_timeout': ctx.soft_timeout,
+        'debug': ctx.debug,
+    }
+
+
+def finish_child_context(parent, ctx):
+    """Add ctx's tracking to its parent, and remove it from the registry."""
+    for name, tracker in list(ctx.tracking.items()):
+        parent.tracking[name].merge(tracker)
+    delete_context(ctx.id)
+
+
+def wrap_task_factory(factory=None):
+    """Return an asyncio task factory that runs tasks in a child context.
+
+    Tasks created while in a talisker context run in a child of it, so that
+    their logging context changes do not affect the parent, and their
+    tracking is added to the parent when they finish. The tasks themselves
+    are created by factory, or asyncio.Task if None.
+    """
+    def create_task(loop, coro, **kwargs):
+        if factory is None:
+            import asyncio
+            return asyncio.Task(coro, loop=loop, **kwargs)
+        return factory(loop, coro, **kwargs)
+
+    def task_factory(loop, coro, **kwargs):
+        parent = CurrentContext.get(None)
+        # an explicit contextvars context is the caller's to manage
+        if parent is None or kwargs.get('context') is not None:
+            return create_task(loop, coro, **kwargs)
+        # the child is created now, not when the task first runs
+        ctx = create_child_context(**capture_context(parent))
+        task_context = contextvars.copy_context()
+        task_context.run(CurrentContext.set, ctx)
+        # tasks copy the current contextvars context when created
+        task = task_context.run(create_task, loop, coro, **kwargs)
+        task.add_done_callback(
+            lambda task: finish_child_context(parent, ctx))
+        return task
+
+    task_factory._talisker = True
+    return task_factory
+
+
+asyncio_task_factory = wrap_task_factory()
+
+
+def enable_asyncio_context(loop=None):
+    """Run tasks created on loop in a child of their creator's context.
+
+    Any task factory already installed on the loop is still used to create
+    the tasks.
+    """
+    import asyncio
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    orig = loop.get_task_factory()
+    if not getattr(orig, '_talisker', False):
+        loop.set_task_factory(wrap_task_factory(orig))
+
+    def undo():
+        loop.set_task_factory(orig)
+
+    return undo
+
+
 class DeadlineExceeded(Exception):
     """A network request has exceeded the deadline."""
 
@@ -132,9 +232,16 @@ class ContextStack(Mapping):
     Can also be used as a context manager.
 
     """
+    __slots__ = ('stack', '_flats', '_empty')
+
     def __init__(self, *dicts):
-        self.stack = list(dicts)
-        self._flat = None
+        self.stack = []
+        # the flattened dict at each level of the stack, so that pop and
+        # unwind can restore the previous one rather than rebuild it
+        self._flats = []
+        self._empty = OrderedDict()
+        for d in dicts:
+            self.push(d)
 
     def __eq__(self, other):
         return (
@@ -144,19 +251,12 @@ class ContextStack(Mapping):
 
     @property
     def flat(self):
-        """Cached flattened dict"""
-        if self._flat is None:
-            self._flat = OrderedDict(self._iterate())
-        return self._flat
+        """Flattened dict, from top to bottom.
 
-    def _iterate(self):
-        """Iterate from top to bottom, preserving individual dict ordering."""
-        seen = set()
-        for d in reversed(self.stack):
-            for k, v in d.items():
-                if k not in seen:
-                    yield k, v
-            seen = seen.union(d)
+        It is replaced rather than modified when the stack changes, so it is
+        safe to keep a reference to it.
+        """
+        return self._flats[-1] if self._flats else self._empty
 
     def push(self, _dict=None, **kwargs):
         """Add a new dict to the stack.
@@ -171,22 +271,26 @@ class ContextStack(Mapping):
         else:
             d = _dict.copy()
         d.update(kwargs)
+        # new keys go first, then the existing keys in their current order
+        flat = OrderedDict(d)
+        flat.update(self.flat)
+        flat.update(d)
         level = len(self.stack)
         self.stack.append(d)
-        self._flat = None
+        self._flats.append(flat)
         return level
 
     def pop(self):
         """Pop the most recent dict from the stack"""
         if self.stack:
             self.stack.pop()
-        self._flat = None
+            self._flats.pop()
 
     def unwind(self, level):
         """Unwind the stack to a specific level."""
-        while len(self.stack) > level:
-            self.stack.pop()
-        self._flat = None
+        if len(self.stack) > level:
+            del self.stack[level:]
+            del self._flats[level:]
 
     @contextmanager
     def __call__(self, extra=None, **kwargs):
@@ -235,6 +339,7 @@ class NullContextStack(ContextStack):
     def __init__(self, *dicts):
         super().__init__()
         self.stack = NullList()
+        self._flats = NullList()
 
     @contextmanager
     def __call__(self, extra=None, **kwargs):
@@ -244,15 +349,95 @@ class NullContextStack(ContextStack):
         yield self
 
 
+# how many of the slowest calls each Tracker keeps
+TRACKER_SLOWEST = 3
+
+_tracking_histogram = None
+
+
+def get_tracking_histogram():
+    # created lazily, as talisker.context is imported before metrics can be
+    global _tracking_histogram
+    if _tracking_histogram is None:
+        import talisker.metrics
+        _tracking_histogram = talisker.metrics.Histogram(
+            name='tracking_latency',
+            documentation='Duration of tracked calls, e.g. SQL and HTTP',
+            labelnames=['type'],
+            buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096],
+        )
+    return _tracking_histogram
+
+
 class Tracker():
+    """Summary of the calls of one type tracked in a context.
+
+    This is a fixed size, however many calls are tracked. As well as the
+    count and total time, it keeps the min, the max, and the slowest few
+    calls, with their labels, as a min-heap of (duration, label).
+    """
+
+    __slots__ = ('count', 'time', 'min', 'max', 'slowest')
+
     def __init__(self):
         self.count = 0
         self.time = 0.0
+        self.min = None
+        self.max = None
+        self.slowest = []
+
+    def add(self, duration, label=None):
+        self.count += 1
+        self.time += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        self.keep((duration, label or ''))
+
+    def keep(self, entry):
+        if len(self.slowest) < TRACKER_SLOWEST:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        """Add another Tracker's calls to this one."""
+        self.count += other.count
+        self.time += other.time
+        if other.min is not None:
+            if self.min is None or other.min < self.min:
+                self.min = other.min
+        if other.max is not None:
+            if self.max is None or other.max > self.max:
+                self.max = other.max
+        for entry in other.slowest:
+            self.keep(entry)
+
+    def top(self):
+        """The slowest calls as (duration, label), slowest first."""
+        return sorted(self.slowest, reverse=True)
 
 
 class ContextData():
     """Talisker specific context data."""
 
+    __slots__ = (
+        'id',
+        'start_time',
+        'request_id',
+        'logging',
+        'tracking',
+        'soft_timeout',
+        'deadline',
+        'debug',
+        'debug_buffer',
+        # set by talisker.requests for the duration of a request
+        'metric_api_name',
+        'metric_host_name',
+        '__weakref__',
+    )
+
     def __init__(self, context_id):
         self.id = context_id
         self.start_time = time.time()
@@ -262,6 +447,9 @@ class ContextData():
         self.soft_timeout = -1
         self.deadline = None
         self.debug = False
+        self.debug_buffer = None
+        self.metric_api_name = None
+        self.metric_host_name = None
 
 
 # The Null context is when there is no explicit context set.
@@ -273,18 +461,33 @@ NULL_CONTEXT.logging = NullContextStack()
 
 def get_context(context_id=None):
     if context_id is None:
-        context_id = ContextId.get(None)
+        ctx = CurrentContext.get(None)
+        return NULL_CONTEXT if ctx is None else ctx
     return CONTEXT_MAP.get(context_id, NULL_CONTEXT)
 
 
 def create_context(context_id=None):
     if context_id is None:
-        context_id = str(uuid.uuid4())
-    elif context_id in CONTEXT_MAP:
-        return CONTEXT_MAP[context_id]
+        # only needs to be unique within this process
+        context_id = str(next(CONTEXT_IDS))
+    else:
+        ctx = CONTEXT_MAP.get(context_id)
+        if ctx is not None:
+            return ctx
 
     ctx = ContextData(context_id)
-    CONTEXT_MAP[context_id] = ctx
+    now = ctx.start_time
+    if now - REAPER_STATE['last_run'] >= REAPER_INTERVAL:
+        try:
+            reap_contexts(now)
+        except Exception:
+            # reaping is housekeeping, it must never fail a request
+            import logging
+            logging.getLogger('talisker.context').exception(
+                'failed to reap stale contexts')
+    # if full, the context still works, but is not tracked
+    if len(CONTEXT_MAP) < MAX_CONTEXTS:
+        CONTEXT_MAP[context_id] = ctx
     return ctx
 
 
@@ -292,6 +495,48 @@ def delete_context(context_id):
     return CONTEXT_MAP.pop(context_id, None)
 
 
+def set_reaper_timeout(timeout):
+    """Evict contexts older than timeout seconds from the registry."""
+    global REAPER_TIMEOUT
+    REAPER_TIMEOUT = timeout
+
+
+def reap_contexts(now=None):
+    """Log and evict contexts that have outlived REAPER_TIMEOUT.
+
+    These are contexts that were never cleared, e.g. from a thread that
+    died mid request. Returns the number evicted.
+    """
+    if now is None:
+        now = time.time()
+    REAPER_STATE['last_run'] = now
+    if REAPER_TIMEOUT is None:
+        return 0
+
+    # other threads add and remove contexts while we look, so take a single
+    # C level copy of the underlying dict rather than iterating the
+    # WeakValueDictionary itself
+    refs = list(CONTEXT_MAP.data.values())
+    stale = []
+    for ref in refs:
+        ctx = ref()
+        if ctx is not None and now - ctx.start_time > REAPER_TIMEOUT:
+            stale.append(ctx)
+    if stale:
+        import logging
+        logger = logging.getLogger('talisker.context')
+        for ctx in stale:
+            CONTEXT_MAP.pop(ctx.id, None)
+            logger.warning(
+                'evicting stale context',
+                extra={
+                    'request_id': ctx.request_id,
+                    'age': round(now - ctx.start_time, 3),
+                },
+            )
+    return len(stale)
+
+
 def warn_null_context(api, extra):
     import logging
     logging.getLogger('talisker.context').warning(
@@ -306,14 +551,15 @@ class ContextAPI():
 
     def current(self):
         """Get the current context."""
-        return get_context()
+        ctx = CurrentContext.get(None)
+        return NULL_CONTEXT if ctx is None else ctx
 
     def clear(self):
         """Remove current context."""
-        current_id = ContextId.get(None)
-        if current_id is not None:
-            delete_context(current_id)
-            ContextId.set(None)
+        ctx = CurrentContext.get(None)
+        if ctx is not None:
+            delete_context(ctx.id)
+            CurrentContext.set(None)
 
     def new(self):
         """Clear current context and explicitly create new one.
@@ -323,7 +569,7 @@ class ContextAPI():
         """
         self.clear()
         ctx = create_context()
-        ContextId.set(ctx.id)
+        CurrentContext.set(ctx)
         return ctx
 
     @property
@@ -384,7 +630,21 @@ class ContextAPI():
 
         return timeout
 
-    def track(self, _type, duration):
+    def deadline_scope(self, timeout=None):
+        """Async context manager that cancels the task at the deadline.
+
+        If the deadline passes before the block finishes, the task is
+        cancelled, and DeadlineExceeded is raised from the block. An optional
+        timeout in ms tightens the deadline inside the block, which then runs
+        in a child context.
+        """
+        return DeadlineScope(self, timeout)
+
+    def track(self, _type, duration, label=None):
+        """Track a call of _type taking duration ms.
+
+        The label identifies the call, if it is one of the slowest.
+        """
         current = self.current()
         if current is NULL_CONTEXT:
             warn_null_context(
@@ -392,13 +652,83 @@ class ContextAPI():
                 {'type': _type, 'duration': duration},
             )
         else:
-            current.tracking[_type].count += 1
-            current.tracking[_type].time += duration
+            current.tracking[_type].add(duration, label)
+        get_tracking_histogram().observe(duration, type=_type)
 
 
 Context = ContextAPI()
 
 
+class DeadlineScope():
+    """Cancel the current asyncio task when the context deadline passes.
+
+    A tighter deadline from timeout applies to a child context, current only
+    inside the block. The current context may be shared with other tasks, so
+    is never modified.
+    """
+
+    def __init__(self, api, timeout=None):
+        self.api = api
+        self.timeout = timeout
+        self.task = None
+        self.handle = None
+        self.parent = None
+        self.child = None
+        self.token = None
+        self.expired = False
+
+    async def __aenter__(self):
+        import asyncio
+        current = self.api.current()
+        deadline = current.deadline
+        if self.timeout is not None and current is not NULL_CONTEXT:
+            timeout = time.time() + self.timeout / 1000
+            if deadline is None or timeout < deadline:
+                deadline = timeout
+                kwargs = capture_context(current)
+                kwargs['deadline'] = deadline
+                self.parent = current
+                self.child = create_child_context(**kwargs)
+                self.token = CurrentContext.set(self.child)
+
+        if deadline is None:
+            return self
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            self.restore()
+            raise DeadlineExceeded()
+
+        if hasattr(asyncio, 'current_task'):
+            self.task = asyncio.current_task()
+        else:
+            self.task = asyncio.Task.current_task()
+        self.handle = asyncio.get_event_loop().call_later(
+            remaining, self.expire)
+        return self
+
+    def expire(self):
+        self.expired = True
+        self.task.cancel()
+
+    def restore(self):
+        if self.child is not None:
+            CurrentContext.reset(self.token)
+            finish_child_context(self.parent, self.child)
+            self.child = self.parent = self.token = None
+
+    async def __aexit__(self, exc_type, exc, tb):
+        import asyncio
+        if self.handle is not None:
+            self.handle.cancel()
+        self.restore()
+        if self.expired and exc_type is asyncio.CancelledError:
+            # the cancellation was ours, so don't leave it pending
+            if hasattr(self.task, 'uncancel'):
+                self.task.uncancel()
+            raise DeadlineExceeded() from exc
+        return False
+
+
 class request_timeout():
     def __init__(self, timeout=None, soft_timeout=None):
         self.timeout = timeout
@@ -75,4 +75,12 @@ def middleware(get_response):
             response['X-View-Name'] = view_name
             request.environ['VIEW_NAME'] = view_name
         return response
+
+    def process_view(request, view_func, view_args, view_kwargs):
+        # set before the view runs, for /_status/info/requests
+        if getattr(request, 'resolver_match', None):
+            request.environ['VIEW_NAME'] = request.resolver_match.view_name
+        return None
+
+    add_view_name.process_view = process_view
     return add_view_name
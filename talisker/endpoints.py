@@ -28,6 +28,7 @@ import functools
 import logging
 import os
 import sys
+import time
 
 try:
     from collections import Iterable
@@ -131,6 +132,8 @@ class StandardEndpointMiddleware(object):
         ('/info/workers', None),
         ('/info/logtree', None),
         ('/info/objgraph', None),
+        ('/info/logs', 'logs'),
+        ('/info/requests', 'requests'),
         ('/test/sentry', 'error'),
         ('/test/statsd', 'test_statsd'),
         ('/test/prometheus', None),
@@ -379,6 +382,71 @@ class StandardEndpointMiddleware(object):
             Table(clean_environ, id='process_env'),
         )
 
+    @private
+    def logs(self, request):
+        """Recent log lines from all workers, if the log buffer is enabled."""
+        import talisker.logbuffer
+        directory = os.environ.get('prometheus_multiproc_dir')
+        if not directory or not talisker.get_config().log_ring_buffer_size:
+            return Response('Not Enabled', status=404)
+        try:
+            limit = int(request.args.get('limit', 1000))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return Response('Invalid limit', status=400)
+        lines = talisker.logbuffer.read_logs(directory, limit)
+        body = ''.join('[{}] {}\n'.format(pid, line) for _, pid, line in lines)
+        return Response(body, mimetype='text/plain')
+
+    @private
+    def requests(self, request):
+        """In-flight requests of all workers, oldest first."""
+        import talisker.inflight
+        import talisker.wsgi
+        directory = os.environ.get('prometheus_multiproc_dir')
+        now = time.time()
+        if directory and talisker.get_config().requests_snapshot_size:
+            snapshots = talisker.inflight.read_snapshots(directory)
+        else:
+            # just this worker, live
+            live = talisker.inflight.describe_requests(talisker.wsgi.REQUESTS)
+            snapshots = [(str(os.getpid()), now, live)]
+
+        rows = []
+        for pid, timestamp, requests in snapshots:
+            for r in requests:
+                deadline = r['deadline']
+                rows.append([
+                    pid,
+                    r['id'],
+                    r['method'],
+                    r['path'],
+                    r['view'] or '',
+                    int((now - r['start']) * 1000) if r['start'] else '',
+                    '' if deadline is None else int((deadline - now) * 1000),
+                    ' '.join(
+                        '{}={}'.format(k, v)
+                        for k, v in sorted(r['tracking'].items())
+                    ),
+                    int((now - timestamp) * 1000),
+                ])
+        rows.sort(key=lambda r: r[5] or 0, reverse=True)
+
+        return info_response(
+            request.environ,
+            'Requests',
+            Content('In-flight Requests', 'h2'),
+            Table(
+                rows,
+                headers=[
+                    'PID', 'Request Id', 'Method', 'Path', 'View', 'Age (ms)',
+                    'Deadline (ms)', 'Tracking', 'Snapshot Age (ms)',
+                ],
+                id='requests',
+            ),
+        )
+
     @private
     def objgraph(self, request):
         import objgraph
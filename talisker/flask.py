@@ -79,8 +79,7 @@ else:
         return sentry
 
 
-def add_view_name(response):
-
+def get_view_name():
     name = flask.request.endpoint
 
     if name is not None and flask.current_app:
@@ -91,6 +90,20 @@ def add_view_name(response):
         except Exception:
             pass
 
+    return name
+
+
+def set_view_name():
+    # set before the view runs, for /_status/info/requests
+    name = get_view_name()
+    if name is not None:
+        flask.request.environ['VIEW_NAME'] = name
+
+
+def add_view_name(response):
+
+    name = get_view_name()
+
     if name is None:
         # this is not a critical error, so just debug log it.
         logging.getLogger(__name__).debug('no flask view for {}'.format(
@@ -105,6 +118,7 @@ def add_view_name(response):
 
 def setup(app):
     sentry(app)
+    app.before_request(set_view_name)
     app.after_request(add_view_name)
 
 
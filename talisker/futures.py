@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Executors that run tasks in a child of the submitting request's context.
+
+Tasks get the request id, logging extras, deadline and debug flag of the
+context they were submitted from, and any Context.track() calls they make are
+added to that context when they finish, so they show up in the request's
+access log and metrics. Tasks still waiting to run when the deadline passes
+raise DeadlineExceeded without running.
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import contextvars
+import threading
+import time
+
+import talisker.context
+from talisker.context import (
+    Context,
+    DeadlineExceeded,
+    NULL_CONTEXT,
+    create_child_context,
+    delete_context,
+)
+
+
+__all__ = [
+    'TaliskerProcessPoolExecutor',
+    'TaliskerThreadPoolExecutor',
+]
+
+_merge_lock = threading.Lock()
+
+
+def capture_context():
+    """Return the state of the current context to pass to a task, or None."""
+    ctx = Context.current()
+    if ctx is NULL_CONTEXT:
+        return None
+    return talisker.context.capture_context(ctx)
+
+
+def tracking_totals(ctx):
+    """Return a context's tracking as a picklable {type: Tracker}."""
+    return dict(ctx.tracking)
+
+
+def merge_tracking(ctx, totals):
+    with _merge_lock:
+        for name, tracker in totals.items():
+            ctx.tracking[name].merge(tracker)
+
+
+def run_task(state, fn, args, kwargs):
+    """Run fn in a new child context, returning (context, result)."""
+    ctx = create_child_context(**state)
+    talisker.context.CurrentContext.set(ctx)
+    try:
+        if ctx.deadline is not None and ctx.deadline <= time.time():
+            raise DeadlineExceeded()
+        return ctx, fn(*args, **kwargs)
+    except BaseException as e:
+        e.talisker_context = ctx
+        raise
+    finally:
+        delete_context(ctx.id)
+
+
+class TaliskerThreadPoolExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor that propagates the talisker context to tasks.
+
+    The whole contextvars context is copied, so other context variables are
+    also available to tasks.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        parent = Context.current()
+        state = capture_context()
+        if state is None:
+            return super().submit(fn, *args, **kwargs)
+        context = contextvars.copy_context()
+        return super().submit(
+            context.run, self.run_task, parent, state, fn, args, kwargs)
+
+    @staticmethod
+    def run_task(parent, state, fn, args, kwargs):
+        try:
+            ctx, result = run_task(state, fn, args, kwargs)
+        except BaseException as e:
+            ctx = e.__dict__.pop('talisker_context', None)
+            if ctx is not None:
+                merge_tracking(parent, tracking_totals(ctx))
+            raise
+        merge_tracking(parent, tracking_totals(ctx))
+        return result
+
+
+def run_process_task(state, fn, args, kwargs):
+    """Run fn in a child process, returning (tracking, result).
+
+    The tracking is attached to any exception, so the parent can still merge
+    it.
+    """
+    try:
+        ctx, result = run_task(state, fn, args, kwargs)
+    except BaseException as e:
+        ctx = e.__dict__.pop('talisker_context', None)
+        if ctx is not None:
+            e.talisker_tracking = tracking_totals(ctx)
+        raise
+    finally:
+        talisker.context.CurrentContext.set(None)
+    return tracking_totals(ctx), result
+
+
+class ChainedFuture(Future):
+    """A Future for the result of another, cancelled with it."""
+
+    def __init__(self, inner):
+        super().__init__()
+        self.inner = inner
+
+    def cancel(self):
+        return self.inner.cancel()
+
+
+class TaliskerProcessPoolExecutor(ProcessPoolExecutor):
+    """A ProcessPoolExecutor that propagates the talisker context to tasks.
+
+    Only the talisker context is sent, so it and the task must be picklable,
+    as usual.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        parent = Context.current()
+        state = capture_context()
+        if state is None:
+            return super().submit(fn, *args, **kwargs)
+        inner = super().submit(run_process_task, state, fn, args, kwargs)
+        outer = ChainedFuture(inner)
+
+        def done(future):
+            if future.cancelled():
+                Future.cancel(outer)
+                outer.set_running_or_notify_cancel()
+                return
+            outer.set_running_or_notify_cancel()
+            exc = future.exception()
+            if exc is not None:
+                tracking = exc.__dict__.pop('talisker_tracking', None)
+                if tracking:
+                    merge_tracking(parent, tracking)
+                outer.set_exception(exc)
+            else:
+                tracking, result = future.result()
+                merge_tracking(parent, tracking)
+                outer.set_result(result)
+
+        inner.add_done_callback(done)
+        return outer
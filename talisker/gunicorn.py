@@ -24,12 +24,16 @@
 
 from collections import deque
 import logging
+import os
 import sys
 
 from gunicorn.glogging import Logger
 from gunicorn.app.wsgiapp import WSGIApplication
 
 import talisker
+import talisker.context
+import talisker.inflight
+import talisker.logbuffer
 import talisker.logs
 import talisker.sentry
 import talisker.statsd
@@ -72,6 +76,10 @@ def handle_custom():
             pid = DEAD_WORKERS.popleft()
             logger.info('cleaning up prometheus metrics', extra={'pid': pid})
             prometheus_cleanup_worker(pid)
+            talisker.logbuffer.cleanup_worker(
+                os.environ['prometheus_multiproc_dir'], pid)
+            talisker.inflight.cleanup_worker(
+                os.environ['prometheus_multiproc_dir'], pid)
         except Exception:
             # we should never fail at cleaning up
             logger.exception(
@@ -134,6 +142,9 @@ def gunicorn_worker_exit(server, worker):
             request.exc_info = sys.exc_info()
             request.finish_request(timeout=True)
 
+    # ensure any queued logs are written before we exit
+    talisker.logs.flush_log_queue()
+
 
 class GunicornLogger(Logger):
     """Custom gunicorn logger to undo gunicorns error log config."""
@@ -218,6 +229,9 @@ class TaliskerApplication(WSGIApplication):
             self.cfg.set('statsd_prefix', None)
 
         # trust but warn
+        # contexts older than this belong to requests gunicorn has given up on
+        talisker.context.set_reaper_timeout(self.cfg.timeout)
+
         if self.cfg.logger_class is not GunicornLogger:
             logger.warning(
                 'using custom gunicorn logger class - this may break '
@@ -0,0 +1,253 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+"""Snapshots of in-flight requests, shared via mmap.
+
+Each worker periodically publishes a compact description of the requests it
+is currently handling to its own file in the prometheus multiprocess
+directory, so that /_status/info/requests can show the in-flight requests of
+all workers, even ones too busy to answer themselves.
+
+File format: a header (magic, version, capacity, sequence, length,
+timestamp), followed by capacity bytes holding a JSON list of requests. The
+sequence is odd while a snapshot is being written, so readers can detect and
+retry torn reads.
+"""
+
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from talisker.util import is_status_path
+
+
+__all__ = [
+    'RequestSnapshot',
+    'describe_requests',
+    'read_snapshots',
+    'start_publisher',
+]
+
+MAGIC = b'TLRQ'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQId')
+FILENAME = 'requests_{}.snap'
+PUBLISH_INTERVAL = 1.0
+READ_RETRIES = 5
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_path(directory, pid):
+    return os.path.join(directory, FILENAME.format(pid))
+
+
+def describe_requests(requests):
+    """Return a list of dicts describing the given in-flight requests.
+
+    Called from the publisher thread, so copies any shared containers before
+    iterating them.
+    """
+    rows = []
+    for request in list(requests.values()):
+        environ = request.environ
+        path = environ.get('PATH_INFO', '')
+        # the status endpoints are not interesting here
+        if is_status_path(path):
+            continue
+        ctx = request.context
+        tracking = dict(ctx.tracking) if ctx is not None else {}
+        rows.append({
+            'id': environ.get('REQUEST_ID'),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': path,
+            'view': (
+                environ.get('VIEW_NAME')
+                or request.response_header('x-view-name')
+            ),
+            'start': environ.get('start_time'),
+            'deadline': None if ctx is None else ctx.deadline,
+            'tracking': {k: v.count for k, v in tracking.items()},
+        })
+    rows.sort(key=lambda r: r['start'] or 0)
+    return rows
+
+
+class RequestSnapshot():
+    """A fixed size, mmap backed snapshot of a worker's in-flight requests.
+
+    Not thread safe: only the publisher thread writes to it.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        with open(path, 'w+b') as f:
+            f.truncate(HEADER.size + capacity)
+            self.mmap = mmap.mmap(f.fileno(), HEADER.size + capacity)
+        self.sequence = 0
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, capacity, 0, 0, 0.0)
+
+    def encode(self, rows):
+        data = json.dumps(rows, separators=(',', ':')).encode('utf8')
+        # drop the newest requests until it fits, the oldest are the most
+        # interesting in an incident
+        while len(data) > self.capacity and rows:
+            rows = rows[:-1]
+            data = json.dumps(rows, separators=(',', ':')).encode('utf8')
+        return data
+
+    def write(self, timestamp, rows):
+        data = self.encode(rows)
+        self.sequence += 1
+        HEADER.pack_into(
+            self.mmap, 0, MAGIC, VERSION, self.capacity, self.sequence, 0, 0.0)
+        self.mmap[HEADER.size:HEADER.size + len(data)] = data
+        self.sequence += 1
+        HEADER.pack_into(
+            self.mmap, 0, MAGIC, VERSION, self.capacity, self.sequence,
+            len(data), timestamp,
+        )
+
+    def close(self):
+        self.mmap.close()
+
+
+def read_snapshot(path):
+    """Read a snapshot file, returning (timestamp, rows), or None.
+
+    This is safe to call while another process is writing to the snapshot.
+    """
+    for _ in range(READ_RETRIES):
+        with open(path, 'rb') as f:
+            data = f.read()
+            f.seek(0)
+            header = f.read(HEADER.size)
+
+        if len(data) < HEADER.size or len(header) < HEADER.size:
+            return None
+        magic, version, capacity, sequence, length, timestamp = (
+            HEADER.unpack_from(data))
+        if magic != MAGIC or version != VERSION:
+            return None
+        if sequence % 2 or header != data[:HEADER.size]:
+            # mid-write
+            continue
+        if sequence == 0:
+            return None
+        body = data[HEADER.size:HEADER.size + length]
+        return timestamp, json.loads(body.decode('utf8'))
+    return None
+
+
+def read_snapshots(directory):
+    """Read all the request snapshots in directory.
+
+    Returns a list of (pid, timestamp, rows), ordered by pid.
+    """
+    snapshots = []
+    pattern = os.path.join(directory, FILENAME.format('*'))
+    for path in glob.glob(pattern):
+        name = os.path.basename(path)
+        pid = name[len('requests_'):-len('.snap')]
+        try:
+            snapshot = read_snapshot(path)
+        except Exception:
+            logger.exception(
+                'failed to read request snapshot', extra={'path': path})
+            continue
+        if snapshot is not None:
+            snapshots.append((pid, snapshot[0], snapshot[1]))
+    snapshots.sort(key=lambda s: int(s[0]) if s[0].isdigit() else 0)
+    return snapshots
+
+
+class SnapshotPublisher():
+    """Publish this process's in-flight requests from a background thread."""
+
+    def __init__(self, directory, capacity, requests):
+        self.directory = directory
+        self.capacity = capacity
+        self.requests = requests
+        self.snapshot = None
+        self.thread = None
+        self.pid = None
+        self.published = False
+
+    def start(self):
+        """Start publishing, and restart after a fork."""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        if self.snapshot is not None:
+            # only unmaps it in this process
+            self.snapshot.close()
+        self.pid = pid
+        self.snapshot = RequestSnapshot(
+            snapshot_path(self.directory, pid), self.capacity)
+        self.published = False
+        self.thread = threading.Thread(
+            target=self.run, name='talisker-request-snapshots')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, now=None):
+        rows = describe_requests(self.requests)
+        # nothing has changed if we were and are still idle
+        if rows or self.published:
+            if now is None:
+                now = time.time()
+            self.snapshot.write(now, rows)
+            self.published = bool(rows)
+
+    def run(self):
+        while True:
+            time.sleep(PUBLISH_INTERVAL)
+            try:
+                self.publish()
+            except Exception:
+                logger.exception('failed to publish request snapshot')
+
+
+_publisher = None
+
+
+def start_publisher(directory, capacity, requests):
+    global _publisher
+    if _publisher is None:
+        _publisher = SnapshotPublisher(directory, capacity, requests)
+    _publisher.start()
+
+
+def cleanup_worker(directory, pid):
+    """Remove a dead worker's snapshot, its requests are no longer running."""
+    path = snapshot_path(directory, pid)
+    if os.path.exists(path):
+        os.unlink(path)
@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import functools
+import logging
+import time
+
+import talisker
+from talisker.context import (
+    NULL_CONTEXT,
+    Context,
+    get_tracking_histogram,
+)
+
+
+__all__ = ['instrument']
+
+_record_breadcrumb = None
+
+
+def get_record_breadcrumb():
+    # talisker.sentry is not imported until needed, so that importing
+    # talisker stays cheap
+    global _record_breadcrumb
+    if _record_breadcrumb is None:
+        from talisker.sentry import record_breadcrumb
+        _record_breadcrumb = record_breadcrumb
+    return _record_breadcrumb
+
+
+class instrument():
+    """Time calls to a dependency, such as redis or LDAP.
+
+    Each call is tracked in the current context as _type, so it shows up in
+    the access log and the tracking_latency histogram, recorded as a sentry
+    breadcrumb, and logged if slower than threshold ms (defaults to
+    TALISKER_SLOWCALL_THRESHOLD).
+
+    Use as a decorator, where call defaults to the function name::
+
+        @talisker.instrument('redis')
+        def get(key):
+            ...
+
+    Or as a context manager, where call names the operation, and label
+    identifies the particular call, so can vary::
+
+        with talisker.instrument('ldap', 'search', label=dn):
+            ...
+
+    A context manager instance should only be used once at a time.
+    """
+
+    def __init__(self, _type, call=None, label=None, threshold=None):
+        self.type = _type
+        self.call = call
+        self.label = label
+        self.threshold = threshold
+        self.start = None
+
+    def __call__(self, func):
+        call = self.call or func.__name__
+        label = self.label or call
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.record(call, label, start, e)
+                raise
+            self.record(call, label, start)
+            return result
+
+        return wrapper
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        call = self.call or 'unknown'
+        self.record(call, self.label or call, self.start, exc)
+
+    def record(self, call, label, start, exc=None):
+        duration = round((time.time() - start) * 1000, 3)
+        if Context.current() is NULL_CONTEXT:
+            # outside a request there is nothing to track against, and
+            # Context.track would warn on every call
+            get_tracking_histogram().observe(duration, type=self.type)
+        else:
+            # also observes the tracking_latency histogram
+            Context.track(self.type, duration, label)
+
+        data = {'duration_ms': duration, 'call': call}
+        if label != call:
+            data['label'] = label
+        if exc is not None:
+            data['error'] = type(exc).__name__
+        get_record_breadcrumb()(message=call, category=self.type, data=data)
+
+        threshold = self.threshold
+        if threshold is None:
+            threshold = talisker.get_config().slowcall_threshold
+        if threshold >= 0 and duration > threshold:
+            # not at import time, as this is imported before talisker's
+            # logger class is set
+            logging.getLogger(__name__).info(
+                'slow {} call'.format(self.type), extra=data)
@@ -0,0 +1,243 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Fixed size ring buffers of recent log lines, shared via mmap.
+
+Each process writes its formatted log lines to its own file in the
+prometheus multiprocess directory, so that /_status/info/logs can show the
+recent logs of all workers.
+
+File format: a header (magic, version, capacity, position), followed by
+capacity bytes of circular data. Position is the total bytes ever written.
+Each entry is (length, timestamp), data, length. The trailing length means
+readers can walk backwards from the current position, newest first, until
+they reach data that has been overwritten.
+"""
+
+from collections import deque
+import glob
+import heapq
+import logging
+import mmap
+import os
+import struct
+
+
+__all__ = [
+    'LogRingBuffer',
+    'RingBufferHandler',
+    'read_logs',
+]
+
+MAGIC = b'TLRB'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+POSITION = struct.Struct('<Q')
+POSITION_OFFSET = 16
+ENTRY_HEADER = struct.Struct('<Id')
+ENTRY_TRAILER = struct.Struct('<I')
+ENTRY_OVERHEAD = ENTRY_HEADER.size + ENTRY_TRAILER.size
+FILENAME = 'logs_{}.ring'
+# how many dead workers' buffers to keep around for debugging
+KEEP_DEAD_WORKERS = 2
+
+
+def buffer_path(directory, pid):
+    return os.path.join(directory, FILENAME.format(pid))
+
+
+class LogRingBuffer():
+    """A fixed size, mmap backed ring buffer of timestamped log lines.
+
+    Not thread safe: callers must serialise writes. RingBufferHandler does
+    this with the standard handler lock.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        # an entry can be at most a quarter of the buffer
+        self.max_entry = capacity // 4 - ENTRY_OVERHEAD
+        with open(path, 'w+b') as f:
+            f.truncate(HEADER.size + capacity)
+            self.mmap = mmap.mmap(f.fileno(), HEADER.size + capacity)
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, capacity, 0)
+        self.position = 0
+        # preallocated, to avoid allocating for each entry's header
+        self.scratch = memoryview(bytearray(ENTRY_HEADER.size))
+
+    def put(self, offset, data):
+        """Write data at logical offset, wrapping around if needed."""
+        start = offset % self.capacity
+        first = min(len(data), self.capacity - start)
+        start += HEADER.size
+        self.mmap[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self.mmap[HEADER.size:HEADER.size + rest] = data[first:]
+
+    def write(self, timestamp, data):
+        if len(data) > self.max_entry:
+            data = data[:self.max_entry]
+        size = len(data)
+        position = self.position
+        ENTRY_HEADER.pack_into(self.scratch, 0, size, timestamp)
+        self.put(position, self.scratch)
+        self.put(position + ENTRY_HEADER.size, memoryview(data))
+        ENTRY_TRAILER.pack_into(self.scratch, 0, size)
+        self.put(
+            position + ENTRY_HEADER.size + size,
+            self.scratch[:ENTRY_TRAILER.size],
+        )
+        # only publish the entry once it is fully written
+        self.position = position + size + ENTRY_OVERHEAD
+        POSITION.pack_into(self.mmap, POSITION_OFFSET, self.position)
+
+    def close(self):
+        self.mmap.close()
+
+
+def read_buffer(path):
+    """Read the entries of a ring buffer file, as (timestamp, bytes) tuples.
+
+    This is safe to call while another process is writing to the buffer.
+    Entries that may have been overwritten while reading are skipped.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+        f.seek(0)
+        header = f.read(HEADER.size)
+
+    if len(data) < HEADER.size or len(header) < HEADER.size:
+        return []
+    magic, version, capacity, position = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return []
+    if len(data) < HEADER.size + capacity:
+        return []
+    _, _, _, latest = HEADER.unpack(header)
+    lower = max(0, latest - capacity)
+    buf = data[HEADER.size:HEADER.size + capacity]
+
+    def get(offset, size):
+        start = offset % capacity
+        chunk = buf[start:start + size]
+        if len(chunk) < size:
+            chunk += buf[:size - len(chunk)]
+        return chunk
+
+    entries = []
+    end = position
+    while end - ENTRY_OVERHEAD >= lower:
+        size, = ENTRY_TRAILER.unpack(
+            get(end - ENTRY_TRAILER.size, ENTRY_TRAILER.size))
+        start = end - size - ENTRY_OVERHEAD
+        if start < lower:
+            break
+        header_size, timestamp = ENTRY_HEADER.unpack(
+            get(start, ENTRY_HEADER.size))
+        if header_size != size:
+            # partially overwritten, so we are done
+            break
+        entries.append((timestamp, get(start + ENTRY_HEADER.size, size)))
+        end = start
+
+    entries.reverse()
+    return entries
+
+
+def read_logs(directory, limit=None):
+    """Read all the log buffers in directory, merged by timestamp.
+
+    Returns a list of (timestamp, pid, line), oldest first, limited to the
+    most recent limit lines.
+    """
+    streams = []
+    pattern = os.path.join(directory, FILENAME.format('*'))
+    for path in glob.glob(pattern):
+        name = os.path.basename(path)
+        pid = name[len('logs_'):-len('.ring')]
+        try:
+            entries = read_buffer(path)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'failed to read log buffer', extra={'path': path})
+            continue
+        streams.append([
+            (ts, pid, line.decode('utf8', 'replace')) for ts, line in entries
+        ])
+    lines = list(heapq.merge(*streams, key=lambda e: e[0]))
+    if limit is not None:
+        # lines[-0:] would be all of them
+        lines = lines[-limit:] if limit > 0 else []
+    return lines
+
+
+class RingBufferHandler(logging.Handler):
+    """Write formatted log records to a per-process ring buffer file."""
+
+    def __init__(self, directory, capacity):
+        super().__init__()
+        self.directory = directory
+        self.capacity = capacity
+        self.buffer = None
+        self.pid = None
+
+    def get_buffer(self):
+        """Get this process's buffer, creating a new one after a fork."""
+        pid = os.getpid()
+        if self.pid != pid:
+            if self.buffer is not None:
+                # only unmaps it in this process
+                self.buffer.close()
+            self.buffer = LogRingBuffer(
+                buffer_path(self.directory, pid), self.capacity)
+            self.pid = pid
+        return self.buffer
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            self.get_buffer().write(record.created, msg.encode('utf8'))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+            self.pid = None
+        super().close()
+
+
+_dead_workers = deque()
+
+
+def cleanup_worker(directory, pid):
+    """Remove old dead workers' buffers, keeping the most recent few."""
+    _dead_workers.append(pid)
+    while len(_dead_workers) > KEEP_DEAD_WORKERS:
+        path = buffer_path(directory, _dead_workers.popleft())
+        if os.path.exists(path):
+            os.unlink(path)
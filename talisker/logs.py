@@ -22,15 +22,27 @@
 # under the License.
 #
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+import copy
+import gzip
+import itertools
+import json
 import logging
 import logging.handlers
+import math
 import numbers
+import operator
+import os
+from queue import Queue
+import re
+import shutil
 import sys
+import threading
 import time
 
-from talisker.context import Context, ContextId
+from talisker.context import Context, NULL_CONTEXT
+from talisker.logbuffer import RingBufferHandler
 from talisker.util import (
     get_errno_fields,
     module_cache,
@@ -56,10 +68,18 @@ def set_global_extra(extra):
 
 def reset_logging():
     """Reset logging config"""
+    for dedup in get_dedup_filters():
+        dedup.close()
     # avoid unclosed file resource warning
     for handler in logging.getLogger().handlers:
-        if getattr(handler, '_debug_handler', False):
-            handler.stream.close()
+        if isinstance(handler, TaliskerQueueHandler):
+            handler.close()
+            targets = handler.targets
+        else:
+            targets = [handler]
+        for target in targets:
+            if isinstance(target, (DebugLogHandler, RingBufferHandler)):
+                target.close()
     logging.getLogger().handlers = []
 
 
@@ -90,13 +110,21 @@ def set_logging_context(*args, **kwargs):
 extra_logging = logging_context
 
 
-def add_talisker_handler(level, handler, formatter=None):
+def add_talisker_handler(level, handler, formatter=None, queue=None):
+    """Add a handler to the root logger.
+
+    If queue is supplied, the handler is added to that TaliskerQueueHandler
+    instead, and will be emitted to from its background thread.
+    """
     if formatter is None:
         formatter = StructuredFormatter()
     handler.setFormatter(formatter)
     handler.setLevel(level)
     handler._talisker_handler = True
-    logging.getLogger().addHandler(handler)
+    if queue is None:
+        logging.getLogger().addHandler(handler)
+    else:
+        queue.add_target(handler)
 
 
 def set_logger_class():
@@ -111,6 +139,33 @@ def get_talisker_handler():
     return handler
 
 
+def get_queue_handler():
+    """Return the root TaliskerQueueHandler, if queued logging is enabled."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, TaliskerQueueHandler):
+            return handler
+    return None
+
+
+def get_dedup_filters():
+    return [
+        f for handler in logging.getLogger().handlers
+        for f in handler.filters if isinstance(f, DedupFilter)
+    ]
+
+
+def flush_log_queue(timeout=5.0):
+    """Wait for any queued log records to be written.
+
+    Any pending repeated message summaries are written first.
+    """
+    for dedup in get_dedup_filters():
+        dedup.flush()
+    handler = get_queue_handler()
+    if handler is not None:
+        handler.flush(timeout)
+
+
 def configure(config):  # pragma: no cover
     """Configure default logging setup for our services.
 
@@ -125,12 +180,29 @@ def configure(config):  # pragma: no cover
         return
 
     set_logger_class()
-    formatter = StructuredFormatter()
-    if config.colour:
-        formatter = ColouredFormatter(style=config.colour)
+    encoder = config.logfmt_encoder
+    if config.log_format == 'json':
+        formatter = JSONFormatter()
+    elif config.colour:
+        formatter = ColouredFormatter(style=config.colour, encoder=encoder)
+    else:
+        formatter = StructuredFormatter(encoder=encoder)
+
+    # write logs from a background thread, if configured
+    queue = None
+    if config.log_queue_size > 0:
+        queue = TaliskerQueueHandler(config.log_queue_size)
+        logging.getLogger().addHandler(queue)
 
     # always INFO to stderr
-    add_talisker_handler(logging.INFO, get_talisker_handler(), formatter)
+    add_talisker_handler(
+        logging.INFO, get_talisker_handler(), formatter, queue=queue)
+
+    # collapse repeated messages before they are queued or written
+    dedup_handlers = []
+    if config.log_dedup:
+        dedup_handlers.append(
+            get_talisker_handler() if queue is None else queue)
 
     configure_warnings(config.devel)
     supress_noisy_logs()
@@ -146,30 +218,103 @@ def configure(config):  # pragma: no cover
 
     if config.debuglog is not None:
         if can_write_to_file(config.debuglog):
-            handler = logging.handlers.TimedRotatingFileHandler(
+            handler = DebugLogHandler(
                 config.debuglog,
-                when='D',
-                interval=1,
-                backupCount=1,
-                delay=True,
-                utc=True,
+                segment_size=config.debuglog_segment_size,
+                max_size=config.debuglog_max_size,
             )
-            handler._debug_handler = True
-            add_talisker_handler(logging.DEBUG, handler)
+            add_talisker_handler(logging.DEBUG, handler, queue=queue)
             logger.info('enabling debug log', extra={'path': config.debuglog})
         else:
             logger.info('could not enable debug log, could not write to path',
                         extra={'path': config.debuglog})
 
+    if config.log_ring_buffer_size > 0:
+        directory = os.environ.get('prometheus_multiproc_dir')
+        if directory:
+            handler = RingBufferHandler(
+                directory, config.log_ring_buffer_size)
+            if isinstance(formatter, ColouredFormatter):
+                ring_formatter = StructuredFormatter(encoder=encoder)
+            else:
+                ring_formatter = formatter
+            add_talisker_handler(
+                logging.INFO, handler, ring_formatter, queue=queue)
+            logger.info(
+                'enabled log ring buffer',
+                extra={'size': config.log_ring_buffer_size},
+            )
+        else:
+            logger.info(
+                'could not enable log ring buffer, no multiprocess directory')
+
     # sentry integration
     import talisker.sentry  # defer to avoid logging setup
     if talisker.sentry.enabled:
         sentry_handler = talisker.sentry.get_log_handler()
+        sentry_handler._sentry_handler = True
         add_talisker_handler(logging.ERROR, sentry_handler)
+        if config.log_dedup:
+            dedup_handlers.append(sentry_handler)
+
+    # each handler needs its own filter, or records would be counted twice
+    for handler in dedup_handlers:
+        handler.addFilter(DedupFilter(
+            config.log_dedup, config.log_dedup_window, handler=handler))
+
+    if queue is not None:
+        logger.info(
+            'enabled queued logging',
+            extra={'queue_size': config.log_queue_size},
+        )
 
     logging_globals['configured'] = True
 
 
+def start_debug_buffer(size):
+    """Keep up to size unemitted log records for the current context.
+
+    The records are discarded with the context, unless flush_debug_buffer()
+    is called.
+    """
+    context = Context.current()
+    if size > 0 and context is not NULL_CONTEXT:
+        context.debug_buffer = deque(maxlen=size)
+
+
+def flush_debug_buffer():
+    """Emit the current context's buffered records, regardless of level.
+
+    They are also recorded as sentry breadcrumbs, so they are included in any
+    subsequent sentry report. Returns the number of records flushed.
+    """
+    import talisker.sentry  # lazy to break import cycle
+    context = Context.current()
+    buffer = context.debug_buffer
+    if not buffer:
+        return 0
+    records = list(buffer)
+    buffer.clear()
+
+    handlers = []
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, TaliskerQueueHandler):
+            handlers.extend(handler.targets)
+        elif not getattr(handler, '_sentry_handler', False):
+            handlers.append(handler)
+
+    for record in records:
+        try:
+            record.message = record.getMessage()
+            talisker.sentry.record_log_breadcrumb(record)
+            record._breadcrumb_recorded = True
+        except Exception:
+            pass
+        for handler in handlers:
+            handler.handle(record)
+    return len(records)
+
+
 def can_write_to_file(path):
     try:
         open(path, 'a').close()
@@ -236,47 +381,23 @@ class StructuredLogger(logging.Logger):
     # through. Also, we need to support python 2.
     def makeRecord(self, name, level, fn, lno, msg, args, exc_info,
                    func=None, extra=None, sinfo=None):
-        # at this point we have 3 possible sources of extra kwargs
-        # - log call: extra
-        # - context : local_context.flat
-        # - global  : logging_globals['extra']
-        #
-        # In case of collisions, we append _ to the end of the name, so no data
-        # is lost. The global ones are more important, so take priority - the
-        # user supplied keys are the ones renamed if needed
-        # Also, the ordering is specific - more specific tags first
         trailer = None
-        structured = OrderedDict()
-
-        try:
-            if ContextId.get(None) is None:
-                context_extra = {}
-                request_id = None
-            else:
-                context_extra = logging_context.flat
-                request_id = Context.request_id
-
-            global_extra = logging_globals.get('extra', {})
-
-            if extra:
-                trailer = extra.pop('trailer', None)
-                for k, v in extra.items():
-                    if k in context_extra or k in global_extra:
-                        k = k + '_'
-                    structured[k] = v
-
-            for k, v in context_extra.items():
-                if k in global_extra:
-                    k = k + '_'
-                structured[k] = v
-
-            structured.update(global_extra)
-            if request_id:
-                structured['request_id'] = request_id
-        except Exception:
-            # ensure unexpected error doesn't break logging completely
-            structured = extra
-
+        if extra:
+            trailer = extra.pop('trailer', None)
+        context_extra, request_id, debug_buffer = get_context_extra()
+
+        if not self.will_emit(level):
+            # No handler will emit this record, so don't bother merging the
+            # structured data unless something explicitly asks for it.
+            record = DeferredExtraRecord(
+                name, level, fn, lno, msg, args, exc_info, func, sinfo)
+            record.defer(extra, context_extra, request_id)
+            record._trailer = trailer
+            if debug_buffer is not None:
+                debug_buffer.append(record)
+            return record
+
+        structured = merge_extra(extra, context_extra, request_id)
         kwargs = dict(func=func, extra=structured, sinfo=sinfo)
         # python 2 doesn't support sinfo parameter
         if sys.version_info[0] == 2:
@@ -289,6 +410,136 @@ class StructuredLogger(logging.Logger):
         record._trailer = trailer
         return record
 
+    def will_emit(self, level):
+        """Will any handler emit a record at this level?
+
+        Mirrors the handler lookup in logging.Logger.callHandlers, but does
+        not consider handler filters.
+        """
+        logger = self
+        found = False
+        while logger:
+            for handler in logger.handlers:
+                found = True
+                if level >= handler.level:
+                    return True
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        # with no handlers configured at all, logging falls back to
+        # logging.lastResort, so be conservative and merge as normal
+        return not found
+
+
+def get_context_extra():
+    """Get the current context's logging extra, request id and debug buffer.
+
+    The flattened extra is replaced rather than modified when the context
+    changes, so can be safely kept for later use.
+    """
+    try:
+        context = Context.current()
+        return context.logging.flat, context.request_id, context.debug_buffer
+    except Exception:
+        # ensure unexpected error doesn't break logging completely
+        return {}, None, None
+
+
+def merge_extra(extra, context_extra, request_id):
+    """Merge call, context and global extra into one structured dict."""
+    # at this point we have 3 possible sources of extra kwargs
+    # - log call: extra
+    # - context : local_context.flat
+    # - global  : logging_globals['extra']
+    #
+    # In case of collisions, we append _ to the end of the name, so no data
+    # is lost. The global ones are more important, so take priority - the
+    # user supplied keys are the ones renamed if needed
+    # Also, the ordering is specific - more specific tags first
+    structured = OrderedDict()
+
+    try:
+        global_extra = logging_globals.get('extra', {})
+
+        if extra:
+            for k, v in extra.items():
+                if k in context_extra or k in global_extra:
+                    k = k + '_'
+                structured[k] = v
+
+        for k, v in context_extra.items():
+            if k in global_extra:
+                k = k + '_'
+            structured[k] = v
+
+        structured.update(global_extra)
+        if request_id:
+            structured['request_id'] = request_id
+    except Exception:
+        # ensure unexpected error doesn't break logging completely
+        structured = extra
+
+    return structured
+
+
+class DeferredExtraRecord(logging.LogRecord):
+    """A LogRecord that only merges its structured extra when accessed.
+
+    StructuredLogger uses this for records that no handler will emit, which
+    is most DEBUG records in production, so the merge is usually skipped.
+    If a filter or handler does look at the extra, it is merged then, using
+    the context extra from when the record was logged.
+    """
+
+    def defer(self, extra, context_extra, request_id):
+        self.__dict__['_deferred'] = (extra, context_extra, request_id)
+        # call extra is cheap to add, and expected as attributes
+        if extra:
+            for k, v in extra.items():
+                self.__dict__.setdefault(k, v)
+
+    def _merge(self):
+        deferred = self.__dict__.pop('_deferred', None)
+        if deferred is not None:
+            structured = merge_extra(*deferred)
+            self.__dict__['_extra'] = structured
+            if structured:
+                for k, v in structured.items():
+                    self.__dict__.setdefault(k, v)
+        return self.__dict__.get('_extra')
+
+    @property
+    def extra(self):
+        return self._merge()
+
+    @extra.setter
+    def extra(self, value):
+        self.__dict__.pop('_deferred', None)
+        self.__dict__['_extra'] = value
+
+    _structured = extra  # b/w compat
+
+
+FORMAT_FIELD = re.compile(r'%\((\w+)\)')
+
+
+def compile_format(fmt):
+    """Precompile a %-style format into a positional format and a getter.
+
+    fmt % getter(record.__dict__) gives the same result as the original
+    format % record.__dict__, but avoids parsing each field name per record.
+    Returns None if the format cannot be compiled.
+    """
+    fields = FORMAT_FIELD.findall(fmt)
+    positional = FORMAT_FIELD.sub('%', fmt)
+    # any unnamed fields would consume our positional arguments
+    if not fields or positional.replace('%%', '').count('%') != len(fields):
+        return None
+    if len(fields) == 1:
+        field = fields[0]
+        return positional, lambda d: (d[field],)
+    return positional, operator.itemgetter(*fields)
+
 
 class StructuredFormatter(logging.Formatter):
     """Add additional structured data in logfmt style to formatted log.
@@ -313,12 +564,19 @@ class StructuredFormatter(logging.Formatter):
     # use utc time. No idea why this is not the default.
     converter = time.gmtime
 
-    def __init__(self, fmt=None, datefmt=None):
+    def __init__(self, fmt=None, datefmt=None, encoder=None):
         if fmt is None:
             fmt = self.FORMAT
         if datefmt is None:
             datefmt = self.DATEFMT
         super(StructuredFormatter, self).__init__(fmt, datefmt)
+        self.compiled_fmt = compile_format(self._fmt)
+        self.time_cache = threading.local()
+        self.encoder = None
+        if encoder is not None:
+            encoder_class = LOGFMT_ENCODERS[encoder]
+            if encoder_class is not None:
+                self.encoder = encoder_class(self)
 
     def format(self, record):
         """Format message with structured tags and any exception/trailer"""
@@ -328,7 +586,8 @@ class StructuredFormatter(logging.Formatter):
 
             # we never want sentry to capture DEBUG logs in its breadcrumbs, as
             # they may be sensitive
-            if record.levelno > logging.DEBUG:
+            if (record.levelno > logging.DEBUG
+                    and not getattr(record, '_breadcrumb_recorded', False)):
                 talisker.sentry.record_log_breadcrumb(record)
 
             if len(record.message) > self.MAX_MSG_SIZE:
@@ -339,7 +598,11 @@ class StructuredFormatter(logging.Formatter):
             # this is verbatim from the parent class in stdlib
             if self.usesTime():
                 record.asctime = self.formatTime(record, self.datefmt)
-            s = self._fmt % record.__dict__
+            if self.compiled_fmt is None:
+                s = self._fmt % record.__dict__
+            else:
+                fmt, getter = self.compiled_fmt
+                s = fmt % getter(record.__dict__)
 
             # add our structured tags *before* exception info is added
             structured = getattr(record, 'extra', {})
@@ -377,10 +640,28 @@ class StructuredFormatter(logging.Formatter):
             # ensure unexpected error doesn't break logging
             return super().format(record)
 
+    def formatTime(self, record, datefmt=None):
+        """Format the record time, caching it per second and thread.
+
+        Only cached with an explicit datefmt, as the default includes msecs.
+        """
+        if datefmt is None:
+            return super().formatTime(record, datefmt)
+        cache = self.time_cache
+        second = int(record.created)
+        if getattr(cache, 'key', None) == (second, datefmt):
+            return cache.value
+        value = super().formatTime(record, datefmt)
+        cache.key = (second, datefmt)
+        cache.value = value
+        return value
+
     def clean_message(self, s):
         return s.replace('"', '\\"').replace('\n', '\\n')
 
     def logfmt(self, structured):
+        if self.encoder is not None:
+            return self.encoder.encode(structured)
         formatted = (
             '{}={}'.format(k, v) for k, v in self.logfmt_atoms(structured))
         return " ".join(formatted)
@@ -510,6 +791,930 @@ class StructuredFormatter(logging.Formatter):
         return s
 
 
+class FastLogfmtEncoder():
+    """Optimised logfmt encoder for StructuredFormatter.
+
+    Produces identical output to StructuredFormatter.logfmt_atoms(), but
+    avoids most of the per key python overhead:
+
+     - normalised string keys are memoized in a bounded cache
+     - quoting is decided by precompiled character class tables, rather than
+       a char by char python loop
+     - values are encoded by exact type lookup, falling back to the
+       formatter's isinstance based methods for anything unusual
+
+    The formatter's MAX_* and TRUNCATED* attributes are read on each call, so
+    changing them on the formatter is still respected.
+    """
+
+    CACHE_SIZE = 4096
+    # any of these characters mean a value must be quoted
+    QUOTE_CHARS = re.compile(r'[ ="\\]')
+    # a value that looks like a number must be quoted, so it stays a string
+    NUMERIC = re.compile(r'[0-9]*\.?[0-9]*')
+    # characters that are not valid in a logfmt key
+    KEY_TABLE = str.maketrans(' .=', '___')
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.key_cache = {}
+        self.key_cache_params = None
+        self.value_encoders = {
+            str: self.encode_str,
+            bytes: self.encode_bytes,
+            bool: self.encode_bool,
+            int: self.encode_number,
+            float: self.encode_number,
+        }
+
+    def encode(self, structured):
+        """Encode a dict of structured data as a logfmt string."""
+        fmt = self.formatter
+        params = (fmt.MAX_KEY_SIZE, fmt.TRUNCATED_KEY)
+        if params != self.key_cache_params:
+            self.key_cache.clear()
+            self.key_cache_params = params
+        max_value = fmt.MAX_VALUE_SIZE
+        truncated = fmt.TRUNCATED
+
+        encode_key = self.encode_key
+        encoders = self.value_encoders
+        atoms = []
+        key_errors = []
+
+        for k, v in structured.items():
+            key = None
+            sub_atoms = None
+            try:
+                if v is not False and not v:
+                    continue
+
+                key = encode_key(k)
+                if key is None:
+                    key_errors.append(k)
+                elif isinstance(v, dict):
+                    sub_atoms = []
+                    for k2, v2 in v.items():
+                        subkey = encode_key(k2)
+                        if subkey is None:
+                            key_errors.append(k2)
+                        else:
+                            sub_atoms.append(
+                                key + '_' + subkey + '=' + self.encode_value(
+                                    v2, encoders, max_value, truncated)
+                            )
+                    atoms.extend(sub_atoms)
+                else:
+                    atoms.append(key + '=' + self.encode_value(
+                        v, encoders, max_value, truncated))
+            except Exception:
+                # mirror logfmt_atoms() error handling exactly
+                if key is None:
+                    key_errors.append(k)
+                else:
+                    if sub_atoms:
+                        atoms.extend(sub_atoms)
+                    atoms.append(key + '="???"')
+
+        if key_errors:
+            # we embed the keys in the message precisely because they
+            # couldn't be parsed as logfmt key
+            logger = logging.getLogger(__name__)
+            logger.warning('could not parse logfmt keys: ' + str(key_errors))
+
+        return ' '.join(atoms)
+
+    def encode_key(self, k):
+        if type(k) is not str:
+            return self.formatter.logfmt_key(k)
+        try:
+            return self.key_cache[k]
+        except KeyError:
+            pass
+
+        fmt = self.formatter
+        key = self.safe_string(
+            k.translate(self.KEY_TABLE),
+            fmt.MAX_KEY_SIZE,
+            fmt.TRUNCATED_KEY,
+        )
+        if len(self.key_cache) >= self.CACHE_SIZE:
+            self.key_cache.clear()
+        self.key_cache[k] = key
+        return key
+
+    def encode_value(self, v, encoders, max_value, truncated):
+        encoder = encoders.get(type(v))
+        if encoder is None:
+            return self.formatter.logfmt_value(v)
+        return encoder(v, max_value, truncated)
+
+    def encode_str(self, v, max_value, truncated):
+        v = self.safe_string(v, max_value, truncated)
+        if self.QUOTE_CHARS.search(v) or self.NUMERIC.fullmatch(v):
+            return '"' + v + '"'
+        return v
+
+    def encode_bytes(self, v, max_value, truncated):
+        return self.encode_str(v.decode('utf8'), max_value, truncated)
+
+    def encode_bool(self, v, max_value, truncated):
+        return 'true' if v else 'false'
+
+    def encode_number(self, v, max_value, truncated):
+        return str(v)
+
+    def safe_string(self, s, max, truncate_str):
+        s = s.strip()
+        truncated = False
+        if '\n' in s:
+            s = s.split('\n', 1)[0]
+            truncated = True
+        if len(s) > max:
+            s = s[:max]
+            truncated = True
+        if '"' in s:
+            s = s.replace('"', '\\"')
+        if truncated and truncate_str is not None:
+            s = s + truncate_str
+        return s
+
+
+# available logfmt encoders, by TALISKER_LOGFMT_ENCODER name
+LOGFMT_ENCODERS = {
+    'standard': None,
+    'fast': FastLogfmtEncoder,
+}
+
+
+class JSONFormatter(StructuredFormatter):
+    """Format log records as a single line JSON object.
+
+    The object has the same fields that talisker's logstash grok filter
+    extracts from the logfmt format, so it can be ingested directly:
+
+    {"timestamp": "2016-01-13 10:24:07.357Z", "loglevel": "INFO",
+     "module": "name", "logmsg": "my message", "foo": "data"}
+
+    Structured data follows the same rules as the logfmt format, including
+    truncation, with the exception that values are native JSON types and may
+    contain newlines. Any trailer and exception traceback are included in the
+    "traceback" field.
+    """
+
+    FIELDS = ('timestamp', 'loglevel', 'module', 'logmsg', 'traceback')
+
+    def format(self, record):
+        """Format record as JSON, serialising it in a single pass."""
+        import talisker.sentry  # lazy to break import cycle
+        try:
+            record.message = record.getMessage()
+            if (record.levelno > logging.DEBUG
+                    and not getattr(record, '_breadcrumb_recorded', False)):
+                talisker.sentry.record_log_breadcrumb(record)
+
+            msg = record.message
+            if len(msg) > self.MAX_MSG_SIZE:
+                msg = msg[:self.MAX_MSG_SIZE] + self.TRUNCATED
+
+            data = OrderedDict()
+            data['timestamp'] = '{}.{:03d}Z'.format(
+                self.formatTime(record, self.datefmt), int(record.msecs))
+            data['loglevel'] = record.levelname
+            data['module'] = record.name
+            data['logmsg'] = msg
+
+            structured = getattr(record, 'extra', {})
+            if record.exc_info and 'errno' not in structured:
+                structured.update(get_errno_fields(record.exc_info[1]))
+            if structured:
+                self.add_structured(data, structured)
+
+            traceback = []
+            trailer = getattr(record, '_trailer', None)
+            if trailer is not None:
+                traceback.append(str(trailer))
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                traceback.append(record.exc_text)
+            if traceback:
+                data['traceback'] = '\n'.join(traceback)
+
+            return json.dumps(data, ensure_ascii=False)
+        except Exception:
+            # ensure unexpected error doesn't break logging
+            return logging.Formatter.format(self, record)
+
+    def add_structured(self, data, structured):
+        """Add structured data, with the same rules as logfmt_atoms."""
+        key_errors = []
+        for k, v in structured.items():
+            key = None
+            try:
+                if v is not False and not v:
+                    continue
+
+                key = self.json_key(k)
+                if key is None:
+                    key_errors.append(k)
+                elif isinstance(v, dict):
+                    for k2, v2 in v.items():
+                        subkey = self.json_key(k2)
+                        if subkey is None:
+                            key_errors.append(k2)
+                        else:
+                            self.add_field(
+                                data, key + '_' + subkey, self.json_value(v2))
+                else:
+                    self.add_field(data, key, self.json_value(v))
+            except Exception:
+                if key is None:
+                    key_errors.append(k)
+                else:
+                    self.add_field(data, key, '???')
+
+        if key_errors:
+            logger = logging.getLogger(__name__)
+            logger.warning('could not parse logfmt keys: ' + str(key_errors))
+
+    def add_field(self, data, key, value):
+        # never overwrite the standard fields
+        while key in data:
+            key = key + '_'
+        data[key] = value
+
+    def json_key(self, k):
+        if isinstance(k, bytes):
+            k = k.decode('utf8')
+
+        if isinstance(k, str):
+            k = k.replace(' ', '_').replace('.', '_').replace('=', '_')
+            k = k.strip()
+            truncated = False
+            if '\n' in k:
+                k = k.split('\n', 1)[0]
+                truncated = True
+            return self.truncate(
+                k, self.MAX_KEY_SIZE, self.TRUNCATED_KEY, truncated)
+        elif isinstance(k, bool):
+            return None
+        elif isinstance(k, numbers.Number):
+            return str(k)
+        return None
+
+    def json_value(self, v):
+        if isinstance(v, bytes):
+            v = v.decode('utf8')
+        if isinstance(v, str):
+            return self.truncate(
+                v.strip(), self.MAX_VALUE_SIZE, self.TRUNCATED)
+        elif isinstance(v, bool):
+            return v
+        elif isinstance(v, (int, float)):
+            # NaN and Infinity are not valid JSON
+            return v if math.isfinite(v) else str(v)
+        elif isinstance(v, numbers.Number):
+            return str(v)
+        return str(type(v))
+
+    def truncate(self, s, max, truncate_str, truncated=False):
+        if len(s) > max:
+            s = s[:max]
+            truncated = True
+        if truncated:
+            s = s + truncate_str
+        return s
+
+
+class DedupFilter(logging.Filter):
+    """Collapse repeated log records.
+
+    Records with the same logger, level and message template are counted
+    within a time window. Once the logger's limit is reached, further records
+    are dropped until the window ends. The first record after that carries a
+    repeated field with the number that were dropped.
+
+    If no such record follows, the last dropped record is written to handler
+    with the repeated field once the window has ended, so a burst that stops
+    is still reported. This happens on the next record of any kind, from a
+    timer, or when flushed.
+
+    Limits are configured per logger name, and apply to child loggers too.
+    The 'root' limit applies to all loggers.
+    """
+
+    MAX_KEYS = 1000
+
+    def __init__(self, limits, window, handler=None):
+        super().__init__()
+        self.limits = limits
+        self.window = window
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.logger_limits = {}
+        # windows with dropped records, and when the first of them ends
+        self.pending = {}
+        self.expires = None
+        self.timer = None
+        self.timer_pid = None
+
+    def get_limit(self, name):
+        try:
+            return self.logger_limits[name]
+        except KeyError:
+            pass
+        limit = None
+        parts = name.split('.')
+        while parts and limit is None:
+            limit = self.limits.get('.'.join(parts))
+            parts.pop()
+        if limit is None:
+            limit = self.limits.get('root')
+        self.logger_limits[name] = limit
+        return limit
+
+    def filter(self, record):
+        if getattr(record, '_dedup_summary', False):
+            return True
+        limit = self.get_limit(record.name)
+        if limit is None:
+            return self.flush_expired(record.created)
+        try:
+            key = (record.name, record.levelno, record.msg)
+            hash(key)
+        except TypeError:
+            return self.flush_expired(record.created)
+
+        now = record.created
+        with self.lock:
+            state = self.windows.get(key)
+            if state is not None and now - state[0] < self.window:
+                state[1] += 1
+                if state[1] > limit:
+                    state[2] += 1
+                    state[3] = record
+                    self.add_pending(key, state)
+                    return False
+                summaries = self.pop_expired(now)
+                dropped = 0
+            else:
+                # new window: [start, records seen, records dropped, last
+                # dropped record]
+                self.pending.pop(key, None)
+                dropped = state[2] if state is not None else 0
+                if state is None and len(self.windows) >= self.MAX_KEYS:
+                    summaries = self.prune(now)
+                else:
+                    summaries = self.pop_expired(now)
+                self.windows[key] = [now, 1, 0, None]
+
+        if dropped:
+            extra = getattr(record, 'extra', None)
+            if extra is None:
+                extra = record.extra = OrderedDict()
+            extra['repeated'] = dropped
+        self.write(summaries)
+        return True
+
+    def add_pending(self, key, state):
+        if self.handler is None:
+            return
+        self.pending[key] = state
+        expires = state[0] + self.window
+        if self.expires is None or expires < self.expires:
+            self.expires = expires
+        self.start_timer()
+
+    def pop_expired(self, now, force=False):
+        """Remove and return the pending windows that have ended.
+
+        Must be called with the lock held.
+        """
+        if not self.pending or not (force or now >= self.expires):
+            return []
+        expired = []
+        self.expires = None
+        for key, state in list(self.pending.items()):
+            expires = state[0] + self.window
+            if force or now >= expires:
+                del self.pending[key]
+                expired.append((state[3], state[2]))
+                state[2] = 0
+                state[3] = None
+            elif self.expires is None or expires < self.expires:
+                self.expires = expires
+        return expired
+
+    def flush_expired(self, now):
+        if self.pending:
+            with self.lock:
+                summaries = self.pop_expired(now)
+            self.write(summaries)
+        return True
+
+    def write(self, summaries):
+        for record, dropped in summaries:
+            summary = copy.copy(record)
+            summary.extra = OrderedDict(getattr(record, 'extra', None) or ())
+            summary.extra['repeated'] = dropped
+            summary._dedup_summary = True
+            self.handler.handle(summary)
+
+    def start_timer(self):
+        """Ensure a timer will write the pending summaries.
+
+        Must be called with the lock held.
+        """
+        pid = os.getpid()
+        if self.timer is not None and self.timer_pid == pid:
+            return
+        delay = max(self.expires - time.time(), 0)
+        self.timer = threading.Timer(delay, self.on_timer)
+        self.timer.daemon = True
+        self.timer_pid = pid
+        self.timer.start()
+
+    def on_timer(self):
+        with self.lock:
+            self.timer = None
+            summaries = self.pop_expired(time.time())
+            if self.pending:
+                self.start_timer()
+        self.write(summaries)
+
+    def flush(self):
+        """Write all pending summaries, even if their window has not ended."""
+        with self.lock:
+            summaries = self.pop_expired(time.time(), force=True)
+        self.write(summaries)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.timer is not None and self.timer_pid == os.getpid():
+                self.timer.cancel()
+            self.timer = None
+
+    def prune(self, now):
+        """Remove expired windows, or all windows if none have expired.
+
+        Must be called with the lock held. Returns the summaries of any
+        pending windows that were removed.
+        """
+        expired = [
+            k for k, (start, _, _, _) in self.windows.items()
+            if now - start >= self.window
+        ]
+        summaries = self.pop_expired(now, force=not expired)
+        if expired:
+            for k in expired:
+                del self.windows[k]
+        else:
+            self.windows.clear()
+        return summaries
+
+
+_dropped_metric = None
+
+
+def get_dropped_metric():
+    # created lazily, as talisker.logs is imported before metrics can be
+    global _dropped_metric
+    if _dropped_metric is None:
+        import talisker.metrics
+        _dropped_metric = talisker.metrics.Counter(
+            name='logs_dropped',
+            documentation='Count of log records dropped due to a full queue',
+            labelnames=['level'],
+            statsd='{name}.{level}',
+        )
+    return _dropped_metric
+
+
+class TaliskerQueueHandler(logging.Handler):
+    """Handler that formats and writes records from a background thread.
+
+    Records are held in a bounded buffer until the background thread passes
+    them on to the target handlers. This means a slow log consumer (e.g.
+    journald, or a docker log driver) does not block the logging thread.
+
+    When the buffer is full, the oldest DEBUG record is dropped to make room,
+    then the oldest INFO/WARNING record. ERROR records are never dropped: if
+    the buffer is full of errors, the record is written synchronously
+    instead. Dropped records are counted in the logs_dropped metric.
+    """
+
+    DEBUG_PRIORITY = 0
+    INFO_PRIORITY = 1
+    ERROR_PRIORITY = 2
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.capacity = capacity
+        self.targets = []
+        self.dropped = 0
+        self.pid = None
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        # one fifo per priority, so we can drop less important records
+        # first. Records are tagged with a sequence number, so we can still
+        # write them out in the order they were logged.
+        self.queues = (deque(), deque(), deque())
+        self.size = 0
+        self.pending = 0
+        self.sequence = itertools.count()
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def add_target(self, handler):
+        self.targets.append(handler)
+
+    @property
+    def level(self):
+        # the queue passes on anything its targets want, so that
+        # StructuredLogger.will_emit and Logger.callHandlers see the targets'
+        # current levels
+        levels = [h.level for h in self.targets]
+        return min(levels) if levels else logging.NOTSET
+
+    @level.setter
+    def level(self, value):
+        pass
+
+    def ensure_thread(self):
+        """Start the writer thread, restarting it after a fork."""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        self.reset()
+        self.pid = pid
+        self.thread = threading.Thread(
+            target=self.run, name='talisker-log-queue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wanted(self, record):
+        return any(record.levelno >= h.level for h in self.targets)
+
+    def priority(self, record):
+        if record.levelno >= logging.ERROR:
+            return self.ERROR_PRIORITY
+        elif record.levelno >= logging.INFO:
+            return self.INFO_PRIORITY
+        return self.DEBUG_PRIORITY
+
+    def prepare(self, record):
+        """Do the work that must happen on the calling thread.
+
+        Returns a copy of the record to queue, as the original is also passed
+        to any later handlers, e.g. sentry, which groups on the unformatted
+        msg.
+        """
+        # args may be mutated after the log call, so render them now
+        record.message = record.getMessage()
+        # sentry breadcrumbs are per thread, so record them here rather than
+        # in the formatter
+        if record.levelno > logging.DEBUG:
+            import talisker.sentry
+            talisker.sentry.record_log_breadcrumb(record)
+        record._breadcrumb_recorded = True
+        record = copy.copy(record)
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def emit(self, record):
+        if not self.wanted(record):
+            return
+
+        try:
+            record = self.prepare(record)
+            priority = self.priority(record)
+            dropped = None
+            synchronous = False
+
+            self.ensure_thread()
+            with self.cond:
+                if self.size >= self.capacity:
+                    dropped = self.evict(priority)
+                    if dropped is None:
+                        if priority == self.ERROR_PRIORITY:
+                            synchronous = True
+                        else:
+                            dropped = record
+                if dropped is not record and not synchronous:
+                    item = (next(self.sequence), record)
+                    self.queues[priority].append(item)
+                    self.size += 1
+                    self.cond.notify_all()
+        except Exception:
+            self.handleError(record)
+            return
+
+        if dropped is not None:
+            self.record_dropped(dropped)
+        if synchronous:
+            self.write(record)
+
+    def evict(self, priority):
+        """Drop the oldest, least important record, if less important than
+        or as important as priority."""
+        for p in range(min(priority, self.INFO_PRIORITY) + 1):
+            if self.queues[p]:
+                self.size -= 1
+                return self.queues[p].popleft()[1]
+        return None
+
+    def record_dropped(self, record):
+        self.dropped += 1
+        get_dropped_metric().inc(level=record.levelname.lower())
+
+    def pop(self):
+        """Pop the next record, in the order they were logged."""
+        next_queue = None
+        for queue in self.queues:
+            if queue and (next_queue is None or queue[0] < next_queue[0]):
+                next_queue = queue
+        self.size -= 1
+        return next_queue.popleft()[1]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.size and not self.stopping:
+                    self.cond.wait()
+                if not self.size:
+                    return
+                record = self.pop()
+                self.pending += 1
+            try:
+                self.write(record)
+            finally:
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+    def write(self, record):
+        for handler in self.targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush(self, timeout=5.0):
+        """Wait for queued records to be written, up to timeout seconds."""
+        if self.pid == os.getpid():
+            deadline = time.time() + timeout
+            with self.cond:
+                while self.size or self.pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+    def close(self):
+        self.flush()
+        if self.pid == os.getpid():
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+            self.thread.join(1.0)
+        self.pid = None
+        super().close()
+
+
+_debuglog_metrics = None
+
+
+def get_debuglog_metrics():
+    # created lazily, as talisker.logs is imported before metrics can be
+    global _debuglog_metrics
+    if _debuglog_metrics is None:
+        import talisker.metrics
+        _debuglog_metrics = (
+            talisker.metrics.Counter(
+                name='debuglog_written_bytes',
+                documentation='Bytes written to the debug log',
+                statsd='{name}',
+            ),
+            talisker.metrics.Counter(
+                name='debuglog_dropped_bytes',
+                documentation='Bytes of debug log that failed to be written, '
+                              'or were removed to stay under the size limit',
+                statsd='{name}',
+            ),
+        )
+    return _debuglog_metrics
+
+
+class DebugLogHandler(logging.handlers.BaseRotatingHandler):
+    """Size and time bounded debug log file.
+
+    The file is rotated when it reaches segment_size bytes, or every interval
+    seconds. Rotated segments are gzipped by a background thread, which then
+    removes the oldest segments to keep the total size on disk under
+    max_size, and any segments older than the retention period.
+
+    Several processes can log to the same file. The first to rotate it
+    renames it, and the others will reopen the new file when they next roll
+    over.
+    """
+
+    REPORT_INTERVAL = 1.0
+
+    def __init__(
+            self, filename, segment_size, max_size,
+            interval=86400, retention=None):
+        # always utf-8, so sizes in bytes do not depend on the locale
+        super().__init__(filename, 'a', encoding='utf-8', delay=True)
+        self.max_size = max_size
+        # the live file counts towards the total too
+        self.segment_size = min(segment_size, max_size)
+        self.interval = interval
+        self.retention = interval if retention is None else retention
+        now = time.time()
+        self.rollover_at = self.next_rollover(now)
+        directory, name = os.path.split(self.baseFilename)
+        self.directory = directory
+        self.segment_regex = re.compile(
+            re.escape(name) + r'\.\d{8}-\d{6}\.\d{6}\.\d+(\.gz)?$')
+        self.written = 0
+        self.dropped = 0
+        self.reported_at = now
+        self.pid = None
+        self.thread = None
+        self.jobs = None
+
+    def next_rollover(self, now):
+        # aligned to the epoch, so that processes rotate at the same time
+        return (int(now) // self.interval + 1) * self.interval
+
+    def shouldRollover(self, record):
+        if record.created >= self.rollover_at:
+            return True
+        if self.stream is None:
+            return False
+        return self.stream.tell() >= self.segment_size
+
+    def doRollover(self):
+        self.rollover_at = self.next_rollover(time.time())
+        if self.stream is None:
+            return
+        stream = self.stream
+        self.stream = None
+        try:
+            current = os.stat(self.baseFilename)
+            ours = os.fstat(stream.fileno())
+        except FileNotFoundError:
+            # another process has already rotated it
+            return
+        finally:
+            stream.close()
+
+        if not os.path.samestat(current, ours) or current.st_size == 0:
+            return
+
+        now = time.time()
+        segment = '{}.{}.{:06d}.{}'.format(
+            self.baseFilename,
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)),
+            int(now % 1 * 1e6),
+            os.getpid(),
+        )
+        try:
+            os.rename(self.baseFilename, segment)
+        except FileNotFoundError:
+            return
+        self.schedule_maintenance()
+
+    def emit(self, record):
+        size = None
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record) + self.terminator
+            size = len(msg.encode(self.encoding, 'replace'))
+            self.stream.write(msg)
+            self.stream.flush()
+            self.written += size
+        except RecursionError:
+            raise
+        except OSError:
+            # most likely out of disk space, which we report via metrics
+            # rather than a traceback on stderr for every record
+            if size is not None:
+                self.dropped += size
+        except Exception:
+            self.handleError(record)
+
+        if record.created - self.reported_at >= self.REPORT_INTERVAL:
+            self.report_metrics(record.created)
+
+    def report_metrics(self, now):
+        self.reported_at = now
+        written_metric, dropped_metric = get_debuglog_metrics()
+        if self.written:
+            written_metric.inc(self.written)
+            self.written = 0
+        if self.dropped:
+            dropped_metric.inc(self.dropped)
+            self.dropped = 0
+
+    def schedule_maintenance(self):
+        """Compress and prune segments on the background thread."""
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.jobs = Queue()
+            self.thread = threading.Thread(
+                target=self.run, name='talisker-debuglog')
+            self.thread.daemon = True
+            self.thread.start()
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            self.jobs.get()
+            try:
+                self.maintain()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'failed to compress debug log',
+                    extra={'path': self.baseFilename},
+                )
+            finally:
+                self.jobs.task_done()
+
+    def segments(self):
+        """Return (mtime, path, size) of all rotated segments, oldest first."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if self.segment_regex.match(name):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                segments.append((stat.st_mtime, path, stat.st_size))
+        return sorted(segments)
+
+    def maintain(self):
+        # also picks up segments left uncompressed by a previous process
+        for _, path, _ in self.segments():
+            if not path.endswith('.gz'):
+                self.compress(path)
+
+        segments = self.segments()
+        try:
+            total = os.stat(self.baseFilename).st_size
+        except FileNotFoundError:
+            total = 0
+        total += sum(size for _, _, size in segments)
+        expired = time.time() - self.retention
+        dropped = 0
+        for mtime, path, size in segments:
+            if total <= self.max_size and mtime >= expired:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            if mtime >= expired:
+                # removed early to stay under the size limit
+                dropped += size
+
+        if dropped:
+            get_debuglog_metrics()[1].inc(dropped)
+
+    def compress(self, path):
+        tmp = '{}.gz.{}.tmp'.format(path, os.getpid())
+        try:
+            stat = os.stat(path)
+            with open(path, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            # keep the rotation time, which pruning is based on
+            os.utime(tmp, (stat.st_atime, stat.st_mtime))
+            os.rename(tmp, path + '.gz')
+            os.unlink(path)
+        except FileNotFoundError:
+            # another process got there first
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def close(self):
+        self.acquire()
+        try:
+            self.report_metrics(time.time())
+        finally:
+            self.release()
+        super().close()
+
+
 DEFAULT_COLOURS = {
     'logfmt': '2;3;36',     # dim italic teal
     'name': '0;33',         # orange
@@ -537,7 +1742,7 @@ class ColouredFormatter(StructuredFormatter):
     """Colourised log formatting"""
     CLEAR = '\x1b[0m'
 
-    def __init__(self, style='default'):
+    def __init__(self, style='default', encoder=None):
         style = COLOUR_SCHEMES[style]
         self.colours = {k: '\x1b[' + v + 'm' for k, v in style.items()}
         format = (
@@ -546,7 +1751,7 @@ class ColouredFormatter(StructuredFormatter):
             '{name}%(name)s{clear} '
             '"{msg}%(message)s{clear}"'
         ).format(clear=self.CLEAR, **self.colours)
-        super().__init__(fmt=format)
+        super().__init__(fmt=format, encoder=encoder)
 
     def format(self, record):
         colour = self.colours[record.levelname]
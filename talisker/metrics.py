@@ -138,3 +138,23 @@ class Counter(Metric):
             client = talisker.statsd.get_client()
             name = self.get_statsd_name(labels)
             client.incr(name, amount)
+
+
+class Gauge(Metric):
+
+    @property
+    def metric_type(self):
+        return prometheus_client.Gauge
+
+    @protect("Failed to set gauge metric")
+    def set(self, value, **labels):
+        if self.prometheus:
+            if labels:
+                self.prometheus.labels(**labels).set(value)
+            else:
+                self.prometheus.set(value)
+
+        if self.statsd_template:
+            client = talisker.statsd.get_client()
+            name = self.get_statsd_name(labels)
+            client.gauge(name, value)
@@ -112,7 +112,9 @@ class TaliskerConnection(connection):
         return query
 
     def _record(self, msg, query, vars, duration, extra={}):
-        talisker.Context.track('sql', duration)
+        # only label with the query if the values are not in it
+        label = query if vars is not None and isinstance(query, str) else None
+        talisker.Context.track('sql', duration, label)
 
         qdata = collections.OrderedDict()
         qdata['duration_ms'] = duration
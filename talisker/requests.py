@@ -23,11 +23,14 @@
 #
 
 import collections
+from concurrent.futures import FIRST_COMPLETED, wait
 from datetime import datetime
 import functools
 import itertools
 import logging
+import os
 import random
+import threading
 import warnings
 import time
 from urllib.parse import (
@@ -46,6 +49,7 @@ from urllib3.util import Retry
 
 import talisker
 from talisker import Context
+from talisker.futures import TaliskerThreadPoolExecutor
 import talisker.metrics
 from talisker.util import (
     get_errno_fields,
@@ -95,6 +99,27 @@ class RequestsMetric:
         statsd='{name}.{host}.{view}',
     )
 
+    hedges = talisker.metrics.Counter(
+        name='requests_hedges',
+        documentation='Count of hedged http calls sent by TaliskerAdapter',
+        labelnames=['host'],
+        statsd='{name}.{host}',
+    )
+
+    hedges_won = talisker.metrics.Counter(
+        name='requests_hedges_won',
+        documentation='Count of hedged http calls that answered first',
+        labelnames=['host'],
+        statsd='{name}.{host}',
+    )
+
+    hedge_wasted = talisker.metrics.Counter(
+        name='requests_hedge_wasted_ms',
+        documentation='Time spent on http calls discarded after hedging',
+        labelnames=['host'],
+        statsd='{name}.{host}',
+    )
+
     errors = talisker.metrics.Counter(
         name='requests_errors',
         documentation='Count of errors in responses via requests library',
@@ -189,8 +214,8 @@ def request_wrapper(func):
             # some requests errors can cause the context to be lost, and we
             # should never fail due to this.
             try:
-                del ctx.metric_api_name
-                del ctx.metric_host_name
+                ctx.metric_api_name = None
+                ctx.metric_host_name = None
             except Exception:
                 pass
     request._request_wrapper = True
@@ -270,7 +295,11 @@ def metrics_response_hook(response, **kwargs):
 def record_request(request, response=None, exc=None):
     metadata = collect_metadata(request, response)
     if response:
-        Context.track('http', metadata['duration_ms'])
+        Context.track(
+            'http',
+            metadata['duration_ms'],
+            metadata['method'] + ' ' + metadata['url'],
+        )
 
     if exc:
         metadata.update(get_errno_fields(exc))
@@ -287,8 +316,8 @@ def record_request(request, response=None, exc=None):
     }
 
     ctx = Context.current()
-    metric_api_name = getattr(ctx, 'metric_api_name', None)
-    metric_host_name = getattr(ctx, 'metric_host_name', None)
+    metric_api_name = ctx.metric_api_name
+    metric_host_name = ctx.metric_host_name
     if metric_api_name is not None:
         labels['view'] = metric_api_name
     if metric_host_name is not None:
@@ -322,16 +351,54 @@ def enable_requests_logging():  # pragma: nocover
     requests_log.propagate = True
 
 
+# only safe methods are hedged by default, as they may be sent twice
+HEDGE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# latencies kept per host to derive the hedge delay from
+HEDGE_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 20
+# the most hedges that can be sent in a burst
+HEDGE_MAX_TOKENS = 10.0
+# the most requests an adapter has in flight on its hedging pool, beyond
+# which requests are sent unhedged on the calling thread
+HEDGE_WORKERS = 16
+
+
+def discard_leg(host, request, future):
+    """Clean up after the losing request of a hedged pair."""
+    RequestsMetric.hedge_wasted.inc(
+        round(request._hedge_duration * 1000, 3), host=host)
+    if not future.cancelled() and future.exception() is None:
+        # release the connection
+        future.result().close()
+
+
 class TaliskerAdapter(HTTPAdapter):
 
     KNOWN_SCHEMES = ('http', 'https')
 
     def __init__(self, backends=None, backend_iter=None, connect=1.0,
-                 read=10.0, max_retries=0, *args, **kwargs):
+                 read=10.0, max_retries=0, *args, hedge_delay=None,
+                 hedge_percentile=None, hedge_budget=0.1,
+                 hedge_methods=HEDGE_METHODS, hedge_workers=HEDGE_WORKERS,
+                 **kwargs):
         # set up backends
         self.connect_timeout = connect
         self.read_timeout = read
 
+        # hedging is off unless a delay or percentile is given
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_methods = frozenset(hedge_methods)
+        self.hedge_tokens = HEDGE_MAX_TOKENS
+        self.hedge_latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=HEDGE_SAMPLES))
+        self.hedge_lock = threading.Lock()
+        self.hedge_workers = hedge_workers
+        self.hedge_slots = None
+        self.hedge_executor = None
+        self.hedge_pid = None
+
         if max_retries == 0:
             self.__retry = None
         elif isinstance(max_retries, int):
@@ -454,6 +521,11 @@ class TaliskerAdapter(HTTPAdapter):
         # load balance the url
         self.select_backend(request)
 
+        if self.should_hedge(request):
+            return self.hedged_send(request, retry, args, kwargs)
+        return self.send_once(request, retry, args, kwargs)
+
+    def send_once(self, request, retry, args, kwargs):
         # if no retry, just pass straight to base class
         if retry is None:
             return super().send(
@@ -464,9 +536,201 @@ class TaliskerAdapter(HTTPAdapter):
 
         request._retry = retry.new()
         request._start = time.time()
-        request._read_timeout = read
+        request._read_timeout = kwargs['timeout'][1]
         return self._send(request, *args, **kwargs)
 
+    def should_hedge(self, request):
+        if self.hedge_delay is None and self.hedge_percentile is None:
+            return False
+        if request.method not in self.hedge_methods:
+            return False
+        # streamed bodies can not be sent twice
+        return request.body is None or isinstance(request.body, (bytes, str))
+
+    def hedge_host(self, request):
+        host = Context.current().metric_host_name
+        if host is None:
+            host = get_endpoint_name(request._original_url)
+        if host is None:
+            host = parse_url(request._original_url).hostname
+        return host.replace('.', '-')
+
+    def get_hedge_delay(self, host):
+        """The delay in seconds before hedging, or None to not hedge."""
+        if self.hedge_percentile is not None:
+            samples = sorted(self.hedge_latencies[host])
+            if len(samples) >= HEDGE_MIN_SAMPLES:
+                index = int(len(samples) * self.hedge_percentile / 100)
+                return samples[min(index, len(samples) - 1)]
+        return self.hedge_delay
+
+    def take_hedge_token(self):
+        with self.hedge_lock:
+            if self.hedge_tokens >= 1:
+                self.hedge_tokens -= 1
+                return True
+            return False
+
+    def get_hedge_executor(self):
+        # threads do not survive a fork
+        pid = os.getpid()
+        if self.hedge_pid != pid:
+            self.hedge_executor = TaliskerThreadPoolExecutor(
+                self.hedge_workers)
+            self.hedge_slots = threading.BoundedSemaphore(self.hedge_workers)
+            self.hedge_pid = pid
+        return self.hedge_executor
+
+    def submit_leg(self, fn, *args):
+        """Run fn on the hedging pool, if a worker is free.
+
+        Returns None if all workers are busy, rather than queueing behind
+        them, as they may be held by slow requests that can not be aborted.
+        """
+        executor = self.get_hedge_executor()
+        slots = self.hedge_slots
+        if not slots.acquire(blocking=False):
+            return None
+        future = executor.submit(fn, *args)
+        future.add_done_callback(lambda f: slots.release())
+        return future
+
+    def close(self):
+        if self.hedge_executor is not None and self.hedge_pid == os.getpid():
+            self.hedge_executor.shutdown(wait=False)
+        self.hedge_executor = None
+        self.hedge_slots = None
+        self.hedge_pid = None
+        super().close()
+
+    def timed_send(self, request, retry, args, kwargs):
+        start = time.time()
+        try:
+            return self.send_once(request, retry, args, kwargs)
+        finally:
+            request._hedge_duration = time.time() - start
+
+    def hedged_send(self, request, retry, args, kwargs):
+        """Send the request, and a duplicate if it is slow to respond.
+
+        Whichever answers first is used, and the other is discarded when it
+        finishes, as urllib3 can not abort a request in flight.
+        """
+        host = self.hedge_host(request)
+        with self.hedge_lock:
+            self.hedge_tokens = min(
+                HEDGE_MAX_TOKENS, self.hedge_tokens + self.hedge_budget)
+        delay = self.get_hedge_delay(host)
+
+        def record_latency(leg_request, future):
+            if not future.cancelled() and future.exception() is None:
+                self.hedge_latencies[host].append(leg_request._hedge_duration)
+
+        def send_unhedged():
+            response = self.timed_send(request, retry, args, dict(kwargs))
+            self.hedge_latencies[host].append(request._hedge_duration)
+            return response
+
+        if delay is None:
+            # not enough samples yet, so just measure
+            return send_unhedged()
+
+        started = threading.Event()
+
+        def send_primary():
+            request._hedge_start = time.time()
+            started.set()
+            return self.timed_send(request, retry, args, dict(kwargs))
+
+        primary = self.submit_leg(send_primary)
+        if primary is None:
+            # the pool is saturated, so do not queue behind it
+            return send_unhedged()
+        primary.add_done_callback(
+            functools.partial(record_latency, request))
+        # time from when the request is actually sent, so that waiting for
+        # a free worker does not trigger a hedge
+        if not started.wait(self.get_start_timeout(delay, kwargs)):
+            if primary.cancel():
+                return send_unhedged()
+            # it started just as we gave up
+            started.wait()
+        remaining = delay - (time.time() - request._hedge_start)
+        done, _ = wait([primary], timeout=max(remaining, 0))
+        if done:
+            return primary.result()
+
+        hedge_kwargs = self.get_hedge_kwargs(kwargs, request._hedge_start)
+        if hedge_kwargs is None or not self.take_hedge_token():
+            return primary.result()
+
+        hedge = request.copy()
+        hedge._original_url = request._original_url
+        self.select_backend(hedge)
+        secondary = self.submit_leg(
+            self.timed_send, hedge, retry, args, hedge_kwargs)
+        if secondary is None:
+            with self.hedge_lock:
+                self.hedge_tokens += 1
+            return primary.result()
+        RequestsMetric.hedges.inc(host=host)
+        secondary.add_done_callback(functools.partial(record_latency, hedge))
+
+        legs = [(primary, request), (secondary, hedge)]
+        winner = None
+        pending = {primary, secondary}
+        while pending and winner is None:
+            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future, _ in legs:
+                if future.done() and future.exception() is None:
+                    winner = future
+                    break
+
+        if winner is None:
+            # both failed, so raise the original error
+            return primary.result()
+        if winner is secondary:
+            RequestsMetric.hedges_won.inc(host=host)
+        for future, leg_request in legs:
+            if future is not winner:
+                future.add_done_callback(
+                    functools.partial(discard_leg, host, leg_request))
+        return winner.result()
+
+    def get_start_timeout(self, delay, kwargs):
+        """How long to wait for a pool worker to start the primary request.
+
+        Bounded by the hedge delay, the read timeout and the deadline, after
+        which it is sent unhedged instead.
+        """
+        timeout = min(delay, kwargs['timeout'][1])
+        try:
+            ctx_timeout = Context.deadline_timeout()
+        except talisker.DeadlineExceeded:
+            return 0
+        if ctx_timeout is not None:
+            timeout = min(timeout, ctx_timeout)
+        return max(timeout, 0)
+
+    def get_hedge_kwargs(self, kwargs, start):
+        """Send kwargs for a hedge, within the original timeout and deadline.
+
+        Returns None if there is no time left to hedge.
+        """
+        connect, read = kwargs['timeout']
+        read -= time.time() - start
+        try:
+            ctx_timeout = Context.deadline_timeout()
+        except talisker.DeadlineExceeded:
+            return None
+        if ctx_timeout is not None:
+            read = min(read, ctx_timeout)
+        if read <= 0:
+            return None
+        hedge_kwargs = dict(kwargs)
+        hedge_kwargs['timeout'] = (min(connect, read), read)
+        return hedge_kwargs
+
     def _send(self, request, *args, **kwargs):
         response = None
         try:
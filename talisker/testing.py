@@ -38,7 +38,7 @@ import uuid
 
 import requests
 
-from talisker.context import Context, ContextId, CONTEXT_MAP
+from talisker.context import Context, CurrentContext, CONTEXT_MAP
 import talisker.logs
 import talisker.requests
 import talisker.sentry
@@ -65,7 +65,7 @@ else:
 
 def clear_all():
     """Clear all talisker state."""
-    ContextId.set(None)
+    CurrentContext.set(None)
     CONTEXT_MAP.clear()
     talisker.requests.clear()  # talisker requests.Session cache
     talisker.sentry.clear()  # sentry per-request state
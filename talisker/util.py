@@ -120,6 +120,11 @@ def set_wsgi_header(headers, name, value):
     headers.append((name, value))
 
 
+def is_status_path(path):
+    """Is this path one of the /_status endpoints?"""
+    return path == '/_status' or path.startswith('/_status/')
+
+
 def get_rounded_ms(start_time, now_time=None):
     if now_time is None:
         now_time = time.time()
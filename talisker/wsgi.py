@@ -24,18 +24,29 @@
 
 from collections import OrderedDict
 from datetime import datetime
+from fnmatch import fnmatchcase
+import itertools
 import logging
+import math
 import os
+import random
 import time
 import traceback
 import sys
+import threading
 import uuid
 
 from talisker.context import Context
 import talisker.endpoints
+import talisker.inflight
+import talisker.logs
 import talisker.requests
 import talisker.statsd
-from talisker.util import set_wsgi_header, datetime_to_timestamp
+from talisker.util import (
+    datetime_to_timestamp,
+    is_status_path,
+    set_wsgi_header,
+)
 from talisker.render import (
     Content,
     Table,
@@ -56,6 +67,40 @@ __all__ = [
 REQUESTS = {}
 
 
+def uuid4_request_id():
+    return str(uuid.uuid4())
+
+
+class SequentialRequestId():
+    """Cheap, unique request ids.
+
+    Ids are a per-process prefix, made of the process start time and some
+    random bytes, followed by a counter. This avoids reading os.urandom for
+    every request, and the ids are ordered by time within each process.
+    """
+
+    def __init__(self):
+        self.pid = None
+
+    def reset(self):
+        self.prefix = '{:08x}{}-'.format(
+            int(time.time()), os.urandom(6).hex())
+        self.counter = itertools.count(1)
+        self.pid = os.getpid()
+
+    def __call__(self):
+        # a forked worker must not reuse its parent's prefix
+        if self.pid != os.getpid():
+            self.reset()
+        return '{}{:012x}'.format(self.prefix, next(self.counter))
+
+
+REQUEST_ID_GENERATORS = {
+    'uuid4': uuid4_request_id,
+    'sequential': SequentialRequestId(),
+}
+
+
 class RequestTimeout(Exception):
     pass
 
@@ -145,6 +190,43 @@ class WSGIMetric:
         statsd='{name}.{view}.{method}.{status}',
     )
 
+    phase_latency = talisker.metrics.Histogram(
+        name='wsgi_phase_latency',
+        documentation='Duration of each phase of requests served by WSGI',
+        labelnames=['view', 'method', 'phase'],
+        statsd='{name}.{view}.{method}.{phase}',
+        buckets=[4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192],
+    )
+
+    queue_latency = talisker.metrics.Histogram(
+        name='wsgi_queue_latency',
+        documentation='Time requests spent queued before reaching WSGI',
+        labelnames=['view'],
+        statsd='{name}.{view}',
+        buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096],
+    )
+
+    shed = talisker.metrics.Counter(
+        name='wsgi_shed',
+        documentation='Count of WSGI requests rejected by admission control',
+        labelnames=['reason'],
+        statsd='{name}.{reason}',
+    )
+
+    concurrency_limit = talisker.metrics.Gauge(
+        name='wsgi_concurrency_limit',
+        documentation='Current adaptive concurrency limit of each worker',
+        statsd='{name}',
+        multiprocess_mode='liveall',
+    )
+
+    inflight = talisker.metrics.Gauge(
+        name='wsgi_inflight',
+        documentation='Count of WSGI requests currently in flight',
+        statsd='{name}',
+        multiprocess_mode='livesum',
+    )
+
     timeouts = talisker.metrics.Counter(
         name='wsgi_timeouts',
         documentation='Count of WSGI timeout',
@@ -153,6 +235,91 @@ class WSGIMetric:
     )
 
 
+# seconds clients are asked to wait before retrying a shed request
+RETRY_AFTER = 1
+SHED_LOG_INTERVAL = 1.0
+
+# queue times outside these bounds (in seconds) are assumed to be bogus
+MAX_QUEUE_TIME = 3600
+MAX_CLOCK_SKEW = 1
+
+# truncate labels of the slowest tracked calls in the access log
+MAX_TRACKING_LABEL = 80
+
+# adaptive concurrency tuning
+ADAPTIVE_TOLERANCE = 2.0
+ADAPTIVE_BACKOFF = 0.9
+ADAPTIVE_SLOW_FRACTION = 0.5
+ADAPTIVE_MIN_ROUND = 20
+ADAPTIVE_WARMUP = 20
+ADAPTIVE_BASELINE_SAMPLES = 1000
+ADAPTIVE_MAX_VIEWS = 100
+
+
+def parse_request_start(value):
+    """Parse an X-Request-Start style header value into a timestamp.
+
+    The value can have a 't=' prefix, and be in seconds, milliseconds or
+    microseconds since the epoch, as set by nginx, haproxy and others. The
+    unit is inferred from the magnitude.
+    """
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        ts = float(value)
+    except ValueError:
+        return None
+    # nan and inf parse, but defeat any later bounds checks
+    if not math.isfinite(ts):
+        return None
+    if ts > 1e17:
+        ts /= 1e9
+    elif ts > 1e14:
+        ts /= 1e6
+    elif ts > 1e11:
+        ts /= 1e3
+    return ts
+
+
+def get_queue_time(environ, start_time):
+    """Time in seconds the request was queued before we started handling it.
+
+    Returns None if the front end did not set a request start header, or it
+    does not make sense.
+    """
+    header = (
+        environ.get('HTTP_X_REQUEST_START')
+        or environ.get('HTTP_X_QUEUE_START')
+    )
+    if not header:
+        return None
+    request_start = parse_request_start(header)
+    if request_start is None:
+        return None
+    queue_time = start_time - request_start
+    if queue_time < -MAX_CLOCK_SKEW or queue_time > MAX_QUEUE_TIME:
+        return None
+    return max(queue_time, 0)
+
+
+def format_slowest(tracker):
+    """Format a Tracker's slowest labelled calls, for the access log."""
+    parts = []
+    for duration, label in tracker.top():
+        if label:
+            label = ' '.join(label.split())
+            if len(label) > MAX_TRACKING_LABEL:
+                label = label[:MAX_TRACKING_LABEL - 3] + '...'
+            parts.append('{}ms {}'.format(round(duration, 3), label))
+    return '; '.join(parts)
+
+
+def raise_from_iterator(exc_info):
+    """An iterator that raises the given exception when started."""
+    raise exc_info[1].with_traceback(exc_info[2])
+    yield  # pragma: no cover
+
+
 class TaliskerWSGIRequest():
     """Container for WSGI request/response cycle.
 
@@ -161,6 +328,26 @@ class TaliskerWSGIRequest():
     order to count the content-length and log the response.
     """
 
+    __slots__ = (
+        'environ',
+        'original_start_response',
+        'added_headers',
+        'status',
+        'headers',
+        'exc_info',
+        'iter',
+        'status_code',
+        'content_length',
+        'file_path',
+        'closed',
+        'start_response_called',
+        'start_response_timestamp',
+        'duration',
+        'timedout',
+        'limiter',
+        'context',
+    )
+
     def __init__(self,
                  environ,
                  start_response,
@@ -184,6 +371,9 @@ class TaliskerWSGIRequest():
         self.start_response_timestamp = None
         self.duration = 0
         self.timedout = False
+        self.limiter = None
+        # for introspection of in-flight requests
+        self.context = Context.current()
 
     def start_response(self, status, headers, exc_info=None):
         """Adds response headers and stores response data.
@@ -199,9 +389,9 @@ class TaliskerWSGIRequest():
             for header, value in self.added_headers.items():
                 set_wsgi_header(headers, header, value)
 
+        config = talisker.get_config()
         if 'REQUEST_ID' in self.environ:
             # set id header on outgoing response
-            config = talisker.get_config()
             set_wsgi_header(
                 headers,
                 config.id_header,
@@ -210,7 +400,10 @@ class TaliskerWSGIRequest():
 
         # are we going to be sending a sentry report? If so, include header
         if self.exc_info or Context.debug:
-            set_wsgi_header(headers, 'X-Sentry-Id', self.environ['SENTRY_ID'])
+            set_wsgi_header(headers, 'X-Sentry-Id', self.sentry_id())
+
+        if config.server_timing:
+            set_wsgi_header(headers, 'Server-Timing', self.server_timing())
 
         self.status = status
         status_code, _, _ = status.partition(' ')
@@ -260,7 +453,34 @@ class TaliskerWSGIRequest():
             return self
 
     def __iter__(self):
-        return self
+        return self.iterate()
+
+    def iterate(self):
+        """Iterate the response, with a fast path for the common case.
+
+        The first chunk goes through __next__, which takes care of calling
+        start_response. The remaining chunks are passed straight through,
+        just counting their length. If the response iterator raises, we hand
+        the error back to __next__ to switch to an error response.
+        """
+        while True:
+            try:
+                chunk = next(self)
+            except StopIteration:
+                return
+            yield chunk
+
+            try:
+                for chunk in self.iter:
+                    self.content_length += len(chunk)
+                    yield chunk
+            except (Exception, SystemExit):
+                self.iter = raise_from_iterator(sys.exc_info())
+            else:
+                # as with __next__, close when done, in case the server or
+                # other middleware does not
+                self.close()
+                return
 
     def __next__(self):
         """Wraps the provided WSGI content iterator.
@@ -372,8 +592,21 @@ class TaliskerWSGIRequest():
                     (self.start_response_timestamp - start) * 1000
                 )
 
+        soft_timeout = Context.soft_timeout
+        soft_timedout = soft_timeout > 0 and response_latency > soft_timeout
+
+        # write out any buffered debug logs before the access log, if we want
+        # them. Otherwise, they are discarded with the context.
+        if self.exc_info or Context.debug or soft_timedout:
+            talisker.logs.flush_debug_buffer()
+
         metadata = self.get_metadata()
-        self.log(metadata)
+        rate = self.sample_rate(metadata)
+        if rate >= 1.0:
+            self.log(metadata)
+        elif rate > 0 and random.random() < rate:
+            metadata['sampled_rate'] = rate
+            self.log(metadata)
         self.metrics(metadata)
 
         # We want to send a sentry report if:
@@ -383,7 +616,6 @@ class TaliskerWSGIRequest():
 
         if talisker.sentry.enabled:
             view_or_path = metadata.get('view', metadata['path'])
-            soft_timeout = Context.soft_timeout
             try:
                 if self.exc_info:
                     self.send_sentry(metadata)
@@ -393,7 +625,7 @@ class TaliskerWSGIRequest():
                         msg='Debug: {}'.format(view_or_path),
                         level='debug',
                     )
-                elif soft_timeout > 0 and response_latency > soft_timeout:
+                elif soft_timedout:
                     self.send_sentry(
                         metadata,
                         msg='Soft Timeout: {}'.format(view_or_path),
@@ -407,20 +639,21 @@ class TaliskerWSGIRequest():
                 logger.exception('failed to send soft timeout report')
 
         talisker.clear_context()
+        # read before removing this request, so that it counts itself
+        inflight = len(REQUESTS)
         rid = self.environ.get('REQUEST_ID')
         if rid:
             REQUESTS.pop(rid, None)
+        if self.limiter is not None and start:
+            WSGIMetric.inflight.set(len(REQUESTS))
+            view = metadata.get('view', metadata['path'])
+            self.limiter.update(start, self.duration, inflight, view)
 
     def get_metadata(self):
         """Return an ordered dictionary of request metadata for logging."""
         environ = self.environ
         extra = OrderedDict()
 
-        if self.headers is None:
-            headers = {}
-        else:
-            headers = dict((k.lower(), v) for k, v in self.headers)
-
         extra['method'] = environ.get('REQUEST_METHOD')
         script = environ.get('SCRIPT_NAME', '')
         path = environ.get('PATH_INFO', '')
@@ -432,9 +665,13 @@ class TaliskerWSGIRequest():
             extra['status'] = self.status_code
         if 'VIEW_NAME' in environ:
             extra['view'] = environ['VIEW_NAME']
-        elif 'x-view-name' in headers:
-            extra['view'] = headers['x-view-name']
+        else:
+            view = self.response_header('x-view-name')
+            if view is not None:
+                extra['view'] = view
         extra['duration_ms'] = round(self.duration * 1000, 3)
+        for phase, ms in self.phases().items():
+            extra[phase + '_ms'] = ms
         extra['ip'] = environ.get('REMOTE_ADDR', None)
         extra['proto'] = environ.get('SERVER_PROTOCOL')
         if self.content_length:
@@ -471,9 +708,86 @@ class TaliskerWSGIRequest():
         for name, tracker in sorted(tracking.items()):
             extra[name + '_count'] = tracker.count
             extra[name + '_time_ms'] = tracker.time
+            if tracker.count > 1:
+                extra[name + '_max_ms'] = tracker.max
+            slowest = format_slowest(tracker)
+            if slowest:
+                extra[name + '_slowest'] = slowest
 
         return extra
 
+    def phases(self):
+        """Break the request duration down into phases, in ms.
+
+        The queue phase is the time before we started handling the request,
+        if the front end told us when it received it. The app phase is the
+        time until start_response was first called, and the stream phase is
+        the rest of the request. Before the request has finished, the stream
+        phase is not known.
+        """
+        phases = OrderedDict()
+        queue_time = self.environ.get('queue_time')
+        if queue_time is not None:
+            phases['queue'] = round(queue_time * 1000, 3)
+        start = self.environ.get('start_time')
+        if start and self.start_response_timestamp:
+            app = self.start_response_timestamp - start
+            phases['app'] = round(app * 1000, 3)
+            if self.duration:
+                phases['stream'] = round((self.duration - app) * 1000, 3)
+        return phases
+
+    def server_timing(self):
+        """The Server-Timing header value for the time spent so far."""
+        timings = [
+            '{};dur={}'.format(name, ms)
+            for name, ms in self.phases().items()
+        ]
+        tracking = Context.current().tracking
+        for name, tracker in sorted(tracking.items()):
+            timings.append('{};dur={}'.format(name, round(tracker.time, 3)))
+        return ', '.join(timings)
+
+    def sentry_id(self):
+        """The id for this request's sentry report, created on first use.
+
+        It needs to be different from request id, as the request id can be
+        passed on to upstream services.
+        """
+        sentry_id = self.environ.get('SENTRY_ID')
+        if sentry_id is None:
+            sentry_id = self.environ['SENTRY_ID'] = uuid.uuid4().hex
+        return sentry_id
+
+    def response_header(self, name):
+        """Return the value of a response header, given its lowercase name."""
+        for header, value in self.headers or ():
+            if header.lower() == name:
+                return value
+        return None
+
+    def sample_rate(self, metadata):
+        """The rate at which to sample this request in the access log."""
+        config = talisker.get_config()
+        rules = config.access_log_sampling
+        if not rules:
+            return 1.0
+        # always log anything interesting
+        if (self.exc_info or self.timedout or self.status_code is None
+                or self.status_code >= 400):
+            return 1.0
+        threshold = config.access_log_sampling_threshold
+        if threshold >= 0 and metadata['duration_ms'] > threshold:
+            return 1.0
+
+        view = metadata.get('view')
+        path = metadata['path']
+        for pattern, rate in rules:
+            if fnmatchcase(path, pattern) or (
+                    view is not None and fnmatchcase(view, pattern)):
+                return rate
+        return 1.0
+
     def log(self, extra):
         """Log a WSGI request.
 
@@ -497,6 +811,17 @@ class TaliskerWSGIRequest():
 
         WSGIMetric.requests.inc(**labels)
         WSGIMetric.latency.observe(extra['duration_ms'], **labels)
+        for phase in self.phases():
+            if phase == 'queue':
+                WSGIMetric.queue_latency.observe(
+                    extra['queue_ms'], view=labels['view'])
+                continue
+            WSGIMetric.phase_latency.observe(
+                extra[phase + '_ms'],
+                view=labels['view'],
+                method=labels['method'],
+                phase=phase,
+            )
         if self.timedout:
             lbls = labels.copy()
             lbls.pop('status')
@@ -508,8 +833,7 @@ class TaliskerWSGIRequest():
         from raven.utils.wsgi import get_current_url, get_environ, get_headers
         if data is None:
             data = {}
-        if 'SENTRY_ID' in self.environ:
-            data['event_id'] = self.environ['SENTRY_ID']
+        data['event_id'] = self.sentry_id()
         view_name = metadata.get('view')
         if view_name and 'transaction' not in data:
             data['transaction'] = view_name
@@ -532,6 +856,102 @@ class TaliskerWSGIRequest():
         )
 
 
+class AdaptiveLimiter():
+    """Per-worker concurrency limit that adapts to observed latency.
+
+    Uses AIMD (additive increase, multiplicative decrease), as TCP congestion
+    control does, deciding once per round of requests. A round is at least
+    ADAPTIVE_MIN_ROUND requests, and at least the current limit.
+
+    Each view has its own latency baseline, the mean of roughly its last
+    ADAPTIVE_BASELINE_SAMPLES request durations, so a mix of fast and slow
+    views is not mistaken for congestion. A sudden rise in latency cuts the
+    limit, but if it persists, it slowly becomes the new baseline.
+
+    A request is slow if it took more than ADAPTIVE_TOLERANCE times its
+    view's baseline. If more than ADAPTIVE_SLOW_FRACTION of a round were
+    slow, the limit is cut by ADAPTIVE_BACKOFF. For steady traffic, no
+    more than half of requests can take over twice the mean, so a single
+    slow request, or a view with highly variable latency, does not cut it.
+    Otherwise, if the worker was busy, i.e. had at least half the limit in
+    flight during the round, the limit is raised by one.
+
+    Requests that started before the last cut are ignored, as they may have
+    been slowed by the load that caused it.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        # view: [mean duration, samples]
+        self.baselines = {}
+        self.round_count = 0
+        self.round_slow = 0
+        self.round_peak = 0
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+        WSGIMetric.concurrency_limit.set(self.current())
+
+    def current(self):
+        return int(self.limit)
+
+    def baseline(self, view, duration):
+        """Update view's baseline, returning the previous value.
+
+        Returns None while the view has too few samples to judge by.
+        """
+        state = self.baselines.get(view)
+        if state is None:
+            if len(self.baselines) >= ADAPTIVE_MAX_VIEWS:
+                # bound memory, lumping any further views together
+                view = None
+                state = self.baselines.get(view)
+            if state is None:
+                self.baselines[view] = [duration, 1]
+                return None
+
+        mean, samples = state
+        # the mean of all samples at first, then an exponentially weighted
+        # mean of roughly the last ADAPTIVE_BASELINE_SAMPLES
+        if samples < ADAPTIVE_BASELINE_SAMPLES:
+            samples += 1
+            state[1] = samples
+        state[0] = mean + (duration - mean) / samples
+        return mean if samples > ADAPTIVE_WARMUP else None
+
+    def update(self, start, duration, inflight, view=None):
+        """Adjust the limit given a completed request's duration (in s).
+
+        inflight is the number of requests in flight when it completed,
+        including itself.
+        """
+        with self.lock:
+            baseline = self.baseline(view, duration)
+            if baseline is None or start < self.decreased_at:
+                return
+
+            self.round_count += 1
+            if duration > baseline * ADAPTIVE_TOLERANCE:
+                self.round_slow += 1
+            self.round_peak = max(self.round_peak, inflight)
+            if self.round_count < max(ADAPTIVE_MIN_ROUND, self.limit):
+                return
+
+            previous = self.current()
+            if self.round_slow > self.round_count * ADAPTIVE_SLOW_FRACTION:
+                self.limit = max(self.min_limit, self.limit * ADAPTIVE_BACKOFF)
+                self.decreased_at = start + duration
+            elif self.round_peak * 2 >= self.limit:
+                # only grow if we are actually using the current limit
+                self.limit = min(self.max_limit, self.limit + 1)
+            self.round_count = self.round_slow = self.round_peak = 0
+            limit = self.current()
+
+        if limit != previous:
+            WSGIMetric.concurrency_limit.set(limit)
+
+
 class TaliskerMiddleware():
     """Talisker entrypoint for WSGI apps.
 
@@ -549,10 +969,65 @@ class TaliskerMiddleware():
         self.app = app
         self.environ = environ
         self.headers = headers
+        self.shed_lock = threading.Lock()
+        self.shed_counts = {}
+        self.shed_logged_at = 0
+        self.limiter = None
 
         # ensure new workers have an initialised sentry_context
         talisker.sentry.new_context()
 
+    def shed_reason(self, environ, config):
+        """Return why this request should be rejected, or None to admit it."""
+        # always allow access to the status endpoints, to monitor the worker
+        if is_status_path(environ.get('PATH_INFO', '')):
+            return None
+        limit = config.max_concurrency
+        if limit > 0 and len(REQUESTS) >= limit:
+            return 'concurrency'
+        if self.limiter is not None:
+            if len(REQUESTS) >= self.limiter.current():
+                return 'adaptive'
+        floor = config.min_deadline_budget
+        if floor >= 0:
+            deadline = Context.current().deadline
+            if deadline is not None:
+                budget = (deadline - time.time()) * 1000
+                if budget < floor:
+                    return 'deadline'
+        return None
+
+    def shed(self, environ, start_response, reason):
+        """Reject the request with a 503, without running the app.
+
+        This needs to be cheap, as we are probably overloaded. So rather than
+        an access log line per request, we log at most once a second.
+        """
+        WSGIMetric.shed.inc(reason=reason)
+        now = time.time()
+        counts = None
+        with self.shed_lock:
+            self.shed_counts[reason] = self.shed_counts.get(reason, 0) + 1
+            if now - self.shed_logged_at >= SHED_LOG_INTERVAL:
+                counts = self.shed_counts
+                self.shed_counts = {}
+                self.shed_logged_at = now
+        if counts is not None:
+            extra = OrderedDict(count=sum(counts.values()))
+            extra.update(sorted(counts.items()))
+            logger.warning('shedding requests', extra=extra)
+        talisker.clear_context()
+
+        config = talisker.get_config()
+        body = b'Service Unavailable'
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(RETRY_AFTER)),
+            (config.id_header, environ['REQUEST_ID']),
+        ])
+        return [body]
+
     def __call__(self, environ, start_response):
         Context.new()
         config = talisker.get_config()
@@ -561,17 +1036,20 @@ class TaliskerMiddleware():
         environ['start_time'] = Context.current().start_time
         if self.environ:
             environ.update(self.environ)
+        queue_time = get_queue_time(environ, environ['start_time'])
+        if queue_time is not None:
+            environ['queue_time'] = queue_time
         # ensure request id
         if config.wsgi_id_header not in environ:
-            environ[config.wsgi_id_header] = str(uuid.uuid4())
+            generate_id = REQUEST_ID_GENERATORS[config.request_id_format]
+            environ[config.wsgi_id_header] = generate_id()
         rid = environ[config.wsgi_id_header]
         environ['REQUEST_ID'] = rid
-        # needs to be different from request id, as request can be passed on to
-        # upstream services
-        environ['SENTRY_ID'] = uuid.uuid4().hex
+        # SENTRY_ID is only created if a sentry report is sent
 
         Context.request_id = rid
         Context.soft_timeout = config.soft_request_timeout
+        talisker.logs.start_debug_buffer(config.debug_buffer_size)
 
         # calculate ip route
         route = None
@@ -617,7 +1095,26 @@ class TaliskerMiddleware():
                 set_deadline = True
 
         if not set_deadline and config.request_timeout is not None:
-            Context.set_relative_deadline(config.request_timeout)
+            if config.deadline_includes_queue and queue_time is not None:
+                Context.set_absolute_deadline(
+                    environ['start_time'] - queue_time
+                    + config.request_timeout / 1000
+                )
+            else:
+                Context.set_relative_deadline(config.request_timeout)
+
+        if config.adaptive_concurrency > 0 and self.limiter is None:
+            self.limiter = AdaptiveLimiter(config.adaptive_concurrency)
+
+        reason = self.shed_reason(environ, config)
+        if reason is not None:
+            return self.shed(environ, start_response, reason)
+
+        if config.requests_snapshot_size:
+            directory = os.environ.get('prometheus_multiproc_dir')
+            if directory:
+                talisker.inflight.start_publisher(
+                    directory, config.requests_snapshot_size, REQUESTS)
 
         # create the response container
         request = TaliskerWSGIRequest(environ, start_response, self.headers)
@@ -631,6 +1128,12 @@ class TaliskerMiddleware():
         else:
             REQUESTS[rid] = request
 
+        if self.limiter is not None:
+            WSGIMetric.inflight.set(len(REQUESTS))
+            # status endpoints would skew the latency baseline
+            if not is_status_path(environ.get('PATH_INFO', '')):
+                request.limiter = self.limiter
+
         try:
             response_iter = self.app(environ, request.start_response)
         except Exception as e:
@@ -119,6 +119,16 @@ def context():
     ctx.stop()
 
 
+@pytest.fixture
+def debug_buffer(config, context, monkeypatch):
+    """Enable debug log buffering, with no handlers emitting DEBUG records."""
+    config['TALISKER_DEBUG_BUFFER_SIZE'] = '10'
+    for handler in logging.getLogger().handlers:
+        level = max(handler.level, logging.INFO)
+        monkeypatch.setattr(handler, 'level', level)
+    return context
+
+
 @pytest.fixture
 def django(monkeypatch):
     root = os.path.dirname(__file__)
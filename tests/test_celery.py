@@ -138,6 +138,25 @@ def test_celery_task_run_retries(celery_app, context):
     ]
 
 
+def test_celery_task_debug_buffer(celery_app, debug_buffer):
+
+    @celery_app.task
+    def debug_task(fail):
+        logging.getLogger('debug_task').debug('debug')
+        if fail:
+            raise Exception('failed task')
+
+    debug_task.apply(args=(False,))
+    debug_buffer.assert_not_log(name='debug_task')
+
+    debug_task.apply(args=(True,))
+    debug_buffer.assert_log(
+        name='debug_task',
+        msg='debug',
+        extra={'task_name': debug_task.name},
+    )
+
+
 @pytest.mark.skipif(not talisker.sentry.enabled, reason='need raven installed')
 @freeze_time(DATESTRING)
 def test_celery_sentry(celery_app, context):
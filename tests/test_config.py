@@ -66,14 +66,32 @@ def test_config_defaults():
         {},
         devel=False,
         debuglog=None,
+        debuglog_segment_size=64 * 1024 * 1024,
+        debuglog_max_size=512 * 1024 * 1024,
         colour=False,
         slowquery_threshold=-1,
+        slowcall_threshold=-1,
         explain_sql=False,
+        log_format='logfmt',
+        logfmt_encoder='standard',
+        log_queue_size=0,
+        debug_buffer_size=0,
+        access_log_sampling=[],
+        access_log_sampling_threshold=-1,
+        log_dedup={},
+        log_dedup_window=60,
+        requests_snapshot_size=0,
         soft_request_timeout=-1,
         request_timeout=None,
         logstatus=False,
+        server_timing=False,
+        deadline_includes_queue=False,
+        max_concurrency=0,
+        adaptive_concurrency=0,
+        min_deadline_budget=-1,
         networks=[],
         id_header='X-Request-Id',
+        request_id_format='uuid4',
         wsgi_id_header='HTTP_X_REQUEST_ID',
     )
 
@@ -116,6 +134,31 @@ def test_config_colour(monkeypatch):
     assert_config({'DEVEL': '1'}, devel=True, colour='default')
 
 
+def test_admission_config():
+    assert_config(
+        {
+            'TALISKER_MAX_CONCURRENCY': '10',
+            'TALISKER_ADAPTIVE_CONCURRENCY': '20',
+            'TALISKER_MIN_DEADLINE_BUDGET': '50',
+        },
+        max_concurrency=10,
+        adaptive_concurrency=20,
+        min_deadline_budget=50,
+    )
+
+
+def test_deadline_includes_queue_config():
+    assert_config(
+        {'TALISKER_DEADLINE_INCLUDES_QUEUE': 'yes'},
+        deadline_includes_queue=True,
+    )
+
+
+def test_server_timing_config():
+    assert_config({'TALISKER_SERVER_TIMING': '1'}, server_timing=True)
+    assert_config({'TALISKER_SERVER_TIMING': 'garbage'}, server_timing=False)
+
+
 def test_logstatus_config():
     assert_config({'TALISKER_LOGSTATUS': '1'}, logstatus=True)
     assert_config({'TALISKER_LOGSTATUS': 'garbage'}, logstatus=False)
@@ -126,6 +169,25 @@ def test_debuglog_config():
     assert_config({'DEBUGLOG': 1}, debuglog='1')
 
 
+def test_debuglog_size_config():
+    assert_config(
+        {
+            'TALISKER_DEBUGLOG_SEGMENT_SIZE': '1000',
+            'TALISKER_DEBUGLOG_MAX_SIZE': '10000',
+        },
+        debuglog_segment_size=1000,
+        debuglog_max_size=10000,
+    )
+    assert_config(
+        {
+            'TALISKER_DEBUGLOG_SEGMENT_SIZE': '0',
+            'TALISKER_DEBUGLOG_MAX_SIZE': 'big',
+        },
+        debuglog_segment_size=64 * 1024 * 1024,
+        debuglog_max_size=512 * 1024 * 1024,
+    )
+
+
 def test_query_threshold_config():
     assert_config(
         {'TALISKER_SLOWQUERY_THRESHOLD': '3000'}, slowquery_threshold=3000)
@@ -133,6 +195,8 @@ def test_query_threshold_config():
         {'TALISKER_SLOWQUERY_THRESHOLD': 'garbage'}, slowquery_threshold=-1)
     msg = str(cfg.ERRORS['TALISKER_SLOWQUERY_THRESHOLD'])
     assert msg == "'garbage' is not a valid integer"
+    assert_config(
+        {'TALISKER_SLOWCALL_THRESHOLD': '100'}, slowcall_threshold=100)
 
 
 def test_explain_sql_config():
@@ -140,6 +204,61 @@ def test_explain_sql_config():
     assert_config({'TALISKER_EXPLAIN_SQL': 'garbage'}, explain_sql=False)
 
 
+def test_log_format_config():
+    assert_config({'TALISKER_LOG_FORMAT': 'json'}, log_format='json')
+    assert_config({'TALISKER_LOG_FORMAT': 'JSON'}, log_format='json')
+    cfg = assert_config(
+        {'TALISKER_LOG_FORMAT': 'garbage'}, log_format='logfmt')
+    msg = str(cfg.ERRORS['TALISKER_LOG_FORMAT'])
+    assert msg == 'garbage is not a valid log format'
+
+
+def test_logfmt_encoder_config():
+    assert_config({'TALISKER_LOGFMT_ENCODER': 'fast'}, logfmt_encoder='fast')
+    assert_config({'TALISKER_LOGFMT_ENCODER': 'FAST'}, logfmt_encoder='fast')
+    cfg = assert_config(
+        {'TALISKER_LOGFMT_ENCODER': 'garbage'}, logfmt_encoder='standard')
+    msg = str(cfg.ERRORS['TALISKER_LOGFMT_ENCODER'])
+    assert msg == 'garbage is not a valid logfmt encoder'
+
+
+def test_debug_buffer_size_config():
+    assert_config(
+        {'TALISKER_DEBUG_BUFFER_SIZE': '100'}, debug_buffer_size=100)
+    cfg = assert_config(
+        {'TALISKER_DEBUG_BUFFER_SIZE': 'garbage'}, debug_buffer_size=0)
+    assert 'TALISKER_DEBUG_BUFFER_SIZE' in cfg.ERRORS
+
+
+def test_access_log_sampling_config():
+    assert_config(
+        {'TALISKER_ACCESS_LOG_SAMPLING': 'api.*=0.01 /static/*=0 /a=b=0.5'},
+        access_log_sampling=[
+            ('api.*', 0.01), ('/static/*', 0.0), ('/a=b', 0.5)],
+    )
+    for rule in ['api.*', '=0.1', 'api.*=2', 'api.*=x']:
+        cfg = assert_config(
+            {'TALISKER_ACCESS_LOG_SAMPLING': rule}, access_log_sampling=[])
+        msg = str(cfg.ERRORS['TALISKER_ACCESS_LOG_SAMPLING'])
+        assert msg == '{} is not a valid sampling rule'.format(rule)
+    assert_config(
+        {'TALISKER_ACCESS_LOG_SAMPLING_THRESHOLD': '500'},
+        access_log_sampling_threshold=500,
+    )
+
+
+def test_log_dedup_config():
+    assert_config(
+        {'TALISKER_LOG_DEDUP': 'talisker.requests=5 root=100'},
+        log_dedup={'talisker.requests': 5, 'root': 100},
+    )
+    for rule in ['root', '=1', 'root=0', 'root=x']:
+        cfg = assert_config({'TALISKER_LOG_DEDUP': rule}, log_dedup={})
+        msg = str(cfg.ERRORS['TALISKER_LOG_DEDUP'])
+        assert msg == '{} is not a valid log dedup rule'.format(rule)
+    assert_config({'TALISKER_LOG_DEDUP_WINDOW': '10'}, log_dedup_window=10)
+
+
 def test_request_timeout_config():
     assert_config(
         {'TALISKER_SOFT_REQUEST_TIMEOUT': '3000'}, soft_request_timeout=3000)
@@ -164,6 +283,17 @@ def test_sanitised_keys_config():
     )
 
 
+def test_request_id_format_config():
+    assert_config(
+        {'TALISKER_REQUEST_ID_FORMAT': 'Sequential'},
+        request_id_format='sequential',
+    )
+    assert_config(
+        {'TALISKER_REQUEST_ID_FORMAT': 'random'},
+        request_id_format='uuid4',
+    )
+
+
 def test_id_header_config():
     assert_config(
         {'TALISKER_ID_HEADER': 'X-Alternate'},
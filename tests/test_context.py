@@ -23,19 +23,32 @@
 #
 
 import asyncio
+import gc
 import sys
 import threading
 import time
+import warnings
 
 from freezegun import freeze_time
 import pytest
 
+import talisker.context
 from talisker.context import (
+    CONTEXT_MAP,
+    NULL_CONTEXT,
     Context,
+    ContextData,
     ContextStack,
+    DeadlineExceeded,
     NullContextStack,
+    Tracker,
+    create_context,
+    delete_context,
+    get_context,
+    reap_contexts,
     enable_gevent_context,
     enable_eventlet_context,
+    enable_asyncio_context,
     request_timeout,
 )
 from talisker.util import pkg_is_installed
@@ -57,6 +70,98 @@ def test_context_api():
     assert Context.current().tracking == {}
 
 
+# b/w compat test
+def test_context_id_alias():
+    import talisker.context
+    assert talisker.context.ContextId is talisker.context.CurrentContext
+
+
+def test_context_registry():
+    ctx = Context.new()
+    assert Context.current() is ctx
+    assert get_context(ctx.id) is ctx
+    Context.clear()
+    assert get_context(ctx.id) is NULL_CONTEXT
+
+
+def test_context_registry_is_weak():
+    ids = []
+
+    def worker():
+        ids.append(Context.new().id)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    del thread
+    gc.collect()
+    assert ids[0] not in CONTEXT_MAP
+
+
+def test_context_registry_is_bounded(monkeypatch):
+    monkeypatch.setattr(talisker.context, 'MAX_CONTEXTS', 1)
+    first = create_context()
+    second = create_context()
+    assert first.id in CONTEXT_MAP
+    assert second.id not in CONTEXT_MAP
+
+
+def test_reap_contexts(monkeypatch, context):
+    monkeypatch.setattr(talisker.context, 'REAPER_TIMEOUT', 30)
+    ctx = Context.new()
+    ctx.request_id = 'id'
+    ctx.start_time -= 31
+    fresh = create_context()
+
+    assert reap_contexts() == 1
+    assert ctx.id not in CONTEXT_MAP
+    assert fresh.id in CONTEXT_MAP
+    # still usable by the request
+    assert Context.current() is ctx
+    context.assert_log(
+        name='talisker.context',
+        msg='evicting stale context',
+        extra={'request_id': 'id'},
+    )
+
+
+def test_reap_contexts_concurrent_with_creation(monkeypatch):
+    monkeypatch.setattr(talisker.context, 'REAPER_TIMEOUT', 3600)
+    stop = threading.Event()
+    errors = []
+
+    def churn():
+        try:
+            while not stop.is_set():
+                ctxs = [create_context() for _ in range(500)]
+                for ctx in ctxs:
+                    delete_context(ctx.id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=churn) for _ in range(3)]
+    for t in threads:
+        t.start()
+    try:
+        for _ in range(300):
+            reap_contexts()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    assert errors == []
+
+
+def test_create_context_survives_reaper_errors(monkeypatch):
+    def broken(now=None):
+        raise RuntimeError('dictionary changed size during iteration')
+
+    monkeypatch.setattr(talisker.context, 'reap_contexts', broken)
+    monkeypatch.setitem(talisker.context.REAPER_STATE, 'last_run', 0)
+    ctx = create_context()
+    assert ctx.id in CONTEXT_MAP
+
+
 def test_null_context():
     Context.request_id = 'test'
     Context.set_debug()
@@ -222,6 +327,179 @@ def test_context_asyncio():
     loop.run_until_complete(asyncio.gather(t1, t2))
 
 
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_deadline_scope_cancels_task():
+    async def slow():
+        Context.new()
+        Context.set_relative_deadline(10)
+        async with Context.deadline_scope():
+            await asyncio.sleep(1)
+
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        run_async(slow())
+    assert time.time() - start < 0.5
+
+
+def test_deadline_scope_timeout():
+    async def scoped():
+        Context.new()
+        Context.set_relative_deadline(10000)
+        deadline = Context.current().deadline
+        with pytest.raises(DeadlineExceeded):
+            async with Context.deadline_scope(timeout=10):
+                assert Context.current().deadline < deadline
+                await asyncio.sleep(1)
+        # restored after the scope
+        assert Context.current().deadline == deadline
+        # the task was not left cancelled
+        await asyncio.sleep(0)
+        async with Context.deadline_scope():
+            await asyncio.sleep(0)
+        return 'done'
+
+    assert run_async(scoped()) == 'done'
+
+
+def test_deadline_scope_overlapping_tasks():
+    async def scoped(timeout, started, finish):
+        async with Context.deadline_scope(timeout=timeout):
+            deadline = Context.current().deadline
+            Context.track('sql', 1.0)
+            started.set()
+            await finish.wait()
+        return deadline
+
+    async def parent():
+        Context.new()
+        ctx = Context.current()
+        loop = asyncio.get_event_loop()
+        events = [asyncio.Event() for _ in range(3)]
+        # without the task factory, both tasks share ctx
+        a = loop.create_task(scoped(100000, events[0], events[2]))
+        await events[0].wait()
+        b = loop.create_task(scoped(200000, events[1], events[2]))
+        await events[1].wait()
+        assert ctx.deadline is None
+        events[2].set()
+        deadlines = await asyncio.gather(a, b)
+        assert deadlines[0] < deadlines[1]
+        assert ctx.deadline is None
+        assert ctx.tracking['sql'].count == 2
+
+    run_async(parent())
+
+
+def test_deadline_scope_no_deadline_or_passed():
+    async def scoped():
+        Context.new()
+        async with Context.deadline_scope():
+            await asyncio.sleep(0)
+        Context.set_absolute_deadline(time.time() - 1)
+        with pytest.raises(DeadlineExceeded):
+            async with Context.deadline_scope():
+                pass
+
+    run_async(scoped())
+
+
+def test_asyncio_task_factory():
+    async def child(n):
+        assert Context.request_id == 'ID'
+        Context.logging.push(child=n)
+        Context.track('sql', 1.0, 'child')
+        await asyncio.sleep(0)
+        assert Context.logging.flat == {'child': n, 'a': 1}
+
+    async def parent():
+        Context.new()
+        Context.request_id = 'ID'
+        Context.logging.push(a=1)
+        loop = asyncio.get_event_loop()
+        undo = enable_asyncio_context(loop)
+        try:
+            await asyncio.gather(
+                loop.create_task(child(1)),
+                loop.create_task(child(2)),
+            )
+        finally:
+            undo()
+        assert Context.logging.flat == {'a': 1}
+        return Context.current().tracking['sql']
+
+    tracker = run_async(parent())
+    assert tracker.count == 2
+    assert tracker.top() == [(1.0, 'child'), (1.0, 'child')]
+
+
+def test_asyncio_task_factory_creates_child_with_task():
+    async def child():
+        return Context.request_id
+
+    async def parent():
+        Context.new()
+        Context.request_id = 'ID'
+        loop = asyncio.get_event_loop()
+        undo = enable_asyncio_context(loop)
+        try:
+            coro = child()
+            task = loop.create_task(coro)
+            # the task runs the coroutine as given
+            assert task.get_coro() is coro
+            # captured at creation, not when the task first runs
+            Context.request_id = 'changed'
+            result = await task
+
+            unstarted = loop.create_task(child())
+            unstarted.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await unstarted
+        finally:
+            undo()
+        return result
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert run_async(parent()) == 'ID'
+        gc.collect()
+
+
+def test_enable_asyncio_context_chains_task_factory():
+    created = []
+
+    def factory(loop, coro, **kwargs):
+        created.append(coro)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    async def child():
+        return Context.request_id
+
+    async def parent():
+        Context.new()
+        Context.request_id = 'ID'
+        loop = asyncio.get_event_loop()
+        loop.set_task_factory(factory)
+        undo = enable_asyncio_context(loop)
+        # enabling twice does not nest child contexts
+        undo_again = enable_asyncio_context(loop)
+        try:
+            assert await loop.create_task(child()) == 'ID'
+        finally:
+            undo_again()
+            undo()
+        assert loop.get_task_factory() is factory
+        return created
+
+    assert len(run_async(parent())) == 1
+
+
 def test_stack_basic():
     stack = ContextStack()
 
@@ -292,6 +570,32 @@ def test_stack_unwind():
     assert stack['a'] == 1
 
 
+def test_stack_flat_is_replaced():
+    stack = ContextStack({'a': 1})
+    flat = stack.flat
+
+    stack.push(a=2, b=3)
+    assert flat == {'a': 1}
+    assert list(stack.flat.items()) == [('a', 2), ('b', 3)]
+
+    stack.pop()
+    assert stack.flat is flat
+
+    stack.push(c=4)
+    stack.push(d=5)
+    stack.unwind(1)
+    assert stack.flat is flat
+
+
+def test_context_data_is_slotted():
+    ctx = ContextData('id')
+    assert not hasattr(ctx, '__dict__')
+    assert ctx.metric_api_name is None
+    assert ctx.metric_host_name is None
+    with pytest.raises(AttributeError):
+        ctx.unknown = 1
+
+
 def test_null_context_stack():
     stack = NullContextStack()
     stack.push(a=1)
@@ -324,6 +628,35 @@ def test_tracking():
     assert Context.current().tracking['http'].time == 3.0
 
 
+def test_tracker_summary():
+    tracker = Tracker()
+    for i, duration in enumerate([5.0, 1.0, 9.0, 3.0, 7.0]):
+        tracker.add(duration, 'q{}'.format(i))
+    assert tracker.count == 5
+    assert tracker.time == 25.0
+    assert tracker.min == 1.0
+    assert tracker.max == 9.0
+    assert tracker.top() == [(9.0, 'q2'), (7.0, 'q4'), (5.0, 'q0')]
+
+
+def test_tracker_merge():
+    tracker = Tracker()
+    tracker.add(5.0, 'a')
+    tracker.add(2.0, 'b')
+    other = Tracker()
+    other.add(1.0)
+    other.add(8.0, 'c')
+    other.add(3.0, 'd')
+    tracker.merge(other)
+    assert tracker.count == 5
+    assert tracker.time == 19.0
+    assert tracker.min == 1.0
+    assert tracker.max == 8.0
+    assert tracker.top() == [(8.0, 'c'), (5.0, 'a'), (3.0, 'd')]
+    tracker.merge(Tracker())
+    assert tracker.count == 5
+
+
 @freeze_time()
 def test_request_timeout():
     Context.new()
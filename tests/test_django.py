@@ -54,3 +54,23 @@ def test_django_sentry_client(monkeypatch, context):
     context.assert_log(msg='configured raven')
     assert talisker.sentry.get_client() is client
     assert talisker.sentry.get_log_handler().client is client
+
+
+def test_django_middleware_sets_view_name_before_view():
+    class Request():
+        def __init__(self):
+            self.environ = {}
+            self.resolver_match = type('Match', (), {'view_name': 'view'})
+
+    names = []
+
+    def get_response(request):
+        names.append(request.environ.get('VIEW_NAME'))
+        return {}
+
+    mw = talisker.django.middleware(get_response)
+    request = Request()
+    assert mw.process_view(request, None, (), {}) is None
+    response = mw(request)
+    assert names == ['view']
+    assert response['X-View-Name'] == 'view'
@@ -338,3 +338,86 @@ def test_info_objgraph():
                           environ_overrides={'REMOTE_ADDR': b'127.0.0.1'})
     assert response.status_code == 200
     assert response.headers['Content-Type'] == 'text/plain; charset=utf-8'
+
+
+def test_info_logs(config, tmpdir, monkeypatch):
+    from talisker import logbuffer
+    client = get_client()
+    environ = {'REMOTE_ADDR': b'127.0.0.1'}
+    response = client.get('/_status/info/logs', environ_overrides=environ)
+    assert response.status_code == 404
+
+    directory = str(tmpdir.mkdir('logs'))
+    monkeypatch.setenv('prometheus_multiproc_dir', directory)
+    config['TALISKER_LOG_RING_BUFFER_SIZE'] = '1024'
+    buf1 = logbuffer.LogRingBuffer(logbuffer.buffer_path(directory, 1), 1024)
+    buf2 = logbuffer.LogRingBuffer(logbuffer.buffer_path(directory, 2), 1024)
+    buf1.write(1.0, b'one')
+    buf2.write(2.0, b'two')
+    buf1.write(3.0, b'three')
+
+    response = client.get('/_status/info/logs', environ_overrides=environ)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; charset=utf-8'
+    assert response.data == b'[1] one\n[2] two\n[1] three\n'
+
+    response = client.get(
+        '/_status/info/logs?limit=1', environ_overrides=environ)
+    assert response.data == b'[1] three\n'
+
+    for limit in ('foo', '-1', '0'):
+        response = client.get(
+            '/_status/info/logs?limit=' + limit, environ_overrides=environ)
+        assert response.status_code == 400
+
+
+def test_info_requests(wsgi_env, monkeypatch):
+    from talisker import wsgi
+    from tests.test_inflight import make_request
+    client = get_client()
+    environ = {'REMOTE_ADDR': b'127.0.0.1'}
+    monkeypatch.setitem(
+        wsgi.REQUESTS, 'ID', make_request(wsgi_env, '/slow'))
+    response = client.get(
+        '/_status/info/requests',
+        environ_overrides=environ,
+        headers={'Accept': 'application/json'},
+    )
+    assert response.status_code == 200
+    rows = response.json['requests']
+    assert len(rows) == 1
+    assert rows[0]['Request Id'] == 'ID-/slow'
+    assert rows[0]['Path'] == '/slow'
+    assert rows[0]['Tracking'] == 'http=1 sql=2'
+
+
+def test_info_requests_snapshots(config, tmpdir, monkeypatch):
+    from talisker import inflight
+    client = get_client()
+    environ = {'REMOTE_ADDR': b'127.0.0.1'}
+    directory = str(tmpdir.mkdir('requests'))
+    monkeypatch.setenv('prometheus_multiproc_dir', directory)
+    config['TALISKER_REQUESTS_SNAPSHOT_SIZE'] = '1024'
+    for pid, rid, start in [(1, 'a', 100.0), (2, 'b', 50.0)]:
+        snapshot = inflight.RequestSnapshot(
+            inflight.snapshot_path(directory, pid), 1024)
+        snapshot.write(200.0, [{
+            'id': rid,
+            'method': 'GET',
+            'path': '/',
+            'view': None,
+            'start': start,
+            'deadline': None,
+            'tracking': {},
+        }])
+
+    response = client.get(
+        '/_status/info/requests',
+        environ_overrides=environ,
+        headers={'Accept': 'application/json'},
+    )
+    rows = response.json['requests']
+    # oldest first
+    assert [(r['PID'], r['Request Id']) for r in rows] == [
+        ('2', 'b'), ('1', 'a'),
+    ]
@@ -27,6 +27,7 @@ import logging
 import pytest
 
 try:
+    import flask
     from flask import Flask
 except ImportError:
     pytest.skip('skipping flask tests', allow_module_level=True)
@@ -183,6 +184,20 @@ def test_flask_view_name_header():
     assert response.headers['X-View-Name'] == 'tests.test_flask.index'
 
 
+def test_flask_view_name_set_before_view():
+    app = Flask(__name__)
+    names = []
+
+    @app.route('/')
+    def index():
+        names.append(flask.request.environ.get('VIEW_NAME'))
+        return 'ok'
+
+    talisker.flask.register(app)
+    get_url(app, '/')
+    assert names == ['tests.test_flask.index']
+
+
 def test_flask_view_name_header_no_view(context):
     app = Flask(__name__)
 
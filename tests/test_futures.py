@@ -0,0 +1,112 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import logging
+import time
+
+import pytest
+
+from talisker import Context, DeadlineExceeded
+from talisker.futures import (
+    TaliskerProcessPoolExecutor,
+    TaliskerThreadPoolExecutor,
+)
+
+
+def task(x):
+    Context.track('sql', 1.0)
+    Context.track('sql', 2.0)
+    logging.getLogger('test').info('task')
+    return Context.request_id, x, Context.current().deadline
+
+
+def failing_task():
+    Context.track('http', 5.0)
+    raise ValueError('fail')
+
+
+def no_context_task():
+    return Context.current().id
+
+
+def test_thread_executor(context):
+    Context.new()
+    Context.request_id = 'ID'
+    Context.set_absolute_deadline(time.time() + 10)
+    Context.track('sql', 1.0)
+    Context.logging.push(foo='bar')
+    parent = Context.current()
+    with TaliskerThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(task, i) for i in range(2)]
+        results = [f.result() for f in futures]
+
+    assert results == [('ID', i, parent.deadline) for i in range(2)]
+    assert parent.tracking['sql'].count == 5
+    assert parent.tracking['sql'].time == 7.0
+    assert parent.tracking['sql'].max == 2.0
+    context.assert_log(msg='task', extra={'request_id': 'ID', 'foo': 'bar'})
+
+
+def test_thread_executor_merges_tracking_on_error():
+    Context.new()
+    parent = Context.current()
+    with TaliskerThreadPoolExecutor(1) as executor:
+        future = executor.submit(failing_task)
+        with pytest.raises(ValueError):
+            future.result()
+    assert parent.tracking['http'].count == 1
+    assert parent.tracking['http'].time == 5.0
+
+
+def test_thread_executor_deadline_passed():
+    Context.new()
+    Context.set_absolute_deadline(time.time() - 1)
+    parent = Context.current()
+    with TaliskerThreadPoolExecutor(1) as executor:
+        future = executor.submit(task, 1)
+        with pytest.raises(DeadlineExceeded):
+            future.result()
+    assert 'sql' not in parent.tracking
+
+
+def test_thread_executor_no_context():
+    Context.clear()
+    with TaliskerThreadPoolExecutor(1) as executor:
+        assert executor.submit(no_context_task).result() is None
+
+
+def test_process_executor():
+    Context.new()
+    Context.request_id = 'ID'
+    Context.set_absolute_deadline(time.time() + 10)
+    parent = Context.current()
+    with TaliskerProcessPoolExecutor(1) as executor:
+        assert executor.submit(task, 1).result() == (
+            'ID', 1, parent.deadline)
+        with pytest.raises(ValueError):
+            executor.submit(failing_task).result()
+
+    assert parent.tracking['sql'].count == 2
+    assert parent.tracking['sql'].time == 3.0
+    assert parent.tracking['http'].count == 1
@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+
+from talisker import inflight, wsgi
+from talisker.context import Context
+
+
+def make_request(wsgi_env, path='/', deadline=None):
+    Context.new()
+    wsgi_env['PATH_INFO'] = path
+    wsgi_env['REQUEST_ID'] = 'ID-' + path
+    wsgi_env['start_time'] = Context.current().start_time
+    if deadline is not None:
+        Context.set_absolute_deadline(deadline)
+    request = wsgi.TaliskerWSGIRequest(wsgi_env, None)
+    Context.track('sql', 1.0)
+    Context.track('sql', 2.0)
+    Context.track('http', 3.0)
+    return request
+
+
+def test_describe_requests(wsgi_env):
+    requests = {
+        'a': make_request(wsgi_env.copy(), '/foo', deadline=1000.0),
+        'b': make_request(wsgi_env.copy(), '/_status/info/requests'),
+    }
+    requests['a'].headers = [('X-View-Name', 'view')]
+    rows = inflight.describe_requests(requests)
+    assert rows == [{
+        'id': 'ID-/foo',
+        'method': 'GET',
+        'path': '/foo',
+        'view': 'view',
+        'start': requests['a'].environ['start_time'],
+        'deadline': 1000.0,
+        'tracking': {'sql': 2, 'http': 1},
+    }]
+
+
+def test_describe_requests_view_before_response(wsgi_env):
+    request = make_request(wsgi_env, '/foo')
+    request.environ['VIEW_NAME'] = 'view'
+    rows = inflight.describe_requests({'a': request})
+    assert rows[0]['view'] == 'view'
+
+
+def test_snapshot_read_write(tmpdir):
+    path = inflight.snapshot_path(str(tmpdir), 1)
+    snapshot = inflight.RequestSnapshot(path, 1024)
+    assert inflight.read_snapshot(path) is None
+    snapshot.write(1.0, [{'id': 'a'}])
+    assert inflight.read_snapshot(path) == (1.0, [{'id': 'a'}])
+    snapshot.write(2.0, [])
+    assert inflight.read_snapshot(path) == (2.0, [])
+
+
+def test_snapshot_drops_newest_when_full(tmpdir):
+    path = inflight.snapshot_path(str(tmpdir), 1)
+    snapshot = inflight.RequestSnapshot(path, 30)
+    snapshot.write(1.0, [{'id': 'aaaa'}, {'id': 'bbbb'}, {'id': 'cccc'}])
+    assert inflight.read_snapshot(path) == (
+        1.0, [{'id': 'aaaa'}, {'id': 'bbbb'}])
+
+
+def test_read_snapshot_mid_write(tmpdir):
+    path = inflight.snapshot_path(str(tmpdir), 1)
+    snapshot = inflight.RequestSnapshot(path, 1024)
+    snapshot.write(1.0, [{'id': 'a'}])
+    # simulate a writer that has started but not finished
+    inflight.HEADER.pack_into(
+        snapshot.mmap, 0, inflight.MAGIC, inflight.VERSION, 1024, 3, 0, 0.0)
+    assert inflight.read_snapshot(path) is None
+
+
+def test_read_snapshot_bad_file(tmpdir):
+    path = tmpdir.join('requests_1.snap')
+    path.write('garbage')
+    assert inflight.read_snapshot(str(path)) is None
+
+
+def test_read_snapshots(tmpdir):
+    directory = str(tmpdir)
+    snap1 = inflight.RequestSnapshot(inflight.snapshot_path(directory, 10), 64)
+    snap2 = inflight.RequestSnapshot(inflight.snapshot_path(directory, 9), 64)
+    snap1.write(1.0, [{'id': 'a'}])
+    snap2.write(2.0, [{'id': 'b'}])
+    assert inflight.read_snapshots(directory) == [
+        ('9', 2.0, [{'id': 'b'}]),
+        ('10', 1.0, [{'id': 'a'}]),
+    ]
+    inflight.cleanup_worker(directory, 9)
+    assert inflight.read_snapshots(directory) == [('10', 1.0, [{'id': 'a'}])]
+
+
+def test_publisher_publish(tmpdir, wsgi_env, monkeypatch):
+    monkeypatch.setattr(inflight, 'PUBLISH_INTERVAL', 3600)
+    requests = {}
+    publisher = inflight.SnapshotPublisher(str(tmpdir), 1024, requests)
+    publisher.start()
+    path = inflight.snapshot_path(str(tmpdir), os.getpid())
+
+    publisher.publish(now=1.0)
+    # idle, so nothing written
+    assert inflight.read_snapshot(path) is None
+
+    requests['a'] = make_request(wsgi_env)
+    publisher.publish(now=2.0)
+    timestamp, rows = inflight.read_snapshot(path)
+    assert timestamp == 2.0
+    assert [r['id'] for r in rows] == ['ID-/']
+
+    requests.clear()
+    publisher.publish(now=3.0)
+    assert inflight.read_snapshot(path) == (3.0, [])
+    publisher.snapshot.close()
@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import pytest
+from freezegun import freeze_time
+
+import talisker
+from talisker import Context
+
+
+def test_instrument_decorator(context, get_breadcrumbs):
+    Context.new()
+
+    @talisker.instrument('redis')
+    def get(key):
+        return key
+
+    with freeze_time() as frozen:
+        @talisker.instrument('redis', 'set')
+        def set(key):
+            frozen.tick(0.25)
+
+        assert get('foo') == 'foo'
+        set('foo')
+
+    tracker = Context.current().tracking['redis']
+    assert tracker.count == 2
+    assert tracker.max == 250.0
+    assert tracker.top()[0] == (250.0, 'set')
+    # prometheus only, so no statsd packet per call
+    assert context.statsd == []
+
+    breadcrumbs = get_breadcrumbs()
+    if breadcrumbs is not None:
+        assert breadcrumbs[-1]['message'] == 'set'
+        assert breadcrumbs[-1]['category'] == 'redis'
+        assert breadcrumbs[-1]['data'] == {'duration_ms': 250.0, 'call': 'set'}
+
+
+def test_instrument_decorator_error(context, get_breadcrumbs):
+    Context.new()
+
+    @talisker.instrument('ldap', threshold=0)
+    def search():
+        raise ValueError()
+
+    with freeze_time() as frozen:
+        with pytest.raises(ValueError):
+            with talisker.instrument('ldap', 'bind'):
+                frozen.tick(0.1)
+                search()
+
+    assert Context.current().tracking['ldap'].count == 2
+    context.assert_not_log(msg='slow ldap call', extra={'call': 'bind'})
+    breadcrumbs = get_breadcrumbs()
+    if breadcrumbs is not None:
+        assert breadcrumbs[-1]['data']['error'] == 'ValueError'
+
+
+def test_instrument_context_manager(context, config):
+    config['TALISKER_SLOWCALL_THRESHOLD'] = '100'
+    Context.new()
+    with freeze_time() as frozen:
+        with talisker.instrument('grpc', 'Lookup', label='Lookup id=1'):
+            frozen.tick(0.5)
+        with talisker.instrument('grpc', 'Lookup', label='Lookup id=2'):
+            frozen.tick(0.01)
+
+    tracker = Context.current().tracking['grpc']
+    assert tracker.top() == [(500.0, 'Lookup id=1'), (10.0, 'Lookup id=2')]
+    context.assert_log(
+        name='talisker.instrumentation',
+        msg='slow grpc call',
+        extra={'duration_ms': 500.0, 'call': 'Lookup', 'label': 'Lookup id=1'},
+    )
+    assert len(context.logs.filter(msg='slow grpc call')) == 1
+
+
+def test_instrument_without_context(context, get_breadcrumbs):
+    Context.clear()
+    with freeze_time() as frozen:
+        @talisker.instrument('redis', threshold=0)
+        def get(key):
+            frozen.tick(0.1)
+            return key
+
+        with talisker.instrument('redis', 'set'):
+            frozen.tick(0.1)
+        assert get('foo') == 'foo'
+
+    context.assert_not_log(level='warning')
+    context.assert_log(msg='slow redis call', extra={'call': 'get'})
+    breadcrumbs = get_breadcrumbs()
+    if breadcrumbs is not None:
+        assert any(
+            b['message'] == 'get' and b['category'] == 'redis'
+            for b in breadcrumbs
+        )
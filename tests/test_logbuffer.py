@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2015-2021 Canonical, Ltd.
+#
+# This file is part of Talisker
+# (see http://github.com/canonical-ols/talisker).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import logging
+import os
+
+from talisker import logbuffer
+
+
+def test_ring_buffer_read_write(tmpdir):
+    path = logbuffer.buffer_path(str(tmpdir), 1)
+    buf = logbuffer.LogRingBuffer(path, 1024)
+    assert logbuffer.read_buffer(path) == []
+    buf.write(1.0, b'one')
+    buf.write(2.0, b'two')
+    assert logbuffer.read_buffer(path) == [(1.0, b'one'), (2.0, b'two')]
+
+
+def test_ring_buffer_wraps(tmpdir):
+    path = logbuffer.buffer_path(str(tmpdir), 1)
+    buf = logbuffer.LogRingBuffer(path, 200)
+    for i in range(50):
+        buf.write(float(i), 'line {:02d}'.format(i).encode())
+    entries = logbuffer.read_buffer(path)
+    # each entry is 24 bytes, so only 8 fit in the buffer
+    assert entries == [
+        (float(i), 'line {:02d}'.format(i).encode()) for i in range(42, 50)
+    ]
+
+
+def test_ring_buffer_truncates_large_entries(tmpdir):
+    path = logbuffer.buffer_path(str(tmpdir), 1)
+    buf = logbuffer.LogRingBuffer(path, 200)
+    buf.write(1.0, b'x' * 1000)
+    entries = logbuffer.read_buffer(path)
+    assert entries == [(1.0, b'x' * buf.max_entry)]
+
+
+def test_read_buffer_bad_file(tmpdir):
+    path = tmpdir.join('logs_1.ring')
+    path.write('garbage')
+    assert logbuffer.read_buffer(str(path)) == []
+
+
+def test_read_logs_merges_buffers(tmpdir):
+    directory = str(tmpdir.mkdir('logs'))
+    buf1 = logbuffer.LogRingBuffer(logbuffer.buffer_path(directory, 1), 1024)
+    buf2 = logbuffer.LogRingBuffer(logbuffer.buffer_path(directory, 2), 1024)
+    buf1.write(1.0, b'a')
+    buf2.write(2.0, b'b')
+    buf1.write(3.0, b'c')
+    buf2.write(4.0, 'd ☃'.encode('utf8'))
+    assert logbuffer.read_logs(directory) == [
+        (1.0, '1', 'a'),
+        (2.0, '2', 'b'),
+        (3.0, '1', 'c'),
+        (4.0, '2', 'd ☃'),
+    ]
+    assert logbuffer.read_logs(directory, limit=1) == [(4.0, '2', 'd ☃')]
+    assert logbuffer.read_logs(directory, limit=0) == []
+
+
+def test_ring_buffer_handler(tmpdir, monkeypatch):
+    directory = str(tmpdir.mkdir('logs'))
+    handler = logbuffer.RingBufferHandler(directory, 1024)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    record = logging.LogRecord('test', logging.INFO, 'fn', 1, 'msg', (), None)
+    handler.handle(record)
+    assert logbuffer.read_logs(directory) == [
+        (record.created, str(os.getpid()), 'msg'),
+    ]
+
+    # simulate a fork
+    pid = str(os.getpid())
+    monkeypatch.setattr(os, 'getpid', lambda: 1)
+    handler.handle(record)
+    pids = sorted(pid for _, pid, _ in logbuffer.read_logs(directory))
+    assert pids == sorted([pid, '1'])
+    handler.close()
+
+
+def test_cleanup_worker(tmpdir, monkeypatch):
+    monkeypatch.setattr(logbuffer, '_dead_workers', logbuffer.deque())
+    directory = str(tmpdir.mkdir('logs'))
+    for pid in range(4):
+        logbuffer.LogRingBuffer(logbuffer.buffer_path(directory, pid), 128)
+        logbuffer.cleanup_worker(directory, pid)
+    assert sorted(os.listdir(directory)) == ['logs_2.ring', 'logs_3.ring']
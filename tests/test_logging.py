@@ -23,6 +23,8 @@
 #
 
 import sys
+import gzip
+import json
 import logging
 import logging.handlers
 import os
@@ -31,11 +33,13 @@ import tempfile
 from collections import OrderedDict
 import shlex
 import calendar
+import time
 
 import pytest
 
 from talisker.context import Context
 from talisker import logs
+from talisker.testing import TestHandler
 
 
 TIME = calendar.timegm((2016, 1, 17, 12, 30, 10, 1, 48, 0))
@@ -183,6 +187,72 @@ def test_make_record_protected(monkeypatch):
     assert record._trailer is None
 
 
+def test_make_record_deferred_when_not_emitted():
+    Context.new()
+    logger = logs.StructuredLogger('test')
+    logger.addHandler(TestHandler(level=logging.INFO))
+    logs.set_global_extra({'a': 1})
+    logs.logging_context.push(b=2)
+    args = ('name', logging.DEBUG, 'fn', 'lno', 'msg', (), None)
+    record = logger.makeRecord(*args, extra={'c': 3, 'trailer': 't'})
+    assert isinstance(record, logs.DeferredExtraRecord)
+    assert record.c == 3
+    assert record._trailer == 't'
+    assert '_extra' not in record.__dict__
+    assert record.extra == {'a': 1, 'b': 2, 'c': 3}
+    assert record._structured is record.extra
+    assert record.__dict__['a'] == 1
+    assert record.__dict__['b'] == 2
+
+
+def test_make_record_not_deferred_when_emitted():
+    logger = logs.StructuredLogger('test')
+    logger.addHandler(TestHandler(level=logging.INFO))
+    record = logger.makeRecord(*record_args(), extra={'c': 3})
+    assert not isinstance(record, logs.DeferredExtraRecord)
+    assert record.extra == {'c': 3}
+
+
+def test_logger_will_emit():
+    parent = logs.StructuredLogger('parent')
+    logger = logs.StructuredLogger('parent.child')
+    logger.parent = parent
+    # no handlers configured, so assume lastResort
+    assert logger.will_emit(logging.DEBUG)
+    parent.addHandler(TestHandler(level=logging.INFO))
+    assert not logger.will_emit(logging.DEBUG)
+    assert logger.will_emit(logging.INFO)
+    logger.addHandler(TestHandler(level=logging.DEBUG))
+    assert logger.will_emit(logging.DEBUG)
+    logger.handlers[0].setLevel(logging.ERROR)
+    logger.propagate = False
+    assert not logger.will_emit(logging.INFO)
+
+
+def test_debug_buffer(debug_buffer):
+    Context.clear()
+    logs.start_debug_buffer(2)
+    assert Context.current().debug_buffer is None
+    Context.new()
+    logs.start_debug_buffer(2)
+    logger = logging.getLogger('test')
+    for i in range(3):
+        logger.debug('debug %s', i)
+    logger.info('info')
+    buffer = Context.current().debug_buffer
+    assert [r.args for r in buffer] == [(1,), (2,)]
+
+    sentry = TestHandler()
+    sentry._sentry_handler = True
+    logging.getLogger().addHandler(sentry)
+    assert logs.flush_debug_buffer() == 2
+    assert len(buffer) == 0
+    records = debug_buffer.logs.filter(name='test')
+    assert [r.msg for r in records] == ['info', 'debug %s', 'debug %s']
+    assert sentry.records == []
+    assert logs.flush_debug_buffer() == 0
+
+
 def test_logger_collects_raven_breadcrumbs():
     try:
         import raven.context
@@ -323,6 +393,39 @@ def test_formatter_protected(monkeypatch):
     assert log == '2016-01-17 12:30:10.123Z INFO name "msg here"'
 
 
+def test_formatter_caches_time_per_second():
+    fmt = logs.StructuredFormatter()
+    record = make_record({})
+    assert fmt.formatTime(record, fmt.DATEFMT) == '2016-01-17 12:30:10'
+    assert fmt.time_cache.key == (TIME, fmt.DATEFMT)
+    fmt.time_cache.value = 'cached'
+    record.created = TIME + 0.9
+    assert fmt.formatTime(record, fmt.DATEFMT) == 'cached'
+    record.created = TIME + 1
+    assert fmt.formatTime(record, fmt.DATEFMT) == '2016-01-17 12:30:11'
+    # default datefmt includes msecs, so is not cached
+    assert fmt.formatTime(record) == '2016-01-17 12:30:11,123'
+
+
+@pytest.mark.parametrize('format', [
+    logs.StructuredFormatter.FORMAT,
+    '%(name)s',
+    '%(levelname)-8s 100%% %(msecs)05.1f',
+])
+def test_compile_format(format):
+    record = make_record({})
+    record.asctime = 'asctime'
+    record.message = 'message'
+    fmt, getter = logs.compile_format(format)
+    assert fmt % getter(record.__dict__) == format % record.__dict__
+
+
+def test_compile_format_fallback():
+    assert logs.compile_format('%(name)s %s') is None
+    assert logs.compile_format('%%(name)s') is None
+    assert logs.compile_format('no fields') is None
+
+
 def test_coloured_formatter():
     fmt = logs.ColouredFormatter()
     record = make_record({})
@@ -384,6 +487,110 @@ def test_configure_debug_log(config, context):
     )
 
 
+def debug_log_record(msg, created=None):
+    record = logging.LogRecord(
+        'test', logging.DEBUG, 'fn', 1, msg, None, None)
+    if created is not None:
+        record.created = created
+    return record
+
+
+def debug_log_segments(handler):
+    return [os.path.basename(p) for _, p, _ in handler.segments()]
+
+
+def test_debug_log_handler_rotates_on_size(tmpdir, context):
+    path = str(tmpdir.join('debug.log'))
+    handler = logs.DebugLogHandler(path, segment_size=100, max_size=10000)
+    lines = ['line {:02d} {}'.format(i, 'x' * 40) for i in range(8)]
+    for line in lines:
+        handler.handle(debug_log_record(line))
+    handler.jobs.join()
+    handler.close()
+
+    segments = debug_log_segments(handler)
+    assert len(segments) == 2
+    assert all(s.endswith('.gz') for s in segments)
+    written = []
+    for _, segment, _ in handler.segments():
+        with gzip.open(segment, 'rt') as f:
+            written.extend(f.read().splitlines())
+    with open(path) as f:
+        written.extend(f.read().splitlines())
+    assert written == lines
+    assert 'debuglog.written.bytes:{}|c'.format(
+        sum(len(line) + 1 for line in lines)) in context.statsd
+
+
+def test_debug_log_handler_counts_bytes(tmpdir, context):
+    path = str(tmpdir.join('debug.log'))
+    handler = logs.DebugLogHandler(path, segment_size=1000, max_size=10000)
+    handler.handle(debug_log_record('caf\u00e9 \u2603'))
+    handler.report_metrics(time.time())
+    handler.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data == 'caf\u00e9 \u2603\n'.encode('utf8')
+    assert 'debuglog.written.bytes:{}|c'.format(len(data)) in context.statsd
+
+
+def test_debug_log_handler_rotates_on_time(tmpdir):
+    path = str(tmpdir.join('debug.log'))
+    handler = logs.DebugLogHandler(path, segment_size=1000, max_size=10000)
+    handler.handle(debug_log_record('before'))
+    handler.handle(debug_log_record('after', created=handler.rollover_at))
+    handler.jobs.join()
+    handler.close()
+
+    segment = handler.segments()[0][1]
+    with gzip.open(segment, 'rt') as f:
+        assert f.read() == 'before\n'
+    with open(path) as f:
+        assert f.read() == 'after\n'
+
+
+def test_debug_log_handler_rotated_by_other_process(tmpdir):
+    path = str(tmpdir.join('debug.log'))
+    handler = logs.DebugLogHandler(path, segment_size=1000, max_size=10000)
+    handler.handle(debug_log_record('before'))
+    os.rename(path, path + '.20160117-123010.000000.1')
+    handler.doRollover()
+    handler.handle(debug_log_record('after'))
+    handler.close()
+
+    assert handler.thread is None
+    assert debug_log_segments(handler) == [
+        'debug.log.20160117-123010.000000.1',
+    ]
+    with open(path) as f:
+        assert f.read() == 'after\n'
+
+
+def test_debug_log_handler_prunes_segments(tmpdir, context):
+    path = str(tmpdir.join('debug.log'))
+    handler = logs.DebugLogHandler(path, segment_size=100, max_size=250)
+    now = time.time()
+    for i, name in enumerate(['120000', '120001', '120002']):
+        segment = tmpdir.join('debug.log.20160117-{}.000000.1.gz'.format(name))
+        segment.write('x' * 100)
+        os.utime(str(segment), (now - 10 + i, now - 10 + i))
+    # expired, even though it fits under the size limit
+    expired = tmpdir.join('debug.log.20160116-120000.000000.1.gz')
+    expired.write('x')
+    os.utime(str(expired), (now - 86401, now - 86401))
+    # not ours
+    tmpdir.join('debug.log.bak').write('x' * 1000)
+
+    handler.maintain()
+
+    assert debug_log_segments(handler) == [
+        'debug.log.20160117-120001.000000.1.gz',
+        'debug.log.20160117-120002.000000.1.gz',
+    ]
+    assert tmpdir.join('debug.log.bak').exists()
+    assert 'debuglog.dropped.bytes:100|c' in context.statsd
+
+
 def test_configure_coloured(config, monkeypatch):
     config['TALISKER_COLOUR'] = 'default'
     config['DEVEL'] = True
@@ -530,6 +737,415 @@ def test_safe_string(input, expected):
     assert fmt.safe_string(input, 7, '...') == expected
 
 
+class Unprintable():
+    def __str__(self):
+        raise Exception('unprintable')
+
+
+class Number(int):
+    pass
+
+
+LOGFMT_INPUTS = [
+    {'foo': 'bar'},
+    {'foo': 1, 'bar': 1.5, 'baz': 0, 'qux': 0.0},
+    {'foo': '1', 'bar': '1.5', 'baz': '1.2.3', 'qux': ''},
+    {'foo': True, 'bar': False, 'baz': None},
+    {'foo': b'bytes', b'bkey': 'value', 1: 'int key', 2.5: 'float key'},
+    {True: 'bool key', 'foo': 'bar'},
+    {'with space': 'with space', 'dot.key': 'a=b', 'eq=key': '"quoted"'},
+    {'foo': ' stripped ', 'bar': '   ', 'baz': 'back\\slash'},
+    {'foo': 'multi\nline\nvalue', 'multi\nline': 'key'},
+    {'foo': 'x' * 2000, 'y' * 300: 'long key'},
+    {'foo': {'a': 1, 'b': '1', 'c': None, 'd': {'e': 'f'}, (1,): 'bad'}},
+    {'foo': [1, 2, 3], 'bar': object(), 'baz': Number(3)},
+    {'foo': Unprintable(), (1,): 'bad', 'bar': 'after'},
+    {'foo': {'a': 'b', 'c': Unprintable(), 'd': 'e'}},
+    {'foo': b'\xff', b'\xff': 'bad key bytes'},
+]
+
+
+@pytest.mark.parametrize('input', LOGFMT_INPUTS)
+def test_fast_logfmt_encoder_identical(input, context):
+    standard = logs.StructuredFormatter()
+    fast = logs.StructuredFormatter(encoder='fast')
+    assert isinstance(fast.encoder, logs.FastLogfmtEncoder)
+
+    def warnings():
+        return [r.msg for r in context.logs if r.name == 'talisker.logs']
+
+    expected = standard.logfmt(input)
+    expected_logs = warnings()
+    assert fast.logfmt(input) == expected
+    # uses the cache the second time around
+    assert fast.logfmt(input) == expected
+    assert warnings() == expected_logs * 3
+
+
+def test_fast_logfmt_encoder_limits():
+    fmt = logs.StructuredFormatter(encoder='fast')
+    assert fmt.logfmt({'abcdefghij': 'abcdefghij'}) == 'abcdefghij=abcdefghij'
+    fmt.MAX_KEY_SIZE = 5
+    fmt.MAX_VALUE_SIZE = 5
+    assert fmt.logfmt({'abcdefghij': 'abcdefghij'}) == 'abcde___=abcde...'
+
+
+def test_fast_logfmt_encoder_format():
+    fmt = logs.StructuredFormatter(encoder='fast')
+    log = fmt.format(make_record({'foo': 'bar', 'baz': 'with spaces'}))
+    timestamp, level, name, msg, structured = parse_logfmt(log)
+    assert timestamp == TIMESTAMP
+    assert msg == "msg here"
+    assert structured == {
+        'foo': 'bar',
+        'baz': 'with spaces',
+    }
+
+
+def test_configure_logfmt_encoder(config):
+    config['TALISKER_LOGFMT_ENCODER'] = 'fast'
+    logs.configure(config)
+    formatter = logs.get_talisker_handler().formatter
+    assert isinstance(formatter.encoder, logs.FastLogfmtEncoder)
+
+
+def test_json_formatter():
+    fmt = logs.JSONFormatter()
+    extra = OrderedDict()
+    extra['foo'] = 'bar'
+    extra['with space'] = ' with spaces '
+    extra['int'] = 1
+    extra['float'] = 1.5
+    extra['intstr'] = '1'
+    extra['bool'] = False
+    extra['none'] = None
+    extra['sub'] = {'a': 1, 'b': [1, 2]}
+    extra['logmsg'] = 'collision'
+    output = fmt.format(make_record(extra, msg='some " quotes\nand lines'))
+    assert '\n' not in output
+    data = json.loads(output, object_pairs_hook=OrderedDict)
+    assert list(data.items()) == [
+        ('timestamp', TIMESTAMP),
+        ('loglevel', 'INFO'),
+        ('module', 'name'),
+        ('logmsg', 'some " quotes\nand lines'),
+        ('foo', 'bar'),
+        ('with_space', 'with spaces'),
+        ('int', 1),
+        ('float', 1.5),
+        ('intstr', '1'),
+        ('bool', False),
+        ('sub_a', 1),
+        ('sub_b', str(type([]))),
+        ('logmsg_', 'collision'),
+    ]
+
+
+def test_json_formatter_truncates(monkeypatch):
+    monkeypatch.setattr(logs.JSONFormatter, 'MAX_MSG_SIZE', 5)
+    monkeypatch.setattr(logs.JSONFormatter, 'MAX_VALUE_SIZE', 5)
+    monkeypatch.setattr(logs.JSONFormatter, 'MAX_KEY_SIZE', 5)
+    fmt = logs.JSONFormatter()
+    record = make_record({'abcdefghij': '1234567890'}, msg='1234567890')
+    data = json.loads(fmt.format(record))
+    assert data['logmsg'] == '12345...'
+    assert data['abcde___'] == '12345...'
+
+
+def test_json_formatter_traceback():
+    fmt = logs.JSONFormatter()
+    try:
+        e = Exception('error')
+        e.errno = 101
+        raise e
+    except Exception:
+        record = make_record({'trailer': 'trailer'})
+        record.exc_info = sys.exc_info()
+        data = json.loads(fmt.format(record))
+    assert data['errno'] == 'ENETUNREACH'
+    assert data['traceback'].startswith('trailer\nTraceback')
+    assert data['traceback'].endswith('Exception: error')
+
+
+def test_json_formatter_bad_values(context):
+    fmt = logs.JSONFormatter()
+    record = make_record({
+        'nan': float('nan'),
+        'bytes': b'bytes',
+        'bad': b'\xff',
+        (1,): 'bad key',
+    })
+    data = json.loads(fmt.format(record))
+    assert data['nan'] == 'nan'
+    assert data['bytes'] == 'bytes'
+    assert data['bad'] == '???'
+    assert 'could not parse logfmt keys' in context.logs[-1].msg
+
+
+def test_configure_json(config, capsys):
+    config['TALISKER_LOG_FORMAT'] = 'json'
+    logs.configure(config)
+    formatter = logs.get_talisker_handler().formatter
+    assert isinstance(formatter, logs.JSONFormatter)
+    logging.getLogger('test').info('test msg', extra={'foo': 'bar'})
+    out, err = capsys.readouterr()
+    data = json.loads(err.splitlines()[-1])
+    assert data['module'] == 'test'
+    assert data['logmsg'] == 'test msg'
+    assert data['foo'] == 'bar'
+
+
+def dedup_record(msg, created, name='test', level=logging.ERROR):
+    record = logging.LogRecord(name, level, 'fn', 1, msg, (), None)
+    record.created = created
+    return record
+
+
+def test_dedup_filter():
+    dedup = logs.DedupFilter({'test': 2}, window=10)
+    assert dedup.filter(dedup_record('a %s', 100))
+    assert dedup.filter(dedup_record('a %s', 101))
+    assert not dedup.filter(dedup_record('a %s', 102))
+    assert not dedup.filter(dedup_record('a %s', 103))
+    # different message, level or logger
+    assert dedup.filter(dedup_record('b %s', 103))
+    assert dedup.filter(dedup_record('a %s', 103, level=logging.INFO))
+    assert dedup.filter(dedup_record('a %s', 103, name='other'))
+    # new window reports the dropped count
+    record = dedup_record('a %s', 110)
+    assert dedup.filter(record)
+    assert record.extra == {'repeated': 2}
+    record = dedup_record('a %s', 111)
+    assert dedup.filter(record)
+    assert not hasattr(record, 'extra')
+
+
+def test_dedup_filter_reports_burst_on_other_record(monkeypatch):
+    target = TestHandler()
+    dedup = logs.DedupFilter({'root': 1}, window=10, handler=target)
+    monkeypatch.setattr(dedup, 'start_timer', lambda: None)
+    for i in range(4):
+        dedup.filter(dedup_record('a %s', 100 + i))
+    assert target.records == []
+    # not yet ended
+    assert dedup.filter(dedup_record('b', 105))
+    assert target.records == []
+    assert dedup.filter(dedup_record('c', 111))
+    summary, = target.records
+    assert summary.msg == 'a %s'
+    assert summary.created == 103
+    assert summary.extra == {'repeated': 3}
+    # reported once only
+    record = dedup_record('a %s', 112)
+    assert dedup.filter(record)
+    assert not hasattr(record, 'extra')
+    assert len(target.records) == 1
+
+
+def test_dedup_filter_reports_burst_followed_by_silence():
+    target = TestHandler()
+    dedup = logs.DedupFilter({'root': 1}, window=0.05, handler=target)
+    now = time.time()
+    for i in range(3):
+        dedup.filter(dedup_record('a %s', now))
+    dedup.timer.join(1.0)
+    summary, = target.records
+    assert summary.extra == {'repeated': 2}
+    assert dedup.timer is None
+    dedup.close()
+
+
+def test_dedup_filter_flush():
+    target = TestHandler()
+    dedup = logs.DedupFilter({'root': 1}, window=60, handler=target)
+    now = time.time()
+    for i in range(3):
+        dedup.filter(dedup_record('a %s', now))
+    dedup.close()
+    summary, = target.records
+    assert summary.extra == {'repeated': 2}
+    assert not dedup.timer
+
+
+def test_dedup_filter_limits():
+    dedup = logs.DedupFilter({'a.b': 1, 'root': 5}, window=10)
+    assert dedup.get_limit('a.b') == 1
+    assert dedup.get_limit('a.b.c') == 1
+    assert dedup.get_limit('a') == 5
+    assert dedup.get_limit('other') == 5
+    assert logs.DedupFilter({'a': 1}, 10).get_limit('other') is None
+
+
+def test_dedup_filter_prunes(monkeypatch):
+    monkeypatch.setattr(logs.DedupFilter, 'MAX_KEYS', 2)
+    dedup = logs.DedupFilter({'root': 1}, window=10)
+    dedup.filter(dedup_record('a', 100))
+    dedup.filter(dedup_record('b', 105))
+    dedup.filter(dedup_record('c', 111))
+    assert set(k[2] for k in dedup.windows) == {'b', 'c'}
+    dedup.filter(dedup_record('d', 112))
+    assert set(k[2] for k in dedup.windows) == {'d'}
+
+
+def test_configure_dedup(config, capsys):
+    config['TALISKER_LOG_DEDUP'] = 'test=1'
+    logs.configure(config)
+    logger = logging.getLogger('test')
+    for i in range(3):
+        logger.info('repeated %s', i)
+    out, err = capsys.readouterr()
+    assert err.count('repeated') == 1
+    logs.flush_log_queue()
+    out, err = capsys.readouterr()
+    assert_output_includes_message(err, 'INFO test "repeated 2" repeated=2')
+
+
+def test_configure_ring_buffer(config, tmpdir, monkeypatch):
+    import talisker.logbuffer
+    directory = str(tmpdir.mkdir('logs'))
+    monkeypatch.setenv('prometheus_multiproc_dir', directory)
+    config['TALISKER_LOG_RING_BUFFER_SIZE'] = '4096'
+    logs.configure(config)
+    logging.getLogger('test').info('test msg')
+    lines = [line for _, _, line in talisker.logbuffer.read_logs(directory)]
+    assert_output_includes_message(lines[-1], 'INFO test "test msg"')
+
+
+def queue_record(level, msg):
+    logger = logs.StructuredLogger('test')
+    return logger.makeRecord('test', level, 'fn', 'lno', msg, (), None)
+
+
+def test_queue_handler_writes_in_order():
+    queue = logs.TaliskerQueueHandler(100)
+    target = TestHandler()
+    logs.add_talisker_handler(logging.NOTSET, target, queue=queue)
+    for i in range(10):
+        level = logging.ERROR if i % 3 == 0 else logging.INFO
+        queue.handle(queue_record(level, 'msg {}'.format(i)))
+    queue.flush()
+    assert [r.msg for r in target.records] == [
+        'msg {}'.format(i) for i in range(10)
+    ]
+    assert target.lines[0].endswith('ERROR test "msg 0"')
+    assert queue.thread.name == 'talisker-log-queue'
+    queue.close()
+    assert not queue.thread.is_alive()
+
+
+def test_queue_handler_respects_target_levels():
+    queue = logs.TaliskerQueueHandler(100)
+    info = TestHandler()
+    debug = TestHandler()
+    logs.add_talisker_handler(logging.INFO, info, queue=queue)
+    logs.add_talisker_handler(logging.DEBUG, debug, queue=queue)
+    queue.handle(queue_record(logging.DEBUG, 'debug'))
+    queue.handle(queue_record(logging.INFO, 'info'))
+    queue.flush()
+    assert [r.msg for r in info.records] == ['info']
+    assert [r.msg for r in debug.records] == ['debug', 'info']
+    queue.close()
+
+
+def test_queue_handler_ignores_unwanted_records():
+    queue = logs.TaliskerQueueHandler(100)
+    logs.add_talisker_handler(logging.INFO, TestHandler(), queue=queue)
+    queue.handle(queue_record(logging.DEBUG, 'debug'))
+    assert queue.size == 0
+    assert queue.thread is None
+
+
+def test_queue_handler_level_follows_targets():
+    queue = logs.TaliskerQueueHandler(100)
+    assert queue.level == logging.NOTSET
+    info = TestHandler()
+    logs.add_talisker_handler(logging.INFO, info, queue=queue)
+    assert queue.level == logging.INFO
+    info.setLevel(logging.DEBUG)
+    assert queue.level == logging.DEBUG
+
+
+def test_queue_handler_renders_args_on_calling_thread():
+    queue = logs.TaliskerQueueHandler(100)
+    target = TestHandler()
+    logs.add_talisker_handler(logging.INFO, target, queue=queue)
+    args = ['before']
+    record = queue_record(logging.INFO, 'value: %s')
+    record.args = (args,)
+    queue.handle(record)
+    args[0] = 'after'
+    queue.flush()
+    assert target.records[0].getMessage() == "value: ['before']"
+    queue.close()
+
+
+def test_queue_handler_does_not_modify_record():
+    queue = logs.TaliskerQueueHandler(100)
+    target = TestHandler()
+    logs.add_talisker_handler(logging.INFO, target, queue=queue)
+    record = queue_record(logging.INFO, 'value: %s')
+    record.args = ('arg',)
+    queue.handle(record)
+    queue.flush()
+    # later handlers, e.g. sentry, still see the unformatted message
+    assert record.msg == 'value: %s'
+    assert record.args == ('arg',)
+    assert target.records[0] is not record
+    assert target.records[0].msg == 'value: arg'
+    queue.close()
+
+
+def test_queue_handler_overflow(monkeypatch, context):
+    queue = logs.TaliskerQueueHandler(3)
+    target = TestHandler()
+    logs.add_talisker_handler(logging.DEBUG, target, queue=queue)
+    # do not start the writer thread, so the queue fills up
+    monkeypatch.setattr(queue, 'ensure_thread', lambda: None)
+
+    def queued():
+        return [r.msg for _, r in sorted(
+            queue.queues[0] + queue.queues[1] + queue.queues[2])]
+
+    queue.handle(queue_record(logging.DEBUG, 'debug 1'))
+    queue.handle(queue_record(logging.INFO, 'info 1'))
+    queue.handle(queue_record(logging.DEBUG, 'debug 2'))
+    # full, so the oldest debug is dropped
+    queue.handle(queue_record(logging.INFO, 'info 2'))
+    assert queued() == ['info 1', 'debug 2', 'info 2']
+    queue.handle(queue_record(logging.ERROR, 'error 1'))
+    assert queued() == ['info 1', 'info 2', 'error 1']
+    # nothing less important to drop, so this debug is dropped
+    queue.handle(queue_record(logging.DEBUG, 'debug 3'))
+    assert queued() == ['info 1', 'info 2', 'error 1']
+    queue.handle(queue_record(logging.ERROR, 'error 2'))
+    queue.handle(queue_record(logging.ERROR, 'error 3'))
+    assert queued() == ['error 1', 'error 2', 'error 3']
+    assert queue.dropped == 5
+
+    # full of errors, so write synchronously
+    queue.handle(queue_record(logging.ERROR, 'error 4'))
+    assert queued() == ['error 1', 'error 2', 'error 3']
+    assert [r.msg for r in target.records] == ['error 4']
+    assert queue.dropped == 5
+
+    metrics = context.statsd
+    assert 'logs.dropped.debug:1|c' in metrics
+    assert metrics.count('logs.dropped.info:1|c') == 2
+
+
+def test_configure_queue(config, capsys):
+    config['TALISKER_LOG_QUEUE_SIZE'] = '100'
+    logs.configure(config)
+    queue = logs.get_queue_handler()
+    assert queue.capacity == 100
+    assert queue.targets == [logs.get_talisker_handler()]
+    assert logs.get_talisker_handler() not in logging.getLogger().handlers
+    logging.getLogger('test').info('queued msg')
+    logs.flush_log_queue()
+    out, err = capsys.readouterr()
+    assert_output_includes_message(err, 'INFO test "queued msg"')
+
+
 def logging_app(environ, start_response):
     logger = logging.getLogger('test')
     logger.info('one')
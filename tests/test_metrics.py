@@ -126,3 +126,32 @@ def test_counter_protected(context, registry):
     counter.prometheus = 'THIS WILL RAISE'
     counter.inc(1, label='label')
     context.assert_log(msg='Failed to increment counter metric')
+
+
+def test_gauge(context, registry):
+    gauge = metrics.Gauge(
+        name='test_gauge',
+        documentation='test gauge',
+        labelnames=['label'],
+        statsd='{name}.{label}',
+        registry=registry,
+    )
+
+    labels = {'label': 'value'}
+    gauge.set(3, **labels)
+
+    assert context.statsd[0] == 'test.gauge.value:3|g'
+    assert registry.get_metric('test_gauge', **labels) == 3
+
+
+def test_gauge_protected(context, registry):
+    gauge = metrics.Gauge(
+        name='test_gauge_protected',
+        documentation='test gauge',
+        labelnames=['label'],
+        statsd='{name}.{label}',
+    )
+
+    gauge.prometheus = 'THIS WILL RAISE'
+    gauge.set(1, label='label')
+    context.assert_log(msg='Failed to set gauge metric')
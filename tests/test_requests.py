@@ -426,6 +426,158 @@ def test_adapter_raises_when_context_deadline_exceeded():
         session.get('http://name/foo')
 
 
+@pytest.fixture
+def slow_send(monkeypatch):
+    """Fake HTTPAdapter.send, with a configurable latency per backend."""
+    calls = []
+    delays = {}
+
+    def send(self, request, *args, **kwargs):
+        calls.append(request.url)
+        time.sleep(delays.get(request.url, 0))
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response._content = b''
+        response._content_consumed = True
+        return response
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+    return calls, delays
+
+
+def hedging_session(**kwargs):
+    session = requests.Session()
+    adapter = talisker.requests.TaliskerAdapter(
+        backends=['http://a.test'], **kwargs)
+    adapter.backend_iter = itertools.cycle(['http://a.test', 'http://b.test'])
+    session.mount('http://name', adapter)
+    return session, adapter
+
+
+def test_adapter_hedges_slow_requests(slow_send, context):
+    calls, delays = slow_send
+    delays['http://a.test/foo'] = 0.5
+    session, adapter = hedging_session(hedge_delay=0.05)
+
+    response = session.get('http://name/foo')
+    assert response.url == 'http://b.test/foo'
+    assert calls == ['http://a.test/foo', 'http://b.test/foo']
+    assert 'requests.hedges.name:1|c' in context.statsd
+    assert 'requests.hedges.won.name:1|c' in context.statsd
+
+    # the slow request is discarded when it finishes
+    adapter.hedge_executor.shutdown(wait=True)
+    wasted = [m for m in context.statsd if m.startswith('requests.hedge.')]
+    assert len(wasted) == 1
+    assert wasted[0].startswith('requests.hedge.wasted.ms.name:')
+    # both the winning hedge and the slow primary are sampled
+    assert len(adapter.hedge_latencies['name']) == 2
+
+
+def test_adapter_hedge_delay_excludes_queueing(slow_send):
+    calls, delays = slow_send
+    session, adapter = hedging_session(hedge_delay=0.05, hedge_workers=1)
+    # occupy the only worker behind the adapter's back, so the primary has
+    # to queue
+    adapter.get_hedge_executor().submit(time.sleep, 0.2)
+    start = time.time()
+    response = session.get('http://name/foo')
+    # gave up waiting for a worker and sent it directly
+    assert time.time() - start < 0.2
+    assert response.url == 'http://a.test/foo'
+    assert calls == ['http://a.test/foo']
+
+
+def test_adapter_hedge_pool_saturated(slow_send, context):
+    calls, delays = slow_send
+    delays['http://a.test/foo'] = 0.3
+    delays['http://b.test/foo'] = 0.3
+    session, adapter = hedging_session(hedge_delay=0.05, hedge_workers=2)
+    adapter.hedge_tokens = 0
+    results = []
+
+    def get():
+        results.append(session.get('http://name/foo').status_code)
+
+    start = time.time()
+    threads = [threading.Thread(target=get) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # callers beyond the pool size were sent unhedged, not queued
+    assert results == [200] * 6
+    assert time.time() - start < 0.55
+    assert len(calls) == 6
+
+
+def test_adapter_close_shuts_down_hedge_executor(slow_send):
+    session, adapter = hedging_session(hedge_delay=0.5)
+    session.get('http://name/foo')
+    executor = adapter.hedge_executor
+    session.close()
+    assert executor._shutdown
+    assert adapter.hedge_executor is None
+
+
+def test_adapter_does_not_hedge_fast_requests(slow_send, context):
+    calls, delays = slow_send
+    session, adapter = hedging_session(hedge_delay=0.5)
+    response = session.get('http://name/foo')
+    assert response.url == 'http://a.test/foo'
+    assert calls == ['http://a.test/foo']
+    assert not any(m.startswith('requests.hedge') for m in context.statsd)
+
+
+def test_adapter_hedge_budget(slow_send):
+    calls, delays = slow_send
+    delays['http://a.test/foo'] = 0.1
+    delays['http://b.test/foo'] = 0.1
+    session, adapter = hedging_session(hedge_delay=0.01, hedge_budget=0.5)
+    adapter.hedge_tokens = 0
+    session.get('http://name/foo')
+    assert calls == ['http://a.test/foo']
+    # two requests earn one hedge
+    session.get('http://name/foo')
+    assert calls[1:] == ['http://b.test/foo', 'http://a.test/foo']
+
+
+def test_adapter_hedge_only_safe_methods(slow_send):
+    calls, delays = slow_send
+    delays['http://a.test/foo'] = 0.1
+    session, adapter = hedging_session(hedge_delay=0.01)
+    session.post('http://name/foo', data='data')
+    assert calls == ['http://a.test/foo']
+
+
+def test_adapter_hedge_respects_deadline(slow_send):
+    calls, delays = slow_send
+    delays['http://a.test/foo'] = 0.2
+    Context.new()
+    Context.set_relative_deadline(50)
+    session, adapter = hedging_session(hedge_delay=0.1)
+    assert session.get('http://name/foo').url == 'http://a.test/foo'
+    assert calls == ['http://a.test/foo']
+
+
+def test_adapter_hedge_delay_from_percentile():
+    adapter = talisker.requests.TaliskerAdapter(
+        hedge_delay=1.0, hedge_percentile=95)
+    assert adapter.get_hedge_delay('host') == 1.0
+    adapter.hedge_latencies['host'].extend(i / 100 for i in range(100))
+    assert adapter.get_hedge_delay('host') == 0.95
+
+
+def test_adapter_hedge_records_latency(slow_send):
+    session, adapter = hedging_session(hedge_percentile=95)
+    for _ in range(talisker.requests.HEDGE_MIN_SAMPLES):
+        session.get('http://name/foo')
+    assert len(adapter.hedge_latencies['name']) == 20
+    assert adapter.get_hedge_delay('name') is not None
+
+
 class FakeSocket():
     """Pretend to be read only socket-like object that implements makefile."""
     def __init__(self, content):
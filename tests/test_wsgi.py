@@ -24,6 +24,8 @@
 
 from datetime import datetime, timedelta
 import json
+import logging
+import random
 import sys
 import time
 import wsgiref.util
@@ -32,6 +34,7 @@ import pytest
 from freezegun import freeze_time
 
 from talisker import wsgi, Context
+from talisker.context import Tracker
 from talisker.util import datetime_to_timestamp
 import talisker.sentry
 
@@ -301,6 +304,42 @@ def test_wsgi_request_wrap_error_headers_sent(run_wsgi, context):
         run_wsgi(body=iterator())
 
 
+def test_wsgi_request_wrap_streamed(run_wsgi, context):
+    chunks = [b'x' * i for i in range(1, 101)]
+    headers, body = run_wsgi(body=iter(chunks))
+
+    assert body == chunks
+    context.assert_log(
+        msg='GET /',
+        extra={'length': sum(len(c) for c in chunks)},
+    )
+
+
+def test_wsgi_request_wrap_error_after_first_chunk(run_wsgi, context):
+
+    def iterator():
+        yield b'first'
+        yield b'second'
+        raise Exception('error')
+
+    headers, body = run_wsgi(
+        env={'REQUEST_ID': 'rid', 'HTTP_ACCEPT': 'application/json'},
+        body=iterator(),
+    )
+
+    assert body[:2] == [b'first', b'second']
+    error = json.loads(body[2].decode('utf8'))
+    assert error['title'] == 'Server Error: Exception'
+    context.assert_log(
+        msg='GET /',
+        extra={
+            'status': 500,
+            'exc_type': 'Exception',
+            'length': sum(len(c) for c in body),
+        },
+    )
+
+
 def test_wsgi_request_wrap_no_body(run_wsgi, context):
     def iterator():
         return []
@@ -339,6 +378,8 @@ def test_wsgi_request_log(run_wsgi, context):
         ('status', 200),
         ('view', 'view'),
         ('duration_ms', 1000.0),
+        ('app_ms', 1000.0),
+        ('stream_ms', 0.0),
         ('ip', '127.0.0.1'),
         ('proto', 'HTTP/1.0'),
         ('length', 1000),
@@ -357,6 +398,24 @@ def test_wsgi_request_log(run_wsgi, context):
 
     assert context.statsd[0] == 'wsgi.requests.view.GET.200:1|c'
     assert context.statsd[1] == 'wsgi.latency.view.GET.200:1000.000000|ms'
+    assert context.statsd[2] == (
+        'wsgi.phase.latency.view.GET.app:1000.000000|ms')
+    assert context.statsd[3] == (
+        'wsgi.phase.latency.view.GET.stream:0.000000|ms')
+
+
+def test_wsgi_request_server_timing(run_wsgi, config):
+    config['TALISKER_SERVER_TIMING'] = '1'
+    Context.track('sql', 1.5)
+    Context.track('http', 2.0)
+    headers, _ = run_wsgi()
+    assert headers['Server-Timing'] == (
+        'app;dur=1000.0, http;dur=2.0, sql;dur=1.5')
+
+
+def test_wsgi_request_no_server_timing(run_wsgi):
+    headers, _ = run_wsgi()
+    assert 'Server-Timing' not in headers
 
 
 def test_wsgi_request_log_error(run_wsgi, context):
@@ -377,7 +436,7 @@ def test_wsgi_request_log_error(run_wsgi, context):
 
     assert context.statsd[0] == 'wsgi.requests.view.GET.500:1|c'
     assert context.statsd[1] == 'wsgi.latency.view.GET.500:1000.000000|ms'
-    assert context.statsd[2] == 'wsgi.errors.view.GET.500:1|c'
+    assert context.statsd[4] == 'wsgi.errors.view.GET.500:1|c'
 
 
 def test_wsgi_request_log_timeout(wsgi_env, context):
@@ -399,6 +458,36 @@ def test_wsgi_request_log_timeout(wsgi_env, context):
     )
 
 
+def test_wsgi_request_log_sampling(run_wsgi, context, config, monkeypatch):
+    config['TALISKER_ACCESS_LOG_SAMPLING'] = '/static/*=0 view=0.1'
+    config['TALISKER_ACCESS_LOG_SAMPLING_THRESHOLD'] = '2000'
+    monkeypatch.setattr(wsgi.random, 'random', lambda: 0.05)
+
+    # suppressed
+    run_wsgi({'PATH_INFO': '/static/foo.css'})
+    context.assert_not_log(msg='GET /static/foo.css')
+    # errors are always logged
+    run_wsgi({'PATH_INFO': '/static/bar.css'}, status='404 Not Found')
+    context.assert_log(msg='GET /static/bar.css', extra={'status': 404})
+    # slow requests are always logged
+    run_wsgi({'PATH_INFO': '/static/baz.css'}, duration=3)
+    context.assert_log(msg='GET /static/baz.css')
+    # sampled by view name
+    run_wsgi({'PATH_INFO': '/sampled'}, headers=[('X-View-Name', 'view')])
+    context.assert_log(msg='GET /sampled', extra={'sampled_rate': 0.1})
+    monkeypatch.setattr(wsgi.random, 'random', lambda: 0.5)
+    run_wsgi({'PATH_INFO': '/dropped'}, headers=[('X-View-Name', 'view')])
+    context.assert_not_log(msg='GET /dropped')
+    # no matching rule
+    run_wsgi({'PATH_INFO': '/other'})
+    log = context.logs.find(msg='GET /other')
+    assert 'sampled_rate' not in log.extra
+
+    # metrics still count every request
+    requests = context.statsd.filter('wsgi.requests.')
+    assert len(requests) == 6
+
+
 def test_wsgi_request_metrics(wsgi_env, context):
     wsgi_env['VIEW_NAME'] = 'view'
     request = wsgi.TaliskerWSGIRequest(wsgi_env, start_response, [])
@@ -449,6 +538,328 @@ def test_middleware_basic(wsgi_env, start_response, context):
     )
 
 
+def test_middleware_sequential_request_id(wsgi_env, start_response, config):
+    config['TALISKER_REQUEST_ID_FORMAT'] = 'sequential'
+
+    def app(environ, _start_response):
+        _start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'OK']
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    list(mw(wsgi_env, start_response))
+
+    rid = wsgi_env['REQUEST_ID']
+    prefix, _, counter = rid.partition('-')
+    assert len(prefix) == 20
+    assert len(counter) == 12
+    assert ('X-Request-Id', rid) in start_response.headers
+    # no sentry report, so no sentry id
+    assert 'SENTRY_ID' not in wsgi_env
+
+
+def test_sequential_request_id(monkeypatch):
+    generate = wsgi.SequentialRequestId()
+    ids = [generate() for _ in range(3)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 3
+    assert len(set(i.partition('-')[0] for i in ids)) == 1
+
+    # a new prefix and counter after forking
+    monkeypatch.setattr(wsgi.os, 'getpid', lambda: -1)
+    forked = generate()
+    assert forked.partition('-')[0] != ids[0].partition('-')[0]
+    assert forked.endswith('-000000000001')
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('t=1600000000.5', 1600000000.5),
+    ('1600000000.5', 1600000000.5),
+    ('t=1600000000500', 1600000000.5),
+    ('1600000000500000', 1600000000.5),
+    ('t=1600000000500000000', 1600000000.5),
+    ('garbage', None),
+    ('nan', None),
+    ('t=inf', None),
+    ('-inf', None),
+])
+def test_parse_request_start(header, expected):
+    assert wsgi.parse_request_start(header) == expected
+
+
+def test_get_queue_time():
+    start = 1600000000.5
+    env = {'HTTP_X_REQUEST_START': 't=1600000000400'}
+    assert round(wsgi.get_queue_time(env, start), 3) == 0.1
+    env = {'HTTP_X_QUEUE_START': 't=1600000000400'}
+    assert round(wsgi.get_queue_time(env, start), 3) == 0.1
+    # small clock skew
+    env = {'HTTP_X_REQUEST_START': 't=1600000000600'}
+    assert wsgi.get_queue_time(env, start) == 0
+    # bogus
+    env = {'HTTP_X_REQUEST_START': 't=1500000000'}
+    assert wsgi.get_queue_time(env, start) is None
+    env = {'HTTP_X_REQUEST_START': 'nan'}
+    assert wsgi.get_queue_time(env, start) is None
+    assert wsgi.get_queue_time({}, start) is None
+
+
+def test_middleware_queue_time(wsgi_env, start_response, context):
+
+    def app(environ, _start_response):
+        _start_response('200 OK', [('X-View-Name', 'view')])
+        return [b'OK']
+
+    with freeze_time('2020-09-13 12:26:40'):
+        wsgi_env['HTTP_X_REQUEST_START'] = 't=1599999999750'
+        mw = wsgi.TaliskerMiddleware(app, {}, {})
+        list(mw(wsgi_env, start_response))
+
+    context.assert_log(msg='GET /', extra={'queue_ms': 250.0})
+    assert 'wsgi.queue.latency.view:250.000000|ms' in context.statsd
+
+
+def test_middleware_deadline_includes_queue(
+        wsgi_env, start_response, config):
+    config['TALISKER_REQUEST_TIMEOUT'] = 2000
+    config['TALISKER_DEADLINE_INCLUDES_QUEUE'] = '1'
+    contexts = []
+
+    def app(environ, _start_response):
+        contexts.append(Context.current())
+        _start_response('200 OK', [])
+        return [b'OK']
+
+    wsgi_env['HTTP_X_REQUEST_START'] = 't={:.3f}'.format(time.time() - 0.5)
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    list(mw(wsgi_env, start_response))
+
+    ctx = contexts[0]
+    queue_time = wsgi_env['queue_time']
+    assert queue_time > 0.4
+    assert ctx.deadline == pytest.approx(ctx.start_time - queue_time + 2.0)
+
+
+def test_middleware_sheds_over_concurrency(
+        wsgi_env, start_response, config, context, monkeypatch):
+    config['TALISKER_MAX_CONCURRENCY'] = '1'
+    monkeypatch.setitem(wsgi.REQUESTS, 'other', object())
+    calls = []
+
+    def app(environ, _start_response):
+        calls.append(environ)
+        _start_response('200 OK', [])
+        return [b'OK']
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    output = b''.join(mw(wsgi_env, start_response))
+    b''.join(mw(wsgi_env.copy(), start_response))
+
+    assert calls == []
+    assert output == b'Service Unavailable'
+    assert start_response.status == '503 Service Unavailable'
+    assert ('Retry-After', '1') in start_response.headers
+    assert context.statsd.count('wsgi.shed.concurrency:1|c') == 2
+    # only logged once a second
+    context.assert_log(
+        name='talisker.wsgi',
+        msg='shedding requests',
+        extra={'count': 1, 'concurrency': 1},
+    )
+    assert len(context.logs.filter(msg='shedding requests')) == 1
+    context.assert_not_log(msg='GET /')
+
+
+def test_middleware_shed_log_counts_reasons(
+        wsgi_env, start_response, monkeypatch, context):
+    mw = wsgi.TaliskerMiddleware(None, {}, {})
+    wsgi_env['REQUEST_ID'] = 'ID'
+    for reason in ('concurrency', 'deadline', 'concurrency'):
+        mw.shed(wsgi_env.copy(), start_response, reason)
+    monkeypatch.setattr(wsgi, 'SHED_LOG_INTERVAL', 0)
+    mw.shed(wsgi_env.copy(), start_response, 'adaptive')
+    logs = context.logs.filter(msg='shedding requests')
+    assert [r.extra for r in logs] == [
+        {'count': 1, 'concurrency': 1},
+        {'count': 3, 'adaptive': 1, 'concurrency': 1, 'deadline': 1},
+    ]
+
+
+def test_middleware_status_exempt_from_shedding(
+        wsgi_env, start_response, config, monkeypatch):
+    config['TALISKER_MAX_CONCURRENCY'] = '1'
+    monkeypatch.setitem(wsgi.REQUESTS, 'other', object())
+
+    def app(environ, _start_response):
+        _start_response('200 OK', [])
+        return [b'OK']
+
+    wsgi_env['PATH_INFO'] = '/_status/ping'
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    assert b''.join(mw(wsgi_env, start_response)) == b'OK'
+    env = dict(wsgi_env, PATH_INFO='/_statusX')
+    assert b''.join(mw(env, start_response)) == b'Service Unavailable'
+
+
+def test_middleware_sheds_past_deadline(
+        wsgi_env, start_response, config, context):
+    config['TALISKER_MIN_DEADLINE_BUDGET'] = '100'
+
+    def app(environ, _start_response):
+        _start_response('200 OK', [])
+        return [b'OK']
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    ts = datetime.utcnow() + timedelta(milliseconds=50)
+    wsgi_env['HTTP_X_REQUEST_DEADLINE'] = ts.isoformat() + 'Z'
+    assert b''.join(mw(wsgi_env, start_response)) == b'Service Unavailable'
+    assert 'wsgi.shed.deadline:1|c' in context.statsd
+
+    ts = datetime.utcnow() + timedelta(seconds=10)
+    wsgi_env['HTTP_X_REQUEST_DEADLINE'] = ts.isoformat() + 'Z'
+    assert b''.join(mw(wsgi_env, start_response)) == b'OK'
+
+
+def test_wsgi_request_log_slowest_calls(run_wsgi, context):
+    env = {'REQUEST_ID': 'rid'}
+    Context.track('sql', 2.0, 'SELECT 1')
+    Context.track('sql', 5.0, 'SELECT\n  *   FROM foo WHERE id = %s')
+    Context.track('sql', 1.0)
+    Context.track('http', 3.0)
+    run_wsgi(env)
+    log = context.logs.find(msg='GET /')
+    assert log.extra['sql_count'] == 3
+    assert log.extra['sql_max_ms'] == 5.0
+    assert log.extra['sql_slowest'] == (
+        '5.0ms SELECT * FROM foo WHERE id = %s; 2.0ms SELECT 1')
+    assert 'http_max_ms' not in log.extra
+    assert 'http_slowest' not in log.extra
+
+
+def test_format_slowest_truncates():
+    tracker = Tracker()
+    tracker.add(1.0, 'x' * 100)
+    assert wsgi.format_slowest(tracker) == '1.0ms ' + 'x' * 77 + '...'
+
+
+def warm_limiter(limiter, view='view', duration=0.01):
+    for _ in range(wsgi.ADAPTIVE_BASELINE_SAMPLES):
+        limiter.update(100.0, duration, 1, view)
+    assert limiter.baselines[view] == [
+        pytest.approx(duration), wsgi.ADAPTIVE_BASELINE_SAMPLES]
+
+
+def test_adaptive_limiter_decreases_on_sustained_latency():
+    limiter = wsgi.AdaptiveLimiter(10)
+    warm_limiter(limiter)
+    assert limiter.current() == 10
+    for i in range(wsgi.ADAPTIVE_MIN_ROUND - 1):
+        limiter.update(101.0, 0.01 if i % 2 else 0.1, 1, 'view')
+    assert limiter.current() == 10
+    limiter.update(101.0, 0.1, 1, 'view')
+    # over half the round was slow
+    assert limiter.current() == 9
+
+    # started before the cut, so ignored
+    for i in range(wsgi.ADAPTIVE_MIN_ROUND):
+        limiter.update(101.0, 0.1, 1, 'view')
+    assert limiter.round_count == 0
+    assert limiter.current() == 9
+    for i in range(wsgi.ADAPTIVE_MIN_ROUND):
+        limiter.update(102.0, 0.1, 1, 'view')
+    assert limiter.current() == 8
+
+
+def test_adaptive_limiter_ignores_occasional_slow_requests():
+    limiter = wsgi.AdaptiveLimiter(10)
+    warm_limiter(limiter)
+    for i in range(wsgi.ADAPTIVE_MIN_ROUND * 10):
+        limiter.update(101.0, 1.0 if i % 3 == 0 else 0.01, 1, 'view')
+    assert limiter.current() == 10
+
+
+def test_adaptive_limiter_increases_when_busy():
+    limiter = wsgi.AdaptiveLimiter(10)
+    limiter.limit = 4.0
+    warm_limiter(limiter)
+    # mostly idle, so no evidence we need more
+    for _ in range(wsgi.ADAPTIVE_MIN_ROUND):
+        limiter.update(101.0, 0.015, 1, 'view')
+    assert limiter.limit == 4.0
+    for _ in range(wsgi.ADAPTIVE_MIN_ROUND - 1):
+        limiter.update(101.0, 0.015, 1, 'view')
+    limiter.update(101.0, 0.015, 2, 'view')
+    assert limiter.limit == 5.0
+    limiter.limit = 10.0
+    for _ in range(wsgi.ADAPTIVE_MIN_ROUND):
+        limiter.update(101.0, 0.01, 10, 'view')
+    assert limiter.limit == 10.0
+
+
+def test_adaptive_limiter_min_limit():
+    limiter = wsgi.AdaptiveLimiter(2)
+    warm_limiter(limiter)
+    limiter.limit = 1.0
+    for _ in range(wsgi.ADAPTIVE_MIN_ROUND):
+        limiter.update(101.0, 1.0, 0, 'view')
+    assert limiter.limit == 1.0
+
+
+def test_adaptive_limiter_stable_with_mixed_views():
+    rng = random.Random(0)
+    limiter = wsgi.AdaptiveLimiter(32)
+    views = {'fast': 0.005, 'slow': 0.08, 'variable': 0.02}
+    now = 100.0
+    for i in range(20000):
+        view = rng.choice(list(views))
+        duration = rng.expovariate(1 / views[view])
+        # a mix of sequential and concurrent traffic
+        inflight = 1 if i < 10000 else rng.randint(1, 16)
+        limiter.update(now, duration, inflight, view)
+        now += 0.001
+    assert limiter.current() == 32
+
+
+def test_adaptive_limiter_baseline_follows_latency():
+    limiter = wsgi.AdaptiveLimiter(10)
+    warm_limiter(limiter)
+    for _ in range(wsgi.ADAPTIVE_BASELINE_SAMPLES * 5):
+        limiter.update(101.0, 0.1, 1, 'view')
+    assert limiter.baselines['view'][0] == pytest.approx(0.1, rel=0.01)
+
+
+def test_adaptive_limiter_bounds_views(monkeypatch):
+    monkeypatch.setattr(wsgi, 'ADAPTIVE_MAX_VIEWS', 2)
+    limiter = wsgi.AdaptiveLimiter(10)
+    for view in ('a', 'b', 'c', 'd'):
+        limiter.update(100.0, 0.01, 1, view)
+    assert set(limiter.baselines) == {'a', 'b', None}
+    assert limiter.baselines[None][1] == 2
+
+
+def test_middleware_sheds_over_adaptive_limit(
+        wsgi_env, start_response, config, context, monkeypatch):
+    config['TALISKER_ADAPTIVE_CONCURRENCY'] = '2'
+    calls = []
+
+    def app(environ, _start_response):
+        calls.append(environ)
+        _start_response('200 OK', [])
+        return [b'OK']
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    assert b''.join(mw(wsgi_env, start_response)) == b'OK'
+    assert mw.limiter.current() == 2
+    assert 'wsgi.concurrency.limit:2|g' in context.statsd
+    assert 'wsgi.inflight:0|g' in context.statsd
+
+    mw.limiter.limit = 1.0
+    monkeypatch.setitem(wsgi.REQUESTS, 'other', object())
+    output = b''.join(mw(wsgi_env.copy(), start_response))
+    assert output == b'Service Unavailable'
+    assert len(calls) == 1
+    assert 'wsgi.shed.adaptive:1|c' in context.statsd
+
+
 def test_middleware_sets_deadlines(wsgi_env, start_response, config):
     config['TALISKER_SOFT_REQUEST_TIMEOUT'] = 1000
     config['TALISKER_REQUEST_TIMEOUT'] = 2000
@@ -703,6 +1114,46 @@ def test_middleware_debug(wsgi_env, start_response, context):
         assert msg['level'] == 'debug'
 
 
+def test_middleware_debug_buffer_discarded(
+        wsgi_env, start_response, debug_buffer):
+
+    def app(environ, _start_response):
+        logging.getLogger('app').debug('debug msg')
+        _start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'OK']
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    assert b''.join(mw(wsgi_env, start_response)) == b'OK'
+    debug_buffer.assert_log(name='talisker.wsgi', msg='GET /')
+    debug_buffer.assert_not_log(name='app')
+
+
+def test_middleware_debug_buffer_flushed_on_error(
+        wsgi_env, start_response, debug_buffer, sentry_id):
+    wsgi_env['HTTP_X_REQUEST_ID'] = 'ID'
+
+    def app(environ, _start_response):
+        logging.getLogger('app').debug('debug %s', 'msg', extra={'a': 1})
+        raise Exception('error')
+
+    mw = wsgi.TaliskerMiddleware(app, {}, {})
+    list(mw(wsgi_env, start_response))
+
+    logs = [r.msg for r in debug_buffer.logs if r.name != 'talisker.sentry']
+    assert logs == ['debug %s', 'GET /']
+    debug_buffer.assert_log(
+        name='app',
+        msg='debug %s',
+        levelname='DEBUG',
+        extra={'a': 1, 'request_id': 'ID'},
+    )
+
+    if talisker.sentry.enabled:
+        crumbs = debug_buffer.sentry[0]['breadcrumbs']['values']
+        assert crumbs[-2]['message'] == 'debug msg'
+        assert crumbs[-2]['level'] == 'debug'
+
+
 def test_middleware_debug_invalid_ip(wsgi_env, start_response, context):
 
     def app(environ, _start_response):